@@ -0,0 +1,143 @@
+# 檔案名稱: admission.py
+# /analyze 的准入控制：限制同時處理的請求數，超過的請求在有上限的佇列中等待（有期限），
+# 佇列已滿或等待逾時即快速回 503 + Retry-After，不讓延遲在 threadpool 裡無聲地累積
+# LLM 積壓（llm_gateway 排隊中的呼叫）超過門檻或斷路器開啟時進入降級模式：
+# 只返回確定性的星盤（engine + bazi），AI 段落僅使用快取與預先組好的內容，不再呼叫 LLM
+#
+#   ADMISSION_MAX_IN_FLIGHT    同時處理的請求上限（預設 64）
+#   ADMISSION_QUEUE_SIZE       等待佇列上限（預設 128）
+#   ADMISSION_QUEUE_TIMEOUT    在佇列中最多等待的秒數（預設 5）
+#   ADMISSION_RETRY_AFTER      503 回應的 Retry-After 秒數（預設 5）
+#   ADMISSION_DEGRADE_BACKLOG  LLM 排隊呼叫數達此值時降級（預設 32；0 表示不降級）
+import asyncio
+import os
+from collections import deque
+
+import llm_gateway
+import logs
+import metrics
+
+logger = logs.get_logger("admission")
+
+
+class Overloaded(Exception):
+    """佇列已滿或等待逾時；retry_after 為建議的重試秒數"""
+
+    def __init__(self, reason, retry_after):
+        super().__init__(reason)
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class Ticket:
+    """一次准入；degraded 為 True 時不應呼叫 LLM"""
+
+    def __init__(self, controller, degraded):
+        self._controller = controller
+        self.degraded = degraded
+        self._released = False
+
+    def release(self):
+        if not self._released:
+            self._released = True
+            self._controller._release()
+
+
+class AdmissionController:
+    def __init__(self, max_in_flight, queue_size, queue_timeout, retry_after, degrade_backlog):
+        self.max_in_flight = max_in_flight
+        self.queue_size = queue_size
+        self.queue_timeout = queue_timeout
+        self.retry_after = retry_after
+        self.degrade_backlog = degrade_backlog
+        self.in_flight = 0
+        self._waiters = deque()
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            max_in_flight=int(os.getenv("ADMISSION_MAX_IN_FLIGHT", "64")),
+            queue_size=int(os.getenv("ADMISSION_QUEUE_SIZE", "128")),
+            queue_timeout=float(os.getenv("ADMISSION_QUEUE_TIMEOUT", "5")),
+            retry_after=int(os.getenv("ADMISSION_RETRY_AFTER", "5")),
+            degrade_backlog=int(os.getenv("ADMISSION_DEGRADE_BACKLOG", "32")),
+        )
+
+    def llm_backlog(self):
+        return len(llm_gateway.gateway.limiter._waiters)
+
+    def should_degrade(self):
+        """LLM 積壓過高或斷路器開啟（呼叫注定失敗）時降級"""
+        if llm_gateway.gateway.breaker.state == "open":
+            return True
+        return self.degrade_backlog > 0 and self.llm_backlog() >= self.degrade_backlog
+
+    async def acquire(self):
+        """
+        取得處理名額，回傳 Ticket（用完務必 release）
+        佇列已滿時立即、等待逾時時拋出 Overloaded
+        """
+        if self.in_flight >= self.max_in_flight or self._waiters:
+            if len(self._waiters) >= self.queue_size:
+                _admissions.inc("rejected")
+                raise Overloaded("queue_full", self.retry_after)
+            waiter = asyncio.get_running_loop().create_future()
+            self._waiters.append(waiter)
+            try:
+                async with asyncio.timeout(self.queue_timeout):
+                    await waiter
+            except BaseException as e:
+                if waiter in self._waiters:
+                    self._waiters.remove(waiter)
+                elif waiter.done() and not waiter.cancelled():
+                    self._release()  # 名額已轉交卻放棄了，交給下一位
+                if isinstance(e, TimeoutError):
+                    _admissions.inc("timeout")
+                    raise Overloaded("queue_timeout", self.retry_after) from None
+                raise
+            # 名額由 _release 直接轉交，in_flight 已計入
+        else:
+            self.in_flight += 1
+        degraded = self.should_degrade()
+        _admissions.inc("degraded" if degraded else "admitted")
+        if degraded:
+            logger.info("degraded admission", extra={"fields": {"llm_backlog": self.llm_backlog()}})
+        return Ticket(self, degraded)
+
+    def _release(self):
+        # 有人排隊時名額直接轉交，避免新到的請求插隊
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+        self.in_flight -= 1
+
+    def stats(self):
+        return {
+            "max_in_flight": self.max_in_flight,
+            "in_flight": self.in_flight,
+            "queued": len(self._waiters),
+            "queue_size": self.queue_size,
+            "llm_backlog": self.llm_backlog(),
+            "degrade_backlog": self.degrade_backlog,
+            "degraded": self.should_degrade(),
+        }
+
+
+controller = AdmissionController.from_env()
+
+_admissions = metrics.registry.register(metrics.Counter(
+    "star_admission_total", "Admission decisions for /analyze requests", ("outcome",)))
+_in_flight_gauge = metrics.registry.register(metrics.Gauge(
+    "star_admission_in_flight", "Requests currently admitted"))
+_queued_gauge = metrics.registry.register(metrics.Gauge(
+    "star_admission_queued", "Requests waiting for admission"))
+
+
+def _collect():
+    _in_flight_gauge.set(value=controller.in_flight)
+    _queued_gauge.set(value=len(controller._waiters))
+
+
+metrics.registry.collectors.append(_collect)
@@ -0,0 +1,151 @@
+# 檔案名稱: analytics.py
+# 族群層級的元素統計：整批出生資料一次以 NumPy 陣列運算，
+# 產出星座 / 四元素 / 五行的彙總直方圖（給後台儀表板用）
+import threading
+
+import numpy as np
+
+import bazi_fast
+import ephemeris
+import engine
+
+ELEMENTS = ["Fire", "Earth", "Air", "Water"]
+# 星座序號 → 四元素序號
+SIGN_ELEMENT = np.array([ELEMENTS.index(engine.SIGN_TO_ELEMENT[name]) for name in engine.ZODIAC_NAMES])
+
+# 與 engine.calculate_positions 相同的行星集合與權重
+BODIES = [p for p in engine.PLANETS_LIST if p in engine.FLATLIB_DEFAULT_OBJECTS]
+BODY_COLUMNS = [ephemeris.BODIES.index(p) for p in BODIES]
+BODY_WEIGHTS = np.array([engine.PLANET_WEIGHTS[p] for p in BODIES], dtype=np.float64)
+
+# 可統計的出生年份：八字節氣表涵蓋的範圍
+YEAR_RANGE = (bazi_fast.FIRST_YEAR, bazi_fast.LAST_YEAR)
+
+# 未提供 UTC 偏移時與 engine 相同，以 +08:00 解讀出生時間
+TZ_OFFSET_HOURS = 8.0
+_UNIX_EPOCH = np.datetime64("1970-01-01T00:00:00", "s")
+_UNIX_EPOCH_JD = 2440587.5
+
+
+def to_julian_days(timestamps, tz_offset_hours=TZ_OFFSET_HOURS):
+    """當地鐘錶時間（datetime64 陣列）→ 世界時儒略日；tz_offset_hours 可為純量或逐筆的陣列"""
+    seconds = (np.asarray(timestamps, dtype="datetime64[s]") - _UNIX_EPOCH).astype(np.float64)
+    return _UNIX_EPOCH_JD + seconds / 86400.0 - tz_offset_hours / 24.0
+
+
+def ascendant_longitudes(jds, lats, lons):
+    """
+    向量化計算上升點黃經：由格林威治平恆星時與平黃赤交角推得
+    （未計章動，與 Swiss Ephemeris 相差約百分之一度，足夠判定星座）
+    """
+    d = jds - 2451545.0
+    t = d / 36525.0
+    gmst = 280.46061837 + 360.98564736629 * d + 0.000387933 * t * t
+    ramc = np.radians((gmst + lons) % 360.0)
+    eps = np.radians(23.439291 - 0.0130042 * t)
+    phi = np.radians(lats)
+    asc = np.degrees(np.arctan2(np.cos(ramc), -(np.sin(ramc) * np.cos(eps) + np.tan(phi) * np.sin(eps))))
+    return asc % 360.0
+
+
+def planet_longitudes(jds):
+    """(N,) 儒略日 → (N, 行星數) 黃經；有黃經表時插值，否則逐筆由 Swiss Ephemeris 計算"""
+    table = ephemeris.get_table()
+    if table is not None and np.all((jds >= table.start_jd) & (jds < table.end_jd)):
+        return table.longitudes_batch(jds)[:, BODY_COLUMNS]
+    from flatlib.ephem import swe
+    return np.array([[swe.sweObjectLon(p, jd) for p in BODIES] for jd in jds.tolist()])
+
+
+_bazi_table = None
+_bazi_table_lock = threading.Lock()
+
+
+def get_bazi_table():
+    """
+    批次排八字用的節氣表：有 BAZI_TABLE_PATH 檔案時與 bazi_engine 共用同一份，
+    否則在第一個統計請求時建一份留在記憶體（約數秒；部署時先 python bazi_fast.py build 即可免除）
+    """
+    global _bazi_table
+    if _bazi_table is None:
+        with _bazi_table_lock:  # 同時到達的請求只建一次
+            if _bazi_table is None:
+                _bazi_table = bazi_fast.get_table() or bazi_fast.BaziTable.build()
+    return _bazi_table
+
+
+def wuxing_features(stamps, lons, unknown, tz_offsets=TZ_OFFSET_HOURS):
+    """
+    真太陽時校正後查表排八字（同 engine 預設），回傳 (五行數量 (N, 5), 日主五行 (N,))
+    時間未知者八字時間取正午，五行不計時柱；中央經線 = UTC 偏移 × 15°
+    """
+    shift = np.round((lons - np.asarray(tz_offsets, dtype=np.float64) * 15.0) * 4.0 * 60.0).astype("timedelta64[s]")
+    noon = stamps.astype("datetime64[D]") + np.timedelta64(12, "h")
+    bazi_time = np.where(unknown, noon, stamps + shift).astype("datetime64[m]")
+    pillars = get_bazi_table().pillar_indices_batch(bazi_time)
+    wuxing = bazi_fast.wuxing_counts_batch(pillars)
+    # 時間未知者扣掉時柱的兩個字
+    time_part = bazi_fast.wuxing_counts_batch(pillars[:, 3:4])
+    wuxing -= time_part * unknown[:, None]
+    day_master = bazi_fast.GAN_WUXING[pillars[:, 2] % 10]
+    return wuxing, day_master
+
+
+def element_stats(timestamps, lats=None, lons=None, time_unknown=None, cohorts=None, tz_offsets=None):
+    """
+    timestamps: 出生時間（當地鐘錶時間，可轉為 datetime64 的陣列；年份須在 YEAR_RANGE 內）
+    lats / lons: 出生地經緯度（省略時同 engine 預設香港）
+    tz_offsets: 出生當時的 UTC 偏移（小時，省略時同 engine 預設 +08:00）
+    time_unknown: 出生時間未知的布林陣列（不計上升、時柱；八字時間取正午）
+    cohorts: 分組標籤（例如註冊月份），省略時全部視為同一組
+    逐筆的陣列須與 timestamps 等長；回傳 {分組: 統計}（沒有資料時為空 dict），八字採真太陽時校正（同 engine 預設）
+    """
+    stamps = np.asarray(timestamps, dtype="datetime64[s]")
+    n = len(stamps)
+    if n == 0:
+        return {}
+    lats = np.full(n, 22.3) if lats is None else np.asarray(lats, dtype=np.float64)
+    lons = np.full(n, 114.2) if lons is None else np.asarray(lons, dtype=np.float64)
+    unknown = np.zeros(n, dtype=bool) if time_unknown is None else np.asarray(time_unknown, dtype=bool)
+    labels = np.zeros(n, dtype=np.int64) if cohorts is None else np.asarray(cohorts)
+    offsets = np.full(n, TZ_OFFSET_HOURS) if tz_offsets is None else np.asarray(tz_offsets, dtype=np.float64)
+
+    # --- 西方：行星星座、四元素與加權分布 ---
+    jds = to_julian_days(stamps, offsets)
+    signs = ephemeris.sign_indices(planet_longitudes(jds))          # (N, 行星數)
+    elements = SIGN_ELEMENT[signs]                                   # (N, 行星數)
+
+    rising = ephemeris.sign_indices(ascendant_longitudes(jds, lats, lons))
+    rising = np.where(unknown, -1, rising)
+
+    # 每人 12 星座的加權分數：攤平成 (人, 星座) 一維索引後用 bincount 累加
+    known = ~unknown
+    rows = np.arange(n)[:, None]
+    flat = np.concatenate([(rows * 12 + signs).ravel(), (rows[known, 0] * 12 + rising[known])])
+    weights = np.concatenate([np.broadcast_to(BODY_WEIGHTS, signs.shape).ravel(),
+                              np.full(int(known.sum()), float(engine.RISING_WEIGHT))])
+    scores = np.bincount(flat, weights=weights, minlength=n * 12).reshape(n, 12)
+    distribution = scores / scores.sum(axis=1, keepdims=True) * 100.0
+
+    # --- 中式：真太陽時校正後查表排八字 ---
+    wuxing, day_master = wuxing_features(stamps, lons, unknown, offsets)
+
+    # --- 依分組彙總 ---
+    result = {}
+    for label in np.unique(labels):
+        mask = labels == label
+        count = int(mask.sum())
+        rising_known = rising[mask & known]
+        wx = wuxing[mask].sum(axis=0)
+        result[str(label)] = {
+            "count": count,
+            "sun_signs": dict(zip(engine.ZODIAC_NAMES, np.bincount(signs[mask, 0], minlength=12).tolist())),
+            "moon_signs": dict(zip(engine.ZODIAC_NAMES, np.bincount(signs[mask, 1], minlength=12).tolist())),
+            "rising_signs": dict(zip(engine.ZODIAC_NAMES, np.bincount(rising_known, minlength=12).tolist())),
+            "western_elements": dict(zip(ELEMENTS, np.bincount(elements[mask].ravel(), minlength=4).tolist())),
+            "distribution": dict(zip(engine.ZODIAC_NAMES, distribution[mask].mean(axis=0).round(1).tolist())),
+            "five_elements": dict(zip(bazi_fast.WUXING, wx.tolist())),
+            "five_elements_percent": dict(zip(bazi_fast.WUXING, (wx / max(wx.sum(), 1) * 100).round(1).tolist())),
+            "day_master_elements": dict(zip(bazi_fast.WUXING, np.bincount(day_master[mask], minlength=5).tolist())),
+        }
+    return result
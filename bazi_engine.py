@@ -1,49 +1,94 @@
 # 檔案名稱: bazi_engine.py
+# 統一的八字計算：一次 EightChar 運算同時得到四柱、五行數量 / 百分比與日主
+import datetime
+import os
+
 from lunar_python import Solar
+from lunar_python.util import LunarUtil
+import bazi_fast
+from chart_cache import cached_chart
+
+# 五行中英對照（engine 的 self_element 沿用英文）
+WUXING_EN = {"金": "Metal", "木": "Wood", "水": "Water", "火": "Fire", "土": "Earth"}
+
+# 排盤時間校正方式：
+#   solar - 真太陽時（依經度相對出生地時區的中央經線修正，每度 4 分鐘；+08:00 為東經 120°）
+#   clock - 直接使用輸入的鐘錶時間
+TIME_POLICIES = ("solar", "clock")
+DEFAULT_TIME_POLICY = os.getenv("BAZI_TIME_POLICY", "solar")
+if DEFAULT_TIME_POLICY not in TIME_POLICIES:
+    # 拼錯時啟動即失敗，不默默改變所有八字的結果
+    raise ValueError(f"BAZI_TIME_POLICY 須為 {' / '.join(TIME_POLICIES)} 之一，收到: {DEFAULT_TIME_POLICY!r}")
 
-def get_bazi_analysis(year, month, day, hour, minute):
+
+def apply_time_policy(year, month, day, hour, minute, lon, is_time_unknown, time_policy, tz_offset=8.0):
     """
-    輸入公曆日期，回傳五行能量百分比與八字文字
+    回傳排盤實際使用的 (年, 月, 日, 時, 分)；時間未知時固定取正午
+    tz_offset 為出生當時的 UTC 偏移（含夏令時間），中央經線 = tz_offset × 15°
+    """
+    if is_time_unknown:
+        return year, month, day, 12, 0
+    if time_policy == "solar":
+        original_dt = datetime.datetime(year, month, day, hour, minute)
+        solar_dt = original_dt + datetime.timedelta(minutes=(lon - tz_offset * 15.0) * 4.0)
+        return solar_dt.year, solar_dt.month, solar_dt.day, solar_dt.hour, solar_dt.minute
+    if time_policy == "clock":
+        return year, month, day, hour, minute
+    raise ValueError(f"未知的時間校正方式: {time_policy}")
+
+
+def format_bazi_text(pillars, is_time_unknown=False):
+    """四柱 → 給 AI 閱讀的文字，例如「庚午年 辛巳月 壬午日 甲辰時」"""
+    text = f"{pillars[0]}年 {pillars[1]}月 {pillars[2]}日"
+    return text + (" 時辰未知" if is_time_unknown else f" {pillars[3]}時")
+
+
+@cached_chart("bazi", defaults={"time_policy": lambda: DEFAULT_TIME_POLICY})
+def compute_bazi(year, month, day, hour=12, minute=0, lon=120.0, is_time_unknown=False, time_policy=None, tz_offset=8.0):
+    """
+    輸入公曆日期，回傳四柱、五行數量 / 百分比與日主
+    時間未知時時柱以正午排出，但不計入五行（只統計 6 個字）
     """
-    # 1. 初始化：將公曆轉為農曆八字物件
-    solar = Solar.fromYmdHms(year, month, day, hour, minute, 0)
-    lunar = solar.getLunar()
-    ba_zi = lunar.getEightChar()
-
-    # 2. 獲取四柱（年、月、日、時）的天干與地支，共 8 個字
-    # 這些物件都有 .getWuXing() 方法，會回傳 "金", "木", "水", "火", "土"
-    chars = [
-        ba_zi.getYearGan(), ba_zi.getYearZhi(),   # 年柱
-        ba_zi.getMonthGan(), ba_zi.getMonthZhi(), # 月柱
-        ba_zi.getDayGan(), ba_zi.getDayZhi(),     # 日柱
-        ba_zi.getTimeGan(), ba_zi.getTimeZhi()    # 時柱
-    ]
-
-    # 3. 開始統計五行數量
+    time_policy = time_policy or DEFAULT_TIME_POLICY
+    y, m, d, h, mi = apply_time_policy(year, month, day, hour, minute, lon, is_time_unknown, time_policy, tz_offset)
+
+    # 1. 公曆 → 八字（年、月柱以立春及節氣交接時刻為準）
+    #    有節氣表時查表，否則由 lunar_python 計算
+    table = bazi_fast.get_table()
+    if table is not None and table.covers(y):
+        pillars = bazi_fast.pillars_from_indices(table.pillar_indices(y, m, d, h, mi))
+    else:
+        ba_zi = Solar.fromYmdHms(y, m, d, h, mi, 0).getLunar().getEightChar()
+        pillars = [ba_zi.getYear(), ba_zi.getMonth(), ba_zi.getDay(), ba_zi.getTime()]
+
+    # 2. 統計五行：天干、地支分別查表
     counts = {"金": 0, "木": 0, "水": 0, "火": 0, "土": 0}
-    
-    for char in chars:
-        wx = char.getWuXing() # 獲取五行屬性
-        if wx in counts:
-            counts[wx] += 1
-
-    # 4. 計算百分比
-    total = sum(counts.values()) # 應該總是 8
-    percentages = {}
-    
-    for k, v in counts.items():
-        if total > 0:
-            # 計算百分比並取整數
-            percentages[k] = round((v / total) * 100)
-        else:
-            percentages[k] = 0
-
-    # 5. 回傳資料結構
+    for pillar in pillars[:3] if is_time_unknown else pillars:
+        counts[LunarUtil.WU_XING_GAN[pillar[0]]] += 1
+        counts[LunarUtil.WU_XING_ZHI[pillar[1]]] += 1
+
+    # 3. 計算百分比（取整數）
+    total = sum(counts.values())
+    percentages = {k: round(v / total * 100) if total else 0 for k, v in counts.items()}
+
+    # 4. 日主
+    day_master = pillars[2][0]
+
     return {
-        "percentages": percentages, # 給前端畫能量條用
-        "bazi_text": f"{ba_zi.getYearGan().getName()}{ba_zi.getYearZhi().getName()}年 "
-                     f"{ba_zi.getMonthGan().getName()}{ba_zi.getMonthZhi().getName()}月 "
-                     f"{ba_zi.getDayGan().getName()}{ba_zi.getDayZhi().getName()}日 "
-                     f"{ba_zi.getTimeGan().getName()}{ba_zi.getTimeZhi().getName()}時" 
-                     # 這行字可以給 AI 看，讓它分析八字
-    }
\ No newline at end of file
+        "pillars": pillars,
+        "bazi_text": format_bazi_text(pillars, is_time_unknown),
+        "counts": counts,
+        "percentages": percentages,  # 給前端畫能量條用
+        "day_master": day_master,
+        "self_element": WUXING_EN[LunarUtil.WU_XING_GAN[day_master]],
+        "time_policy": time_policy,
+    }
+
+
+def get_bazi_analysis(year, month, day, hour, minute, time_policy="clock"):
+    """
+    輸入公曆日期，回傳五行能量百分比與八字文字
+    （舊介面，/test-bazi 使用；預設不做真太陽時校正）
+    """
+    result = compute_bazi(year, month, day, hour, minute, time_policy=time_policy)
+    return {"percentages": result["percentages"], "bazi_text": result["bazi_text"]}
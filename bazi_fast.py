@@ -0,0 +1,241 @@
+# 檔案名稱: bazi_fast.py
+# 查表版八字：預先算好 1900–2100 每個「節」的交接時刻，
+# 排盤時以二分搜尋找出年、月柱，日、時柱用模運算，不必建立 lunar_python 的物件
+#
+#   BAZI_TABLE_PATH  節氣表檔案（預設與本檔同目錄的 bazi_table.npz，不受啟動時的工作目錄影響）
+#
+# 建表：  python bazi_fast.py build（預設寫到 BAZI_TABLE_PATH）
+# 比對：  python bazi_fast.py verify --samples 1000000
+# 效能：  python bazi_fast.py bench
+import bisect
+import datetime
+import os
+
+import numpy as np
+from lunar_python import LunarYear, Solar
+from lunar_python.util import LunarUtil
+
+TABLE_PATH = os.getenv("BAZI_TABLE_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "bazi_table.npz"))
+
+FIRST_YEAR = 1900
+LAST_YEAR = 2100
+
+# 以 1900-01-01 00:00:00（當地鐘錶時間）起算的秒數作為時間軸
+_EPOCH_ORDINAL = datetime.date(FIRST_YEAR, 1, 1).toordinal()
+_EPOCH = np.datetime64(f"{FIRST_YEAR}-01-01T00:00:00", "s")
+
+# 六十甲子與五行靜態表
+JIA_ZI = list(LunarUtil.JIA_ZI)
+GAN = list(LunarUtil.GAN[1:])
+ZHI = list(LunarUtil.ZHI[1:])
+WUXING = ["金", "木", "水", "火", "土"]
+GAN_WUXING = np.array([WUXING.index(LunarUtil.WU_XING_GAN[g]) for g in GAN], dtype=np.int8)
+ZHI_WUXING = np.array([WUXING.index(LunarUtil.WU_XING_ZHI[z]) for z in ZHI], dtype=np.int8)
+
+
+def to_seconds(year, month, day, hour=0, minute=0, second=0):
+    """鐘錶時間 → 時間軸秒數"""
+    days = datetime.date(year, month, day).toordinal() - _EPOCH_ORDINAL
+    return days * 86400 + hour * 3600 + minute * 60 + second
+
+
+class BaziTable:
+    """
+    instants[k]：第 k 個「節」的交接時刻（秒）
+    year_gz[k] / month_gz[k]：該時刻起生效的年柱、月柱（六十甲子序號）
+    """
+
+    def __init__(self, instants, year_gz, month_gz):
+        self.instants = np.asarray(instants, dtype=np.int64)
+        self.year_gz = np.asarray(year_gz, dtype=np.int8)
+        self.month_gz = np.asarray(month_gz, dtype=np.int8)
+        self._instants_list = self.instants.tolist()
+        self._year_list = self.year_gz.tolist()
+        self._month_list = self.month_gz.tolist()
+
+    @classmethod
+    def build(cls, first_year=FIRST_YEAR, last_year=LAST_YEAR):
+        """以 lunar_python 的節氣計算為準建表（離線工作，約數秒）"""
+        jie = {}
+        for lunar_year in range(first_year - 1, last_year + 2):
+            julian_days = LunarYear.fromYear(lunar_year).getJieQiJulianDays()
+            # JIE_QI_IN_USE 偶數位置為「節」（大雪、小寒、立春、驚蟄…），決定月柱交接
+            for jd in julian_days[::2]:
+                solar = Solar.fromJulianDay(jd)
+                key = (solar.getYear(), solar.getMonth(), solar.getDay(),
+                       solar.getHour(), solar.getMinute(), solar.getSecond())
+                jie[to_seconds(*key)] = key
+
+        instants, year_gz, month_gz = [], [], []
+        for seconds in sorted(jie):
+            # 直接以交接當下的 EightChar 取得生效的年、月柱
+            y, m, d, h, mi, s = jie[seconds]
+            ba_zi = Solar.fromYmdHms(y, m, d, h, mi, s).getLunar().getEightChar()
+            instants.append(seconds)
+            year_gz.append(JIA_ZI.index(ba_zi.getYear()))
+            month_gz.append(JIA_ZI.index(ba_zi.getMonth()))
+        return cls(instants, year_gz, month_gz)
+
+    @classmethod
+    def load(cls, path):
+        data = np.load(path)
+        return cls(data["instants"], data["year_gz"], data["month_gz"])
+
+    def save(self, path):
+        np.savez(path, instants=self.instants, year_gz=self.year_gz, month_gz=self.month_gz)
+
+    def covers(self, year):
+        return FIRST_YEAR <= year <= LAST_YEAR
+
+    def _out_of_range(self):
+        # 第一個節之前（k = -1 會繞到最後一列）或最後一個節之後（沒有下一個節界定月柱）都不能查表
+        return ValueError(f"時間超出節氣表範圍（{FIRST_YEAR}–{LAST_YEAR}）")
+
+    def pillar_indices(self, year, month, day, hour, minute, second=0):
+        """回傳 (年, 月, 日, 時) 四柱的六十甲子序號；超出節氣表範圍時拋出 ValueError"""
+        t = to_seconds(year, month, day, hour, minute, second)
+        k = bisect.bisect_right(self._instants_list, t) - 1
+        if not 0 <= k < len(self._instants_list) - 1:
+            raise self._out_of_range()
+
+        # 日柱：以日期計（晚子時仍算當天，同 EightChar 預設流派）
+        jdn = datetime.date(year, month, day).toordinal() + 1721425
+        day_gz = (jdn - 11) % 60
+
+        # 時柱：23 點屬子時，時干以隔天日干起算
+        time_zhi = 0 if hour == 23 else (hour + 1) // 2
+        day_gan_exact = (day_gz + (1 if hour == 23 else 0)) % 10
+        time_gan = (day_gan_exact % 5 * 2 + time_zhi) % 10
+        time_gz = (6 * time_gan - 5 * time_zhi) % 60
+
+        return self._year_list[k], self._month_list[k], day_gz, time_gz
+
+    def pillar_indices_batch(self, timestamps):
+        """
+        向量化版本：timestamps 為 datetime64（當地鐘錶時間）陣列，
+        回傳 (N, 4) 的六十甲子序號；任何一筆超出節氣表範圍時拋出 ValueError
+        """
+        ts = np.asarray(timestamps, dtype="datetime64[s]")
+        t = (ts - _EPOCH).astype(np.int64)
+        k = np.searchsorted(self.instants, t, side="right") - 1
+        if len(k) and (k.min() < 0 or k.max() >= len(self.instants) - 1):
+            raise self._out_of_range()
+
+        days = np.floor_divide(t, 86400)
+        hour = np.floor_divide(t - days * 86400, 3600)
+        day_gz = (days + (_EPOCH_ORDINAL + 1721425 - 11)) % 60
+
+        is_late_zi = hour == 23
+        time_zhi = np.where(is_late_zi, 0, (hour + 1) // 2)
+        day_gan_exact = (day_gz + is_late_zi) % 10
+        time_gan = (day_gan_exact % 5 * 2 + time_zhi) % 10
+        time_gz = (6 * time_gan - 5 * time_zhi) % 60
+
+        return np.stack([self.year_gz[k], self.month_gz[k], day_gz, time_gz], axis=1).astype(np.int64)
+
+
+def pillars_from_indices(indices):
+    """六十甲子序號 → 四柱文字"""
+    return [JIA_ZI[i] for i in indices]
+
+
+def wuxing_counts_batch(indices, with_time=True):
+    """(N, 4) 四柱序號 → (N, 5) 五行數量（順序同 WUXING）；時間未知時不計時柱"""
+    indices = np.asarray(indices)
+    if not with_time:
+        indices = indices[:, :3]
+    n = len(indices)
+    rows = np.arange(n)[:, None] * 5
+    flat = np.concatenate([(rows + GAN_WUXING[indices % 10]).ravel(), (rows + ZHI_WUXING[indices % 12]).ravel()])
+    return np.bincount(flat, minlength=n * 5).reshape(n, 5)
+
+
+_table = None
+
+
+def get_table():
+    """載入 TABLE_PATH 的節氣表；檔案不存在時回傳 None（沿用 lunar_python）"""
+    global _table
+    if _table is None:
+        if not os.path.exists(TABLE_PATH):
+            return None
+        _table = BaziTable.load(TABLE_PATH)
+    return _table
+
+
+def verify(table, samples=1000000, seed=0):
+    """與 lunar_python EightChar 做差分比對，回傳不一致的筆數與前幾個例子"""
+    rng = np.random.default_rng(seed)
+    start = to_seconds(FIRST_YEAR, 1, 1)
+    end = to_seconds(LAST_YEAR, 12, 31, 23, 59, 59)
+    # 依時間排序，讓 lunar_python 的單年快取（LunarYear）發揮作用
+    offsets = np.sort(rng.integers(start, end, samples))
+    stamps = _EPOCH + offsets.astype("timedelta64[s]")
+    fast = table.pillar_indices_batch(stamps)
+
+    mismatches = []
+    for stamp, row in zip(stamps.tolist(), fast.tolist()):
+        ba_zi = Solar.fromYmdHms(stamp.year, stamp.month, stamp.day,
+                                 stamp.hour, stamp.minute, stamp.second).getLunar().getEightChar()
+        expected = [ba_zi.getYear(), ba_zi.getMonth(), ba_zi.getDay(), ba_zi.getTime()]
+        if pillars_from_indices(row) != expected:
+            mismatches.append((stamp.isoformat(), pillars_from_indices(row), expected))
+    return {"samples": samples, "mismatches": len(mismatches), "examples": mismatches[:5]}
+
+
+def bench(table, samples=20000, seed=0):
+    """單筆查表 vs lunar_python 的每次呼叫耗時（微秒；隨機年份，lunar_python 的單年快取多半不命中）"""
+    import time
+    rng = np.random.default_rng(seed)
+    years = rng.integers(1950, 2010, samples)
+    rows = [(int(y), int(rng.integers(1, 13)), int(rng.integers(1, 29)),
+             int(rng.integers(0, 24)), int(rng.integers(0, 60))) for y in years]
+
+    t0 = time.perf_counter()
+    for row in rows:
+        pillars_from_indices(table.pillar_indices(*row))
+    fast = (time.perf_counter() - t0) / samples
+
+    t0 = time.perf_counter()
+    for y, m, d, h, mi in rows:
+        ba_zi = Solar.fromYmdHms(y, m, d, h, mi, 0).getLunar().getEightChar()
+        [ba_zi.getYear(), ba_zi.getMonth(), ba_zi.getDay(), ba_zi.getTime()]
+    slow = (time.perf_counter() - t0) / samples
+
+    stamps = np.array([f"{y:04d}-{m:02d}-{d:02d}T{h:02d}:{mi:02d}" for y, m, d, h, mi in rows], dtype="datetime64[s]")
+    t0 = time.perf_counter()
+    table.pillar_indices_batch(stamps)
+    batch = (time.perf_counter() - t0) / samples
+
+    return {
+        "samples": samples,
+        "table_us": round(fast * 1e6, 2),
+        "table_batch_us": round(batch * 1e6, 3),
+        "lunar_python_us": round(slow * 1e6, 2),
+        "speedup": round(slow / fast, 1),
+    }
+
+
+if __name__ == "__main__":
+    import argparse
+    import json
+
+    parser = argparse.ArgumentParser(description="查表版八字工具")
+    sub = parser.add_subparsers(dest="cmd", required=True)
+    p_build = sub.add_parser("build")
+    p_build.add_argument("--out", default=TABLE_PATH)
+    p_verify = sub.add_parser("verify")
+    p_verify.add_argument("--samples", type=int, default=1000000)
+    p_bench = sub.add_parser("bench")
+    p_bench.add_argument("--samples", type=int, default=20000)
+    args = parser.parse_args()
+
+    if args.cmd == "build":
+        BaziTable.build().save(args.out)
+    elif args.cmd == "verify":
+        report = verify(get_table() or BaziTable.build(), args.samples)
+        print(json.dumps(report, ensure_ascii=False, indent=2))
+        if report["mismatches"]:
+            raise SystemExit("查表結果與 lunar_python 不一致")
+    else:
+        print(json.dumps(bench(get_table() or BaziTable.build(), args.samples), indent=2))
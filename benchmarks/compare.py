@@ -0,0 +1,73 @@
+# 檔案名稱: benchmarks/compare.py
+# 與基準結果比較：延遲類指標（*_ms）變大、吞吐類指標（ops_per_sec、throughput_rps）變小
+# 或錯誤率上升超過門檻時標記為退步，並以非零結束碼結束（可直接放進 CI）
+#
+# 用法：
+#   python -m benchmarks.compare baseline.json current.json --threshold 0.10
+import argparse
+import json
+import sys
+
+# 判斷方向：True 表示數值越小越好
+LOWER_IS_BETTER = {"mean_ms": True, "p50_ms": True, "p95_ms": True, "p99_ms": True,
+                   "ops_per_sec": False, "throughput_rps": False}
+# 極小的數值（例如 0.01 ms）波動比例大，絕對差距低於此值不計退步
+MIN_ABS_DELTA_MS = 0.05
+
+
+def compare(baseline, current, threshold=0.10):
+    """回傳逐項比較結果的 list；regression 為 True 者即為退步"""
+    rows = []
+    for bench, base_stats in baseline["results"].items():
+        cur_stats = current["results"].get(bench)
+        if cur_stats is None:
+            continue
+        for metric, lower_is_better in LOWER_IS_BETTER.items():
+            if metric not in base_stats or metric not in cur_stats:
+                continue
+            base, cur = base_stats[metric], cur_stats[metric]
+            change = (cur - base) / base if base else 0.0
+            worse = change > threshold if lower_is_better else change < -threshold
+            if metric.endswith("_ms") and abs(cur - base) < MIN_ABS_DELTA_MS:
+                worse = False
+            rows.append({"benchmark": bench, "metric": metric, "baseline": base, "current": cur,
+                         "change": round(change, 4), "regression": worse})
+        if "error_rate" in base_stats and "error_rate" in cur_stats:
+            worse = cur_stats["error_rate"] > base_stats["error_rate"] + 0.01
+            rows.append({"benchmark": bench, "metric": "error_rate", "baseline": base_stats["error_rate"],
+                         "current": cur_stats["error_rate"],
+                         "change": round(cur_stats["error_rate"] - base_stats["error_rate"], 4), "regression": worse})
+    return rows
+
+
+def format_report(rows, baseline, current):
+    lines = []
+    base_env, cur_env = baseline.get("environment"), current.get("environment")
+    if base_env and cur_env and base_env != cur_env:
+        lines.append("注意：執行環境不同")
+        for key in sorted(set(base_env) | set(cur_env)):
+            if base_env.get(key) != cur_env.get(key):
+                lines.append(f"  {key}: {base_env.get(key)} -> {cur_env.get(key)}")
+    lines.append(f"{'benchmark':<36}{'metric':<16}{'baseline':>12}{'current':>12}{'change':>10}")
+    for row in rows:
+        flag = "  << 退步" if row["regression"] else ""
+        lines.append(f"{row['benchmark']:<36}{row['metric']:<16}{row['baseline']:>12.6g}{row['current']:>12.6g}"
+                     f"{row['change']:>+10.1%}{flag}")
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="基準結果比較")
+    parser.add_argument("baseline")
+    parser.add_argument("current")
+    parser.add_argument("--threshold", type=float, default=0.10, help="允許的變化比例（預設 10%%）")
+    args = parser.parse_args()
+
+    with open(args.baseline, encoding="utf-8") as f:
+        baseline = json.load(f)
+    with open(args.current, encoding="utf-8") as f:
+        current = json.load(f)
+    rows = compare(baseline, current, args.threshold)
+    print(format_report(rows, baseline, current))
+    if any(row["regression"] for row in rows):
+        sys.exit(1)
@@ -0,0 +1,34 @@
+# 檔案名稱: benchmarks/corpus.py
+# 固定的出生資料語料：同一個 seed 永遠產生同一批資料，前後兩次基準測試才可比較
+import random
+
+# 常見出生地（緯度, 經度）
+CITIES = [
+    (22.3, 114.2),    # 香港
+    (25.03, 121.56),  # 台北
+    (31.23, 121.47),  # 上海
+    (39.9, 116.4),    # 北京
+    (1.35, 103.82),   # 新加坡
+    (35.68, 139.69),  # 東京
+    (43.65, -79.38),  # 多倫多
+    (-33.87, 151.21), # 雪梨
+]
+
+
+def births(n=500, seed=2024, time_unknown_ratio=0.0):
+    """回傳 n 筆 ChartRequest 形式的 dict（1950–2010 年、隨機城市）"""
+    rng = random.Random(seed)
+    records = []
+    for _ in range(n):
+        lat, lon = rng.choice(CITIES)
+        records.append({
+            "year": rng.randint(1950, 2010),
+            "month": rng.randint(1, 12),
+            "day": rng.randint(1, 28),
+            "hour": rng.randint(0, 23),
+            "minute": rng.randint(0, 59),
+            "lat": lat,
+            "lon": lon,
+            "is_time_unknown": rng.random() < time_unknown_ratio,
+        })
+    return records
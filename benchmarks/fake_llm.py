@@ -0,0 +1,114 @@
+# 檔案名稱: benchmarks/fake_llm.py
+# 本機假 LLM 伺服器：相容 OpenAI /chat/completions（含 stream=True 與 usage），
+# 延遲可調，讓負載測試不必呼叫 DeepSeek、不花 token
+#
+# 用法：
+#   python -m benchmarks.fake_llm --port 9100 --latency 0.8 --token-delay 0.005
+#   DEEPSEEK_BASE_URL=http://127.0.0.1:9100 uvicorn main:app --port 8000
+import argparse
+import asyncio
+import json
+import random
+import re
+import time
+import uuid
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+# 可由命令列參數調整
+CONFIG = {
+    "latency": 0.8,        # 第一個 token 前的等待（秒）
+    "jitter": 0.2,         # 延遲的隨機浮動比例
+    "token_delay": 0.005,  # 串流時每個 token 的間隔（秒）
+    "error_rate": 0.0,     # 回傳 500 的機率
+}
+
+app = FastAPI()
+
+
+_MARKER = re.compile(r"<<<\w+>>>")
+
+
+def _reply_tokens(max_tokens, system_prompt=""):
+    """
+    產生約 max_tokens 個 token 的中文回覆（每個字算一個 token）
+    系統提示詞要求 <<<段落>>> 分隔標記（GENERATION_MODE=combined）時，依序輸出各標記並平分 token
+    """
+    total = max(1, min(max_tokens, 8000))
+    markers = list(dict.fromkeys(_MARKER.findall(system_prompt)))
+    if not markers:
+        return ["星"] * total
+    share = max(1, total // len(markers) - 2)
+    tokens = []
+    for marker in markers:
+        tokens += [marker, "\n"] + ["星"] * share
+    return tokens
+
+
+def _usage(messages, completion_tokens):
+    prompt_tokens = sum(len(m.get("content") or "") for m in messages)
+    return {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens}
+
+
+async def _first_token_delay():
+    jitter = CONFIG["latency"] * CONFIG["jitter"]
+    await asyncio.sleep(max(0.0, CONFIG["latency"] + random.uniform(-jitter, jitter)))
+
+
+@app.post("/chat/completions")
+@app.post("/v1/chat/completions")
+async def chat_completions(request: Request):
+    body = await request.json()
+    if random.random() < CONFIG["error_rate"]:
+        return JSONResponse({"error": {"message": "fake upstream error", "type": "server_error"}}, status_code=500)
+
+    messages = body.get("messages", [])
+    system_prompt = next((m.get("content") or "" for m in messages if m.get("role") == "system"), "")
+    tokens = _reply_tokens(body.get("max_tokens") or 256, system_prompt)
+    completion_id = f"chatcmpl-{uuid.uuid4().hex[:12]}"
+    created = int(time.time())
+    model = body.get("model", "fake")
+
+    if not body.get("stream"):
+        await _first_token_delay()
+        await asyncio.sleep(CONFIG["token_delay"] * len(tokens))
+        return {
+            "id": completion_id, "object": "chat.completion", "created": created, "model": model,
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": "".join(tokens)},
+                         "finish_reason": "stop"}],
+            "usage": _usage(messages, len(tokens)),
+        }
+
+    include_usage = (body.get("stream_options") or {}).get("include_usage", False)
+
+    async def events():
+        await _first_token_delay()
+        base = {"id": completion_id, "object": "chat.completion.chunk", "created": created, "model": model}
+        for token in tokens:
+            chunk = {**base, "choices": [{"index": 0, "delta": {"content": token}, "finish_reason": None}]}
+            yield f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n"
+            if CONFIG["token_delay"]:
+                await asyncio.sleep(CONFIG["token_delay"])
+        yield f"data: {json.dumps({**base, 'choices': [{'index': 0, 'delta': {}, 'finish_reason': 'stop'}]})}\n\n"
+        if include_usage:
+            yield f"data: {json.dumps({**base, 'choices': [], 'usage': _usage(messages, len(tokens))})}\n\n"
+        yield "data: [DONE]\n\n"
+
+    return StreamingResponse(events(), media_type="text/event-stream")
+
+
+if __name__ == "__main__":
+    import uvicorn
+
+    parser = argparse.ArgumentParser(description="本機假 LLM 伺服器")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9100)
+    parser.add_argument("--latency", type=float, default=CONFIG["latency"])
+    parser.add_argument("--jitter", type=float, default=CONFIG["jitter"])
+    parser.add_argument("--token-delay", type=float, default=CONFIG["token_delay"])
+    parser.add_argument("--error-rate", type=float, default=CONFIG["error_rate"])
+    args = parser.parse_args()
+    CONFIG.update(latency=args.latency, jitter=args.jitter, token_delay=args.token_delay, error_rate=args.error_rate)
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
@@ -0,0 +1,117 @@
+# 檔案名稱: benchmarks/generation.py
+# 生成模式比較：GENERATION_MODE=sections（三段各自呼叫）與 combined（一次呼叫）
+# 同一份語料各跑一次 /analyze，統計延遲與 LLM 的輸入 / 輸出 token
+# 後端與假 LLM 都在同一個行程內執行（httpx.ASGITransport），不需要另外啟動伺服器
+# ASGITransport 會把回應整個收完才交回，量不到串流的首個事件；串流延遲請用 benchmarks.load --stream
+#
+# 用法：
+#   python -m benchmarks.generation --requests 20 --latency 0.8 --token-delay 0.001 --out bench_generation.json
+import argparse
+import asyncio
+import json
+import os
+import time
+
+import httpx
+
+os.environ.setdefault("DEEPSEEK_API_KEY", "x")
+
+from benchmarks import corpus, fake_llm  # noqa: E402
+from benchmarks.load import _latency_stats  # noqa: E402
+
+
+def _token_totals(metrics):
+    """metrics.llm_tokens 目前的累計值 → {"prompt": n, "completion": n}"""
+    totals = {"prompt": 0, "completion": 0}
+    for (_, kind), value in metrics.llm_tokens._values.items():
+        totals[kind] += value
+    return totals
+
+
+async def _one(client, payload):
+    """送出一個請求，回傳 (是否成功, 耗時)"""
+    start = time.perf_counter()
+    res = await client.post("/analyze", json=payload)
+    ok = res.status_code == 200 and "error" not in res.json()
+    return ok, time.perf_counter() - start
+
+
+async def run_mode(mode, payloads, concurrency=4):
+    import combined
+    import main
+    import metrics
+    from openai import AsyncOpenAI
+
+    combined.MODE = mode
+    main.client = AsyncOpenAI(
+        api_key="x", base_url="http://fake-llm", max_retries=0,
+        http_client=httpx.AsyncClient(transport=httpx.ASGITransport(app=fake_llm.app), base_url="http://fake-llm"),
+    )
+    requests_before = dict(metrics.llm_requests._values)
+    tokens_before = _token_totals(metrics)
+
+    queue = asyncio.Queue()
+    for p in payloads:
+        queue.put_nowait(p)
+    latencies, errors = [], 0
+
+    async def worker(client):
+        nonlocal errors
+        while not queue.empty():
+            ok, elapsed = await _one(client, queue.get_nowait())
+            if ok:
+                latencies.append(elapsed)
+            else:
+                errors += 1
+
+    transport = httpx.ASGITransport(app=main.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=300) as client:
+        start = time.perf_counter()
+        await asyncio.gather(*[worker(client) for _ in range(concurrency)])
+        wall = time.perf_counter() - start
+
+    tokens_after = _token_totals(metrics)
+    calls = sum(v - requests_before.get(k, 0) for k, v in metrics.llm_requests._values.items()
+                if k[1] in ("ok", "error"))
+    n = len(payloads)
+    result = {
+        "requests": n,
+        "errors": errors,
+        "llm_calls_per_request": round(calls / n, 2) if n else 0.0,
+        "prompt_tokens_per_request": round((tokens_after["prompt"] - tokens_before["prompt"]) / n, 1) if n else 0.0,
+        "completion_tokens_per_request":
+            round((tokens_after["completion"] - tokens_before["completion"]) / n, 1) if n else 0.0,
+        "throughput_rps": round(len(latencies) / wall, 2) if wall else 0.0,
+        **_latency_stats(latencies),
+    }
+    return result
+
+
+async def run(total=20, seed=2024, concurrency=4):
+    # regenerate 略過 AI 回覆快取，兩種模式都實際打到假 LLM
+    payloads = [{**r, "regenerate": True} for r in corpus.births(total, seed)]
+    results = {}
+    for mode in ("sections", "combined"):
+        results[mode] = await run_mode(mode, payloads, concurrency)
+    return {"kind": "generation", "corpus": {"n": total, "seed": seed},
+            "config": {"concurrency": concurrency, **fake_llm.CONFIG},
+            "results": results}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="生成模式比較（sections / combined）")
+    parser.add_argument("--requests", type=int, default=20)
+    parser.add_argument("--seed", type=int, default=2024)
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--latency", type=float, default=fake_llm.CONFIG["latency"])
+    parser.add_argument("--token-delay", type=float, default=fake_llm.CONFIG["token_delay"])
+    parser.add_argument("--out", help="結果寫入 JSON 檔")
+    args = parser.parse_args()
+    fake_llm.CONFIG.update(latency=args.latency, token_delay=args.token_delay)
+
+    report = asyncio.run(run(args.requests, args.seed, args.concurrency))
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            f.write(text)
+    print(text)
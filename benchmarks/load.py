@@ -0,0 +1,115 @@
+# 檔案名稱: benchmarks/load.py
+# /analyze 負載測試：以固定並發數持續送出請求，統計延遲分位數、吞吐量與錯誤率
+# 後端請以 DEEPSEEK_BASE_URL 指向 benchmarks.fake_llm，避免消耗真實 token
+#
+# 用法：
+#   python -m benchmarks.load --url http://127.0.0.1:8000 --concurrency 16 --requests 400 --out bench_load.json
+#   python -m benchmarks.load --stream ...   # 改打 /analyze/stream，另外統計首個事件的延遲
+import argparse
+import asyncio
+import json
+import statistics
+import time
+
+import httpx
+
+from benchmarks import corpus
+
+
+def _percentile(ordered, q):
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))] if ordered else 0.0
+
+
+def _latency_stats(samples):
+    ordered = sorted(samples)
+    return {
+        "mean_ms": round(statistics.fmean(ordered) * 1000, 2) if ordered else 0.0,
+        "p50_ms": round(_percentile(ordered, 0.50) * 1000, 2),
+        "p95_ms": round(_percentile(ordered, 0.95) * 1000, 2),
+        "p99_ms": round(_percentile(ordered, 0.99) * 1000, 2),
+        "max_ms": round(ordered[-1] * 1000, 2) if ordered else 0.0,
+    }
+
+
+async def _one(client, url, payload, stream):
+    """送出一個請求，回傳 (是否成功, 總耗時, 首個事件耗時)"""
+    start = time.perf_counter()
+    if not stream:
+        res = await client.post(f"{url}/analyze", json=payload)
+        ok = res.status_code == 200 and "error" not in res.json()
+        return ok, time.perf_counter() - start, None
+    first = None
+    ok = False
+    async with client.stream("POST", f"{url}/analyze/stream", json=payload) as res:
+        async for line in res.aiter_lines():
+            if first is None and line.startswith("event:"):
+                first = time.perf_counter() - start
+            if line == "event: done":
+                ok = res.status_code == 200
+    return ok, time.perf_counter() - start, first
+
+
+async def run(url, concurrency=8, total=200, seed=2024, stream=False, regenerate=True, timeout=120.0):
+    """
+    regenerate=True 時略過 AI 回覆快取，每個請求都會打到（假）LLM
+    語料筆數等於請求數，星盤快取也不會命中
+    """
+    payloads = [{**r, "regenerate": regenerate} for r in corpus.births(total, seed)]
+    queue = asyncio.Queue()
+    for p in payloads:
+        queue.put_nowait(p)
+
+    latencies, first_events, errors = [], [], 0
+
+    async def worker(client):
+        nonlocal errors
+        while not queue.empty():
+            payload = queue.get_nowait()
+            try:
+                ok, elapsed, first = await _one(client, url, payload, stream)
+            except httpx.HTTPError:
+                ok, elapsed, first = False, 0.0, None
+            if ok:
+                latencies.append(elapsed)
+                if first is not None:
+                    first_events.append(first)
+            else:
+                errors += 1
+
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(timeout=timeout, limits=limits) as client:
+        start = time.perf_counter()
+        await asyncio.gather(*[worker(client) for _ in range(concurrency)])
+        wall = time.perf_counter() - start
+
+    results = {"analyze": {
+        "requests": total,
+        "errors": errors,
+        "error_rate": round(errors / total, 4) if total else 0.0,
+        "throughput_rps": round(len(latencies) / wall, 2) if wall else 0.0,
+        **_latency_stats(latencies),
+    }}
+    if stream:
+        results["analyze_first_event"] = _latency_stats(first_events)
+    return {"kind": "load", "corpus": {"n": total, "seed": seed},
+            "config": {"url": url, "concurrency": concurrency, "stream": stream, "regenerate": regenerate},
+            "results": results}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="/analyze 負載測試")
+    parser.add_argument("--url", default="http://127.0.0.1:8000")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--seed", type=int, default=2024)
+    parser.add_argument("--stream", action="store_true", help="改打 /analyze/stream")
+    parser.add_argument("--use-cache", action="store_true", help="允許 AI 回覆快取命中")
+    parser.add_argument("--out", help="結果寫入 JSON 檔")
+    args = parser.parse_args()
+
+    report = asyncio.run(run(args.url, args.concurrency, args.requests, args.seed, args.stream, not args.use_cache))
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            f.write(text)
+    print(text)
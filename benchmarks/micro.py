@@ -0,0 +1,100 @@
+# 檔案名稱: benchmarks/micro.py
+# 計算引擎微基準：engine.calculate_positions（時間已知 / 未知）與 bazi_engine.get_bazi_analysis
+# 預設關閉星盤快取，量測的是實際計算成本
+#
+# 用法（在專案根目錄）：
+#   python -m benchmarks.micro --out bench_micro.json
+#   python -m benchmarks.compare baseline.json bench_micro.json
+import argparse
+import json
+import platform
+import statistics
+import time
+from importlib import metadata
+
+import bazi_engine
+import bazi_fast
+import chart_cache
+import engine
+import ephemeris
+from benchmarks import corpus
+
+
+def _summarize(samples):
+    """每次呼叫耗時（秒）→ 統計值（毫秒）"""
+    ordered = sorted(samples)
+    pick = lambda q: ordered[min(len(ordered) - 1, int(q * len(ordered)))] * 1000
+    return {
+        "calls": len(samples),
+        "mean_ms": round(statistics.fmean(samples) * 1000, 4),
+        "p50_ms": round(pick(0.50), 4),
+        "p95_ms": round(pick(0.95), 4),
+        "p99_ms": round(pick(0.99), 4),
+        "ops_per_sec": round(len(samples) / sum(samples), 1),
+    }
+
+
+def _time_calls(func, arg_list, repeat):
+    samples = []
+    for _ in range(repeat):
+        for args in arg_list:
+            start = time.perf_counter()
+            func(**args)
+            samples.append(time.perf_counter() - start)
+    return samples
+
+
+def environment():
+    """記錄版本與啟用中的加速表，比較結果時一併參考"""
+    versions = {}
+    for name in ("flatlib", "lunar_python", "pyswisseph", "numpy"):
+        try:
+            versions[name] = metadata.version(name)
+        except metadata.PackageNotFoundError:
+            versions[name] = None
+    return {
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "packages": versions,
+        "ephemeris_table": ephemeris.get_table() is not None,
+        "bazi_table": bazi_fast.get_table() is not None,
+        "chart_cache": chart_cache.cache.enabled,
+    }
+
+
+def run(n=300, repeat=3, seed=2024, cached=False):
+    if not cached:
+        chart_cache.cache.maxsize = 0
+    records = corpus.births(n, seed)
+    chart_args = [{k: r[k] for k in ("year", "month", "day", "hour", "minute", "lat", "lon")} for r in records]
+    bazi_args = [{k: r[k] for k in ("year", "month", "day", "hour", "minute")} for r in records]
+
+    # 預熱：載入星曆檔與 lunar_python 的表格，不計入結果
+    engine.calculate_positions(**chart_args[0])
+    bazi_engine.get_bazi_analysis(**bazi_args[0])
+
+    results = {
+        "calculate_positions": _summarize(_time_calls(engine.calculate_positions, chart_args, repeat)),
+        "calculate_positions_time_unknown": _summarize(_time_calls(
+            engine.calculate_positions, [{**a, "is_time_unknown": True} for a in chart_args], repeat)),
+        "get_bazi_analysis": _summarize(_time_calls(bazi_engine.get_bazi_analysis, bazi_args, repeat)),
+    }
+    return {"kind": "micro", "corpus": {"n": n, "seed": seed, "repeat": repeat},
+            "environment": environment(), "results": results}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="計算引擎微基準")
+    parser.add_argument("--n", type=int, default=300, help="語料筆數")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=2024)
+    parser.add_argument("--cached", action="store_true", help="保留星盤快取（量測快取命中路徑）")
+    parser.add_argument("--out", help="結果寫入 JSON 檔")
+    args = parser.parse_args()
+
+    report = run(args.n, args.repeat, args.seed, args.cached)
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            f.write(text)
+    print(text)
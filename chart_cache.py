@@ -0,0 +1,173 @@
+# 檔案名稱: chart_cache.py
+# 星盤 / 八字計算結果快取：記憶體 LRU + TTL，可選 SQLite 磁碟層（重啟後仍保留）
+import functools
+import inspect
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+# 經緯度取到小數點後 2 位（約 1 公里），同一城市的請求會共用快取
+COORD_PRECISION = 2
+
+# 計算結果的版本：engine / bazi_engine 的輸出有變（演算法、欄位、查表資料）時加一，
+# 舊版本的快取（含 SQLite 磁碟層）自然不再命中，部署後不會繼續送出舊的星盤
+VERSION = 2
+
+
+class ChartCache:
+    """
+    以正規化後的出生資料為鍵的快取
+    值以 JSON 字串保存，每次讀取都會得到新的 dict，呼叫端可以放心修改
+    """
+
+    def __init__(self, maxsize=4096, ttl=86400, db_path=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()  # key -> (寫入時間, JSON 字串)
+        self._lock = threading.Lock()
+        self._db = None
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        if db_path:
+            self._db = sqlite3.connect(db_path, check_same_thread=False)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS charts (key TEXT PRIMARY KEY, value TEXT NOT NULL, created REAL NOT NULL)"
+            )
+            self._db.commit()
+
+    @classmethod
+    def from_env(cls):
+        """由環境變數建立：CHART_CACHE_SIZE（0 為關閉）、CHART_CACHE_TTL（秒）、CHART_CACHE_DB（SQLite 路徑）"""
+        return cls(
+            maxsize=int(os.getenv("CHART_CACHE_SIZE", "4096")),
+            ttl=float(os.getenv("CHART_CACHE_TTL", "86400")),
+            db_path=os.getenv("CHART_CACHE_DB") or None,
+        )
+
+    @property
+    def enabled(self):
+        return self.maxsize > 0
+
+    def _expired(self, created):
+        return self.ttl > 0 and time.time() - created > self.ttl
+
+    def get(self, key):
+        """命中時回傳新的 dict，否則回傳 None"""
+        with self._lock:
+            item = self._data.get(key)
+            if item is not None:
+                created, raw = item
+                if not self._expired(created):
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return json.loads(raw)
+                del self._data[key]
+
+            if self._db is not None:
+                row = self._db.execute("SELECT value, created FROM charts WHERE key = ?", (key,)).fetchone()
+                if row is not None and not self._expired(row[1]):
+                    self._put_memory(key, row[0], row[1])
+                    self.disk_hits += 1
+                    return json.loads(row[0])
+
+            self.misses += 1
+            return None
+
+    def set(self, key, value):
+        raw = json.dumps(value, ensure_ascii=False)
+        created = time.time()
+        with self._lock:
+            self._put_memory(key, raw, created)
+            if self._db is not None:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO charts (key, value, created) VALUES (?, ?, ?)", (key, raw, created)
+                )
+                self._db.commit()
+
+    def _put_memory(self, key, raw, created):
+        self._data[key] = (created, raw)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            if self._db is not None:
+                self._db.execute("DELETE FROM charts")
+                self._db.commit()
+
+    def stats(self):
+        lookups = self.hits + self.disk_hits + self.misses
+        return {
+            "size": len(self._data),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_ratio": round((self.hits + self.disk_hits) / lookups, 4) if lookups else 0.0,
+            "disk": self._db is not None,
+        }
+
+
+cache = ChartCache.from_env()
+
+
+def normalize(params):
+    """正規化出生資料（經緯度四捨五入），回傳新的 dict"""
+    normalized = dict(params)
+    for name in ("lat", "lon"):
+        if normalized.get(name) is not None:
+            normalized[name] = round(float(normalized[name]), COORD_PRECISION)
+    return normalized
+
+
+def make_key(namespace, **params):
+    """把出生資料正規化成快取鍵（含結果版本）"""
+    return f"v{VERSION}:{namespace}:" + json.dumps(normalize(params), sort_keys=True)
+
+
+def cached_chart(namespace, defaults=None):
+    """
+    裝飾器：以函式參數（套用預設值並正規化）為鍵快取回傳值
+    經緯度會先四捨五入再傳入原函式，確保同一個鍵永遠對應同一個結果
+    defaults：{參數名稱: 無參數函式}，參數為 None 時改用函式的回傳值（例如由環境變數決定的八字時間校正），
+    實際採用的值因此進入快取鍵，改了設定後不會命中舊設定算出的結果
+    """
+    defaults = defaults or {}
+
+    def decorator(func):
+        sig = inspect.signature(func)
+
+        def cache_key(*args, **kwargs):
+            """回傳 (快取鍵, 正規化後的參數)"""
+            bound = sig.bind(*args, **kwargs)
+            bound.apply_defaults()
+            for name, resolve in defaults.items():
+                if bound.arguments.get(name) is None:
+                    bound.arguments[name] = resolve()
+            params = normalize(bound.arguments)
+            return make_key(namespace, **params), params
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not cache.enabled:
+                return func(*args, **kwargs)
+            key, params = cache_key(*args, **kwargs)
+            result = cache.get(key)
+            if result is None:
+                result = func(**params)
+                cache.set(key, result)
+                # 回傳與快取內容分離的副本
+                result = json.loads(json.dumps(result, ensure_ascii=False))
+            return result
+
+        wrapper.uncached = func
+        wrapper.cache_key = cache_key
+        return wrapper
+    return decorator
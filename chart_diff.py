@@ -0,0 +1,51 @@
+# 檔案名稱: chart_diff.py
+# 兩次請求之間的差異：哪些輸入變了、星盤哪些欄位變了、哪些 AI 段落需要重新生成
+#
+# 使用者常先以 is_time_unknown=True 送出、之後補上出生時間，或只改城市。
+# 星盤的三個部分各自只依賴部分輸入（DEPENDENCIES），由各自的快取重用未受影響的部分：
+#   planets（engine.western_planets，獨立快取）、houses（engine.western_houses）、bazi（bazi_engine.compute_bazi，獨立快取）
+# AI 段落各自只讀取摘要中的一部分（見 main._build_summaries），摘要沒變的段落會直接命中 llm_cache，不再呼叫 LLM
+#
+# 查詢：POST /charts/diff  {"before": {...}, "after": {...}}
+
+# 星盤各部分依賴的輸入欄位
+# 改城市時若時區不同（tz_offset 改變），行星也要重算
+DEPENDENCIES = {
+    "planets": ("year", "month", "day", "hour", "minute", "tz_offset"),
+    "houses": ("year", "month", "day", "hour", "minute", "lat", "lon", "is_time_unknown", "tz_offset"),
+    "bazi": ("year", "month", "day", "hour", "minute", "lon", "is_time_unknown", "bazi_time_policy", "tz_offset"),
+}
+
+
+def changed_inputs(before, after):
+    """兩組出生資料（已正規化的 dict）中值不同的欄位"""
+    return sorted(k for k in set(before) | set(after) if before.get(k) != after.get(k))
+
+
+def affected_parts(changed):
+    """受輸入變動影響、需要重新計算的星盤部分"""
+    changed = set(changed)
+    return [part for part, inputs in DEPENDENCIES.items() if changed.intersection(inputs)]
+
+
+def diff(before, after, path=""):
+    """
+    比較兩張星盤，回傳值不同的欄位路徑（例如 "western.planets.moon.deg"、"chinese.bazi_text.3"）
+    dict 逐鍵比較；等長的 list 逐項比較，長度不同時整個 list 視為變動
+    """
+    if isinstance(before, dict) and isinstance(after, dict):
+        changed = []
+        for key in list(before) + [k for k in after if k not in before]:
+            changed += diff(before.get(key), after.get(key), f"{path}.{key}" if path else str(key))
+        return changed
+    if isinstance(before, list) and isinstance(after, list) and len(before) == len(after):
+        changed = []
+        for i, (a, b) in enumerate(zip(before, after)):
+            changed += diff(a, b, f"{path}.{i}" if path else str(i))
+        return changed
+    return [] if before == after else [path]
+
+
+def changed_sections(before, after):
+    """各段落摘要（{段落: 摘要}）有變動的段落；只有這些段落需要重新生成"""
+    return [name for name in after if before.get(name) != after[name]]
@@ -0,0 +1,110 @@
+# 檔案名稱: combined.py
+# 合併生成模式（GENERATION_MODE=combined）：三個 AI 段落改為一次 LLM 呼叫
+# 三個系統提示詞的風格規則大多重複，分開呼叫時星盤摘要與規則的輸入 token 要付三次；
+# 合併後共用規則只送一次，輸出以 <<<段落名稱>>> 分隔，由這裡拆回各欄位
+# 輸出格式不對（缺段落、段落為空）時，缺的段落由呼叫端退回逐段生成
+#
+#   GENERATION_MODE   sections（預設，每段各自呼叫、同時進行）| combined（一次呼叫）
+import os
+import re
+
+import prompts
+
+MODE = os.getenv("GENERATION_MODE", "sections").lower()
+
+# 合併呼叫的 temperature（三段原本為 1.0 / 1.3 / 1.2）
+TEMPERATURE = 1.2
+
+_MARKER = re.compile(r"<<<(\w+)>>>")
+# 未收到結尾 >>> 的標記最多等待的字數（超過就當成一般文字）
+_MAX_MARKER_LEN = 40
+
+
+def marker(name):
+    return f"<<<{name}>>>"
+
+
+def build_prompt(names):
+    """只包含本次需要的段落：共用規則 + 各段任務 + 輸出格式"""
+    return "".join([
+        prompts.COMBINED_RULES_PROMPT,
+        *(prompts.COMBINED_SECTION_PROMPTS[name] for name in names),
+        prompts.COMBINED_FORMAT_PROMPT.format(markers="\n    ".join(marker(name) for name in names)),
+    ])
+
+
+def split(text, names):
+    """
+    拆回各段落：回傳 {段落: 內容}，只包含格式正確且內容非空的段落
+    標記之前的文字（模型自行加的前言）與不認得的標記一律忽略
+    """
+    wanted = set(names)
+    sections = {}
+    matches = [m for m in _MARKER.finditer(text) if m.group(1) in wanted]
+    for i, m in enumerate(matches):
+        end = matches[i + 1].start() if i + 1 < len(matches) else len(text)
+        content = text[m.end():end].strip()
+        if content and m.group(1) not in sections:
+            sections[m.group(1)] = content
+    return sections
+
+
+class StreamSplitter:
+    """
+    串流版 split：逐段餵入 delta，回傳 [(段落, 文字)]（文字為 None 代表該段落開始）
+    標記可能被切在兩個 delta 之間，尚未確定的尾端會先保留
+    """
+
+    def __init__(self, names):
+        self.wanted = set(names)
+        self.current = None
+        self.started = []
+        self._buffer = ""
+        self._leading = False  # 標記之後的換行不輸出
+
+    def _emit(self, out, text):
+        if self._leading:
+            text = text.lstrip("\r\n")
+            self._leading = not text
+        if text and self.current is not None:
+            out.append((self.current, text))
+
+    def feed(self, delta):
+        out = []
+        self._buffer += delta
+        while self._buffer:
+            start = self._buffer.find("<<<")
+            if start < 0:
+                # 尾端的 "<" 或 "<<" 可能是下一個標記的開頭，先留著
+                keep = len(self._buffer) - len(self._buffer.rstrip("<"))
+                keep = min(keep, 2)
+                self._emit(out, self._buffer[:len(self._buffer) - keep])
+                self._buffer = self._buffer[len(self._buffer) - keep:]
+                break
+            end = self._buffer.find(">>>", start + 3)
+            if end < 0:
+                if len(self._buffer) - start > _MAX_MARKER_LEN:
+                    # 太長，不是標記
+                    self._emit(out, self._buffer[:start + 3])
+                    self._buffer = self._buffer[start + 3:]
+                    continue
+                self._emit(out, self._buffer[:start])
+                self._buffer = self._buffer[start:]
+                break
+            name = self._buffer[start + 3:end]
+            if name in self.wanted and name not in self.started:
+                self._emit(out, self._buffer[:start])
+                self.current = name
+                self.started.append(name)
+                self._leading = True
+                out.append((name, None))
+            else:
+                self._emit(out, self._buffer[:end + 3])
+            self._buffer = self._buffer[end + 3:]
+        return out
+
+    def flush(self):
+        out = []
+        self._emit(out, self._buffer)
+        self._buffer = ""
+        return out
@@ -0,0 +1,91 @@
+# 檔案名稱: compact.py
+# 回應編碼：orjson 序列化（未安裝時退回標準 json），以及精簡版星盤（compat=false 時使用）
+#
+# 精簡版星盤以序號取代星座名稱，欄位順序見 GET /schema/compact：
+#   {
+#     "v": 1,
+#     "planets": [[星座序號, 度數] 或 null, ...],   # 順序同 planets
+#     "elements": [Fire, Earth, Air, Water],
+#     "rising": 星座序號（時間未知為 -1）,
+#     "distribution": [[星座序號, 百分比], ...],
+#     "houses": [第1宮星座序號, ..., 第12宮星座序號],
+#     "bazi": ["年柱", "月柱", "日柱", "時柱"],
+#     "day_master": "壬",
+#     "self_element": "Water",
+#     "five_elements": [金, 木, 水, 火, 土]
+#   }
+import json
+
+from starlette.responses import JSONResponse
+
+try:
+    import orjson
+except ImportError:  # orjson 為選用相依
+    orjson = None
+
+COMPACT_VERSION = 1
+ELEMENTS = ["Fire", "Earth", "Air", "Water"]
+WUXING = ["金", "木", "水", "火", "土"]
+
+
+class FastJSONResponse(JSONResponse):
+    """以 orjson 序列化（比標準 json 快數倍，且直接輸出 UTF-8 不跳脫中文）"""
+
+    def render(self, content):
+        if orjson is not None:
+            return orjson.dumps(content, option=orjson.OPT_NON_STR_KEYS)
+        return json.dumps(content, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+def schema():
+    """精簡版星盤的序號對照表"""
+    import engine
+    return {
+        "v": COMPACT_VERSION,
+        "signs": engine.ZODIAC_NAMES,
+        "planets": [p.lower() for p in engine.PLANETS_LIST],
+        "elements": ELEMENTS,
+        "five_elements": WUXING,
+    }
+
+
+def compact_chart(chart):
+    """完整星盤 → 精簡版（純資料轉換，不重新計算）"""
+    import engine
+    sign_index = {name: i for i, name in enumerate(engine.ZODIAC_NAMES)}
+    western = chart["western"]
+    chinese = chart["chinese"]
+    planets = []
+    for p in engine.PLANETS_LIST:
+        info = western["planets"].get(p.lower())
+        planets.append([sign_index[info["sign"]], info["deg"]] if info else None)
+    return {
+        "v": COMPACT_VERSION,
+        "planets": planets,
+        "elements": [western["elements"].get(e, 0) for e in ELEMENTS],
+        "rising": sign_index.get(western["rising"], -1),
+        "distribution": [[sign_index[d["sign"]], d["percent"]] for d in western["distribution"]],
+        "houses": [sign_index[h["sign"]] for h in western["houses"]],
+        "bazi": chinese["bazi_text"],
+        "day_master": chinese["day_master"],
+        "self_element": chinese["self_element"],
+        "five_elements": [chinese["five_elements"].get(w, 0) for w in WUXING],
+    }
+
+
+def shape_response(data, compat=True, fields=None):
+    """
+    依查詢參數調整 /analyze 類回應：
+      compat=False  拿掉重複的 ai_report，chart 改為精簡版
+      fields        只保留指定的頂層欄位（逗號分隔，例如 "chart,deep_analysis"）
+    """
+    if not compat:
+        data.pop("ai_report", None)
+        if isinstance(data.get("chart"), dict):
+            data["chart"] = compact_chart(data["chart"])
+    if fields:
+        wanted = {f.strip() for f in fields.split(",") if f.strip()}
+        # 錯誤與降級資訊一律保留
+        wanted |= {"error", "traceback", "degraded"}
+        data = {k: v for k, v in data.items() if k in wanted}
+    return data
@@ -0,0 +1,333 @@
+# 檔案名稱: compatibility.py
+# 合盤配對：大量候選人的本命資料以緊湊的 NumPy 矩陣常駐記憶體，
+# 一張查詢星盤對 N 位候選人一次向量化算出：
+#   - 跨盤相位（查詢者 7 星 × 候選人 7 星 × 5 種相位，依容許度給強度）
+#   - 西洋四元素互補（同元素、火風 / 土水互補）
+#   - 五行互補（補足對方缺少的五行）與日主生剋
+# 每位候選人約 65 位元組（7 個黃經 + 4 + 5 個比例，float32；日主 int8），10 萬人約 6.5 MB
+#
+#   COMPATIBILITY_STORE_PATH  候選人資料檔（.npz，選用；設定後啟動時載入、每次新增後寫回）
+#
+# 效能測試：  python compatibility.py bench --candidates 100000
+import os
+import threading
+
+import numpy as np
+
+import analytics
+import bazi_fast
+import ephemeris
+import logs
+
+logger = logs.get_logger("compatibility")
+
+BODIES = analytics.BODIES  # 與 engine 相同的 7 顆行星
+BODY_NAMES = [b.lower() for b in BODIES]
+MOON = BODIES.index("Moon")
+
+# 相位：(名稱, 角度, 容許度, 分數權重)；刑、沖為負分
+ASPECTS = [
+    ("conjunction", 0.0, 6.0, 1.0),
+    ("sextile", 60.0, 4.0, 0.6),
+    ("square", 90.0, 5.0, -0.6),
+    ("trine", 120.0, 5.0, 0.8),
+    ("opposition", 180.0, 6.0, -0.3),
+]
+
+# 行星配對權重：兩顆行星的 engine 權重幾何平均（日月 1.0），日月互映與金火互映加倍
+_w = np.sqrt([analytics.engine.PLANET_WEIGHTS[b] for b in BODIES]) / np.sqrt(30.0)
+PAIR_WEIGHTS = np.outer(_w, _w)
+for a, b in (("Sun", "Moon"), ("Venus", "Mars")):
+    i, j = BODIES.index(a), BODIES.index(b)
+    PAIR_WEIGHTS[i, j] *= 2
+    PAIR_WEIGHTS[j, i] *= 2
+# 每種相位在 (7×7) 攤平後的權重向量：強度矩陣 (N, 49) 與它做一次矩陣乘法即為該相位的分數
+_ASPECT_VECTORS = [(angle, orb, (PAIR_WEIGHTS * weight).ravel().astype(np.float32))
+                   for _, angle, orb, weight in ASPECTS]
+
+# 四元素（Fire, Earth, Air, Water）相容矩陣：同元素 1，火風、土水互補 0.8
+ELEMENT_MATRIX = np.array([
+    [1.0, 0.0, 0.8, 0.0],
+    [0.0, 1.0, 0.0, 0.8],
+    [0.8, 0.0, 1.0, 0.0],
+    [0.0, 0.8, 0.0, 1.0],
+], dtype=np.float32)
+
+# 五行（金木水火土）日主關係：同類 0.5，相生（任一方向）1，相剋（任一方向）-0.5
+_GENERATES = {"金": "水", "水": "木", "木": "火", "火": "土", "土": "金"}
+_CONTROLS = {"金": "木", "木": "土", "土": "水", "水": "火", "火": "金"}
+DAY_MASTER_MATRIX = np.zeros((5, 5), dtype=np.float32)
+for _i, _a in enumerate(bazi_fast.WUXING):
+    for _j, _b in enumerate(bazi_fast.WUXING):
+        if _a == _b:
+            DAY_MASTER_MATRIX[_i, _j] = 0.5
+        elif _GENERATES[_a] == _b or _GENERATES[_b] == _a:
+            DAY_MASTER_MATRIX[_i, _j] = 1.0
+        elif _CONTROLS[_a] == _b or _CONTROLS[_b] == _a:
+            DAY_MASTER_MATRIX[_i, _j] = -0.5
+# 某一行占比低於平均（20%）的部分視為「缺」，由對方的占比補足
+WUXING_EVEN_SHARE = 0.2
+
+# 總分 = 相位 + 2 × 四元素 + 2 × 五行
+ELEMENT_WEIGHT = 2.0
+WUXING_WEIGHT = 2.0
+
+# 分塊計算相位，讓每塊的暫存陣列留在 CPU 快取內
+CHUNK_ROWS = 2048
+
+
+def chart_features(timestamps, lats, lons, time_unknown, tz_offsets=analytics.TZ_OFFSET_HOURS):
+    """
+    出生資料（陣列）→ 配對用特徵：
+    (黃經 (N, 7) float32，時間未知者月亮為 NaN；四元素比例 (N, 4)；五行比例 (N, 5)；日主五行 (N,))
+    """
+    stamps = np.asarray(timestamps, dtype="datetime64[s]")
+    lats = np.asarray(lats, dtype=np.float64)
+    lons = np.asarray(lons, dtype=np.float64)
+    unknown = np.asarray(time_unknown, dtype=bool)
+    tz_offsets = np.asarray(tz_offsets, dtype=np.float64)
+
+    planet_lons = analytics.planet_longitudes(analytics.to_julian_days(stamps, tz_offsets))
+    elements = analytics.SIGN_ELEMENT[ephemeris.sign_indices(planet_lons)]
+    element_share = np.stack([(elements == k).sum(axis=1) for k in range(4)], axis=1) / len(BODIES)
+    planet_lons = planet_lons.astype(np.float32)
+    # 時間未知時月亮位置誤差可達 ±7°，不參與相位計算（NaN 與任何角度比較都不成立）
+    planet_lons[unknown, MOON] = np.nan
+
+    wuxing, day_master = analytics.wuxing_features(stamps, lons, unknown, tz_offsets)
+    wuxing_share = wuxing / np.maximum(wuxing.sum(axis=1, keepdims=True), 1)
+    return (planet_lons, element_share.astype(np.float32), wuxing_share.astype(np.float32),
+            day_master.astype(np.int8))
+
+
+def records_to_arrays(records):
+    """[{year, month, day, hour, minute, lat, lon, is_time_unknown, tz_offset}, ...] → chart_features 的輸入"""
+    stamps = np.array([f"{r['year']:04d}-{r['month']:02d}-{r['day']:02d}T{r.get('hour', 12):02d}:{r.get('minute', 0):02d}"
+                       for r in records], dtype="datetime64[s]")
+    lats = [r.get("lat", 22.3) for r in records]
+    lons = [r.get("lon", 114.2) for r in records]
+    unknown = [r.get("is_time_unknown", False) for r in records]
+    tz_offsets = [analytics.TZ_OFFSET_HOURS if r.get("tz_offset") is None else r["tz_offset"] for r in records]
+    return stamps, lats, lons, unknown, tz_offsets
+
+
+def aspect_scores(query_lons, candidate_lons):
+    """查詢者黃經 (7,) × 候選人黃經 (N, 7) → 相位分數 (N,)"""
+    n = len(candidate_lons)
+    scores = np.zeros(n, dtype=np.float32)
+    q = query_lons.astype(np.float32)[:, None]  # (7, 1)，與候選人的 (1, 7) 廣播成 (7, 7)
+    for start in range(0, n, CHUNK_ROWS):
+        chunk = candidate_lons[start:start + CHUNK_ROWS]
+        # 兩盤任意兩顆行星的夾角（0–180°），攤平成 (塊大小, 49)；全部原地運算，不另配置暫存陣列
+        # （以 min(x, 360 - x) 折回 0–180°，比取餘數快得多）
+        sep = q[None, :, :] - chunk[:, None, :]
+        np.abs(sep, out=sep)
+        np.minimum(sep, 360.0 - sep, out=sep)
+        sep = sep.reshape(len(chunk), -1)
+        strength = np.empty_like(sep)
+        for angle, orb, vector in _ASPECT_VECTORS:
+            # 強度：正好成相位為 1，到容許度邊緣降為 0；fmax 會把 NaN（月亮未知）當成 0
+            np.subtract(sep, angle, out=strength)
+            np.abs(strength, out=strength)
+            strength *= -1.0 / orb
+            strength += 1.0
+            np.fmax(strength, 0.0, out=strength)
+            scores[start:start + len(chunk)] += strength @ vector
+    return scores
+
+
+def element_scores(query_share, candidate_shares):
+    return candidate_shares @ (ELEMENT_MATRIX @ query_share)
+
+
+def wuxing_scores(query_share, query_day_master, candidate_shares, candidate_day_masters):
+    """雙方互補（各自缺的由對方補）+ 日主生剋"""
+    query_lack = np.maximum(WUXING_EVEN_SHARE - query_share, 0.0)
+    candidate_lack = np.maximum(WUXING_EVEN_SHARE - candidate_shares, 0.0)
+    complement = candidate_shares @ query_lack + candidate_lack @ query_share
+    return complement * 5.0 + DAY_MASTER_MATRIX[query_day_master][candidate_day_masters]
+
+
+def aspect_details(query_lons, candidate_lons, limit=3):
+    """單一候選人：依分數貢獻（絕對值）排序的前幾個相位（只對 top-k 計算）"""
+    sep = np.abs((query_lons[:, None] - candidate_lons[None, :] + 180.0) % 360.0 - 180.0)
+    found = []
+    for name, angle, orb, weight in ASPECTS:
+        dev = np.abs(sep - angle)
+        for i, j in zip(*np.nonzero(dev <= orb)):
+            contribution = float((1 - dev[i, j] / orb) * weight * PAIR_WEIGHTS[i, j])
+            found.append((abs(contribution), {"a": BODY_NAMES[i], "b": BODY_NAMES[j], "aspect": name,
+                                              "orb": round(float(dev[i, j]), 2)}))
+    found.sort(key=lambda x: -x[0])
+    return [detail for _, detail in found[:limit]]
+
+
+class CandidateStore:
+    def __init__(self, path=None):
+        self.path = path
+        self._lock = threading.Lock()  # 只擋寫入；查詢讀取的是不可變的快照
+        self._snapshot = self._empty()
+        if path and os.path.exists(path):
+            self._load(path)
+
+    @classmethod
+    def from_env(cls):
+        return cls(os.getenv("COMPATIBILITY_STORE_PATH") or None)
+
+    @staticmethod
+    def _empty():
+        return {
+            "ids": np.empty(0, dtype=object),
+            "lons": np.empty((0, len(BODIES)), dtype=np.float32),
+            "elements": np.empty((0, 4), dtype=np.float32),
+            "wuxing": np.empty((0, 5), dtype=np.float32),
+            "day_master": np.empty(0, dtype=np.int8),
+            "index": {},
+        }
+
+    def _load(self, path):
+        data = np.load(path, allow_pickle=True)
+        snapshot = {name: data[name] for name in ("ids", "lons", "elements", "wuxing", "day_master")}
+        snapshot["index"] = {cid: i for i, cid in enumerate(snapshot["ids"].tolist())}
+        self._snapshot = snapshot
+        logger.info("loaded %d compatibility candidates", len(snapshot["ids"]))
+
+    def _save(self, snapshot):
+        tmp = self.path + ".tmp.npz"
+        np.savez(tmp, **{k: v for k, v in snapshot.items() if k != "index"})
+        os.replace(tmp, self.path)
+
+    @property
+    def size(self):
+        return len(self._snapshot["ids"])
+
+    def add(self, ids, features):
+        """
+        新增或更新候選人（id 已存在時覆寫該列）；features 為 chart_features 的回傳值
+        同一批中重複的 id 以最後一筆為準；回傳 (新增數, 更新數)
+        """
+        latest = {cid: row for row, cid in enumerate(ids)}  # 保留第一次出現的順序、最後一筆的資料
+        with self._lock:
+            old = self._snapshot
+            index = dict(old["index"])
+            columns = {name: [old[name]] for name in ("lons", "elements", "wuxing", "day_master")}
+            new_ids = list(old["ids"].tolist())
+            updates = []
+            for cid, row in latest.items():
+                if cid in index:
+                    updates.append((index[cid], row))
+                else:
+                    index[cid] = len(new_ids)
+                    new_ids.append(cid)
+                    for name, values in zip(columns, features):
+                        columns[name].append(values[row:row + 1])
+            # 複製成新的陣列再整組替換，進行中的查詢不受影響
+            snapshot = {name: np.concatenate(parts) for name, parts in columns.items()}
+            for target, row in updates:
+                for name, values in zip(columns, features):
+                    snapshot[name][target] = values[row]
+            snapshot["ids"] = np.array(new_ids, dtype=object)
+            snapshot["index"] = index
+            self._snapshot = snapshot
+            if self.path:
+                self._save(snapshot)
+        return len(latest) - len(updates), len(updates)
+
+    def remove(self, ids):
+        with self._lock:
+            old = self._snapshot
+            drop = [old["index"][cid] for cid in ids if cid in old["index"]]
+            if not drop:
+                return 0
+            keep = np.ones(len(old["ids"]), dtype=bool)
+            keep[drop] = False
+            snapshot = {name: old[name][keep] for name in ("ids", "lons", "elements", "wuxing", "day_master")}
+            snapshot["index"] = {cid: i for i, cid in enumerate(snapshot["ids"].tolist())}
+            self._snapshot = snapshot
+            if self.path:
+                self._save(snapshot)
+        return len(drop)
+
+    def rank(self, query, top_k=10, exclude_id=None):
+        """
+        query：chart_features 回傳的單筆特徵（每個陣列取第 0 列）
+        回傳分數最高的 top_k 位候選人（含各項分數與主要相位）
+        """
+        data = self._snapshot
+        q_lons, q_elements, q_wuxing, q_day_master = query
+        n = len(data["ids"])
+        if n == 0:
+            return []
+        aspects = aspect_scores(q_lons, data["lons"])
+        elements = element_scores(q_elements, data["elements"])
+        wuxing = wuxing_scores(q_wuxing, q_day_master, data["wuxing"], data["day_master"])
+        total = aspects + ELEMENT_WEIGHT * elements + WUXING_WEIGHT * wuxing
+        if exclude_id is not None and exclude_id in data["index"]:
+            total[data["index"][exclude_id]] = -np.inf
+        k = min(top_k, n)
+        # argpartition 只做部分排序（O(N)），再把前 k 名排好
+        top = np.argpartition(-total, k - 1)[:k]
+        top = top[np.argsort(-total[top], kind="stable")]
+        return [
+            {
+                "id": data["ids"][i],
+                "score": round(float(total[i]), 3),
+                "aspects": round(float(aspects[i]), 3),
+                "elements": round(float(elements[i]), 3),
+                "wuxing": round(float(wuxing[i]), 3),
+                "top_aspects": aspect_details(q_lons, data["lons"][i]),
+            }
+            for i in top.tolist() if np.isfinite(total[i])
+        ]
+
+    def stats(self):
+        data = self._snapshot
+        return {
+            "candidates": len(data["ids"]),
+            "bytes": int(sum(data[name].nbytes for name in ("lons", "elements", "wuxing", "day_master"))),
+            "path": self.path,
+        }
+
+
+store = CandidateStore.from_env()
+
+
+if __name__ == "__main__":
+    import argparse
+    import time
+
+    parser = argparse.ArgumentParser(description="合盤配對工具")
+    sub = parser.add_subparsers(dest="cmd", required=True)
+    p_bench = sub.add_parser("bench")
+    p_bench.add_argument("--candidates", type=int, default=100000)
+    p_bench.add_argument("--queries", type=int, default=20)
+    p_bench.add_argument("--top-k", type=int, default=10)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    n = args.candidates
+    seconds = rng.integers(0, 60 * 365 * 86400, n) + np.datetime64("1960-01-01T00:00:00", "s").astype(np.int64)
+    stamps = seconds.astype("datetime64[s]")
+    lats, lons = rng.uniform(18, 45, n), rng.uniform(100, 125, n)
+    unknown = rng.random(n) < 0.2
+
+    start = time.perf_counter()
+    features = chart_features(stamps, lats, lons, unknown)
+    build_s = time.perf_counter() - start
+    bench_store = CandidateStore()
+    bench_store.add([f"u{i}" for i in range(n)], features)
+
+    timings = []
+    for q in range(args.queries):
+        query = [f[q] for f in features]
+        start = time.perf_counter()
+        bench_store.rank(query, args.top_k, exclude_id=f"u{q}")
+        timings.append(time.perf_counter() - start)
+    timings = np.array(timings) * 1000
+    print({
+        "candidates": n,
+        "features_build_s": round(build_s, 2),
+        **bench_store.stats(),
+        "rank_ms_median": round(float(np.median(timings)), 1),
+        "rank_ms_max": round(float(timings.max()), 1),
+    })
@@ -0,0 +1,127 @@
+# 檔案名稱: compression.py
+# 回應壓縮：依 Accept-Encoding 協商 brotli（有安裝 brotli 套件時）或 gzip
+# SSE（text/event-stream）不壓縮，避免 token 被壓縮緩衝卡住；小於 COMPRESS_MIN_SIZE 的回應也不壓縮
+# 直接實作 ASGI 的 send 介面，不依賴 starlette GZipMiddleware 的內部類別（各版本的建構參數不同）
+#
+#   COMPRESS_MIN_SIZE   最小壓縮大小（位元組，預設 1000）
+#   COMPRESS_LEVEL      gzip 壓縮等級（預設 6；9 的 CPU 成本高、體積只小一點點）
+import os
+import zlib
+
+from starlette.datastructures import Headers, MutableHeaders
+
+try:
+    import brotli
+except ImportError:  # brotli 為選用相依（requirements.txt 已列入；未安裝時只協商 gzip）
+    brotli = None
+
+# 不壓縮的內容類型：串流事件與本身已壓縮的格式
+EXCLUDED_CONTENT_TYPES = ("text/event-stream", "application/gzip", "application/zip", "image/", "audio/", "video/")
+
+
+class _Gzip:
+    def __init__(self, level):
+        self._compressor = zlib.compressobj(level, zlib.DEFLATED, 31)  # wbits=31：gzip 標頭
+
+    def compress(self, body, more_body):
+        data = self._compressor.compress(body)
+        # 串流回應（例如 NDJSON）每個分塊都 flush，讓客戶端能立即解開
+        return data + self._compressor.flush(zlib.Z_SYNC_FLUSH if more_body else zlib.Z_FINISH)
+
+
+class _Brotli:
+    def __init__(self, quality):
+        self._compressor = brotli.Compressor(quality=quality)
+
+    def compress(self, body, more_body):
+        data = self._compressor.process(body)
+        return data + (self._compressor.flush() if more_body else self._compressor.finish())
+
+
+def _accepts(accept_encoding, coding):
+    """Accept-Encoding 中是否接受某種編碼（q=0 視為拒絕）"""
+    for part in accept_encoding.split(","):
+        name, _, params = part.strip().partition(";")
+        if name.strip().lower() == coding:
+            return params.replace(" ", "") not in ("q=0", "q=0.0")
+    return False
+
+
+class _Responder:
+    """
+    包住下游的 send：先暫存 http.response.start，看到第一個 body 後才決定是否壓縮
+    （單次回應且小於門檻、已有 Content-Encoding、部分內容或排除的類型時原樣送出）
+    可壓縮的回應不論最後是否壓縮都帶 Vary: Accept-Encoding，避免中間的快取把未壓縮的版本
+    送給接受壓縮的客戶端（或反過來）；encoding 為 None 表示客戶端不接受任何壓縮，只補上 Vary
+    """
+
+    def __init__(self, send, encoding, make_compressor, minimum_size):
+        self.send = send
+        self.encoding = encoding
+        self.make_compressor = make_compressor
+        self.minimum_size = minimum_size
+        self.start = None
+        self.passthrough = False
+        self.compressor = None
+
+    async def __call__(self, message):
+        kind = message["type"]
+        if kind == "http.response.start":
+            headers = Headers(raw=message["headers"])
+            content_type = headers.get("content-type", "").partition(";")[0].strip().lower()
+            self.passthrough = ("content-encoding" in headers or message["status"] == 206
+                                or content_type.startswith(EXCLUDED_CONTENT_TYPES))
+            if self.passthrough:
+                await self.send(message)
+            else:
+                self.start = message
+            return
+        if self.passthrough or kind != "http.response.body":
+            if self.start is not None:  # 例如 pathsend：不壓縮，先補送標頭
+                await self.send(self.start)
+                self.start = None
+            await self.send(message)
+            return
+
+        body = message.get("body", b"")
+        more_body = message.get("more_body", False)
+        if self.start is not None:
+            start, self.start = self.start, None
+            headers = MutableHeaders(scope=start)
+            headers.add_vary_header("Accept-Encoding")
+            if self.encoding is None or (not more_body and len(body) < self.minimum_size):
+                self.passthrough = True
+                await self.send(start)
+                await self.send(message)
+                return
+            self.compressor = self.make_compressor()
+            headers["Content-Encoding"] = self.encoding
+            body = self.compressor.compress(body, more_body)
+            if more_body:
+                del headers["Content-Length"]
+            else:
+                headers["Content-Length"] = str(len(body))
+            await self.send(start)
+        else:
+            body = self.compressor.compress(body, more_body)
+        await self.send({**message, "body": body})
+
+
+class CompressionMiddleware:
+    def __init__(self, app, minimum_size=None, gzip_level=None, brotli_quality=5):
+        self.app = app
+        self.minimum_size = minimum_size or int(os.getenv("COMPRESS_MIN_SIZE", "1000"))
+        self.gzip_level = gzip_level or int(os.getenv("COMPRESS_LEVEL", "6"))
+        self.brotli_quality = brotli_quality
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        accept = Headers(scope=scope).get("accept-encoding", "")
+        if brotli is not None and _accepts(accept, "br"):
+            send = _Responder(send, "br", lambda: _Brotli(self.brotli_quality), self.minimum_size)
+        elif _accepts(accept, "gzip"):
+            send = _Responder(send, "gzip", lambda: _Gzip(self.gzip_level), self.minimum_size)
+        else:
+            send = _Responder(send, None, None, self.minimum_size)
+        await self.app(scope, receive, send)
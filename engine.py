@@ -1,66 +1,120 @@
 from flatlib.datetime import Datetime
-from flatlib.geopos import GeoPos
-from flatlib.chart import Chart
 from flatlib import const
-from lunar_python import Solar
+from flatlib.ephem import swe
+from collections import deque
 import datetime
+import time
+from concurrent.futures import ProcessPoolExecutor
+import ephemeris
+import bazi_engine
+import logs
+from chart_cache import cached_chart
 
-def calculate_positions(year, month, day, hour=12, minute=0, lat=22.3, lon=114.2, is_time_unknown=False):
-    # --- 0. 真太陽時校正 ---
-    if not is_time_unknown:
-        longitude_offset_minutes = (lon - 120.0) * 4.0
-        original_dt = datetime.datetime(year, month, day, hour, minute)
-        solar_dt = original_dt + datetime.timedelta(minutes=longitude_offset_minutes)
-        bazi_year, bazi_month, bazi_day = solar_dt.year, solar_dt.month, solar_dt.day
-        bazi_hour, bazi_minute = solar_dt.hour, solar_dt.minute
-    else:
-        bazi_year, bazi_month, bazi_day = year, month, day
-        bazi_hour, bazi_minute = 12, 0
+ZODIAC_NAMES = ["白羊座", "金牛座", "雙子座", "巨蟹座", "獅子座", "處女座", "天秤座", "天蠍座", "射手座", "摩羯座", "水瓶座", "雙魚座"]
+SIGN_TO_ELEMENT = {'白羊座': 'Fire', '獅子座': 'Fire', '射手座': 'Fire', '金牛座': 'Earth', '處女座': 'Earth', '摩羯座': 'Earth', '雙子座': 'Air', '天秤座': 'Air', '水瓶座': 'Air', '巨蟹座': 'Water', '天蠍座': 'Water', '雙魚座': 'Water'}
+PLANETS_LIST = ['Sun', 'Moon', 'Mercury', 'Venus', 'Mars', 'Jupiter', 'Saturn', 'Uranus', 'Neptune', 'Pluto']
+PLANET_WEIGHTS = {'Sun': 30, 'Moon': 30, 'Mercury': 15, 'Venus': 15, 'Mars': 15, 'Jupiter': 10, 'Saturn': 10, 'Uranus': 5, 'Neptune': 5, 'Pluto': 5}
+RISING_WEIGHT = 30
+
+logger = logs.get_logger("engine")
+
+# flatlib Chart 預設只計算傳統七星（不含天王、海王、冥王），黃經表路徑維持相同輸出
+FLATLIB_DEFAULT_OBJECTS = set(const.LIST_OBJECTS_TRADITIONAL)
+
+def utc_offset_text(tz_offset):
+    """UTC 偏移（小時）→ flatlib 的 '+HH:MM'（地方平時等非整分鐘的偏移取最接近的分鐘）"""
+    minutes = round(tz_offset * 60)
+    sign = '-' if minutes < 0 else '+'
+    return f"{sign}{abs(minutes) // 60:02d}:{abs(minutes) % 60:02d}"
+
+
+def _birth_datetime(year, month, day, hour, minute, tz_offset=8.0):
+    """出生地的鐘錶時間；tz_offset 為出生當時的 UTC 偏移（預設 +08:00，見 places.utc_offset）"""
+    return Datetime(f"{year:04d}/{month:02d}/{day:02d}", f"{hour:02d}:{minute:02d}", utc_offset_text(tz_offset))
+
+
+def check_birth_datetime(year, month, day, hour=12, minute=0, is_time_unknown=False):
+    """不存在的日期時間（例如 2 月 30 日、13 月）拋出 ValueError；flatlib 會默默換算成別的日子"""
+    try:
+        datetime.datetime(year, month, day, 12 if is_time_unknown else hour, 0 if is_time_unknown else minute)
+    except ValueError as e:
+        raise ValueError(f"無效的出生日期或時間: {e}") from None
 
-    # --- 1. 西方占星 (保留原樣) ---
-    date_str = f"{year:04d}/{month:02d}/{day:02d}"
-    time_str = f"{hour:02d}:{minute:02d}"
-    date = Datetime(date_str, time_str, '+08:00')
-    pos = GeoPos(lat, lon)
-    chart = Chart(date, pos, hsys=const.HOUSES_PLACIDUS)
 
-    ZODIAC_NAMES = ["白羊座", "金牛座", "雙子座", "巨蟹座", "獅子座", "處女座", "天秤座", "天蠍座", "射手座", "摩羯座", "水瓶座", "雙魚座"]
-    sign_to_element = {'白羊座': 'Fire', '獅子座': 'Fire', '射手座': 'Fire', '金牛座': 'Earth', '處女座': 'Earth', '摩羯座': 'Earth', '雙子座': 'Air', '天秤座': 'Air', '水瓶座': 'Air', '巨蟹座': 'Water', '天蠍座': 'Water', '雙魚座': 'Water'}
-    planets_list = ['Sun', 'Moon', 'Mercury', 'Venus', 'Mars', 'Jupiter', 'Saturn', 'Uranus', 'Neptune', 'Pluto']
-    planet_weights = {'Sun': 30, 'Moon': 30, 'Mercury': 15, 'Venus': 15, 'Mars': 15, 'Jupiter': 10, 'Saturn': 10, 'Uranus': 5, 'Neptune': 5, 'Pluto': 5}
+@cached_chart("planets")
+def western_planets(year, month, day, hour=12, minute=0, tz_offset=8.0):
+    """
+    行星星座與四元素（只取決於出生時刻，與地點無關）
+    單獨快取：只改城市（同時區）、或同一時刻的其他請求可直接沿用
+    """
+    date = _birth_datetime(year, month, day, hour, minute, tz_offset)
+    table = ephemeris.get_table()
+
+    # 行星黃經：有黃經表時插值取得，否則直接查 Swiss Ephemeris（與 flatlib Chart 相同）
+    if table is not None and table.covers(date.jd):
+        lons = table.longitudes(date.jd)
+        planet_lons = {p_id: lons[p_id] for p_id in PLANETS_LIST if p_id in FLATLIB_DEFAULT_OBJECTS}
+    else:
+        planet_lons = {}
+        for p_id in PLANETS_LIST:
+            if p_id not in FLATLIB_DEFAULT_OBJECTS:
+                continue
+            try: planet_lons[p_id] = swe.sweObject(p_id, date.jd)['lon']
+            except: continue
+    sign_indices = dict(zip(planet_lons, ephemeris.sign_indices(list(planet_lons.values())).tolist()))
 
     western_results = {}
     western_elements_count = {"Fire": 0, "Earth": 0, "Air": 0, "Water": 0}
-    sign_scores = {}
-
-    for p_id in planets_list:
+    for p_id in planet_lons:
         try:
-            obj = chart.get(p_id)
-            exact_degree = obj.lon
-            sign_index = int(exact_degree / 30) % 12
-            sign_name = ZODIAC_NAMES[sign_index]
+            exact_degree = planet_lons[p_id]
+            sign_name = ZODIAC_NAMES[sign_indices[p_id]]
             
-            elem = sign_to_element.get(sign_name, "Unknown")
+            elem = SIGN_TO_ELEMENT.get(sign_name, "Unknown")
             if elem in western_elements_count: western_elements_count[elem] += 1
             
-            weight = planet_weights.get(p_id, 5)
-            sign_scores[sign_name] = sign_scores.get(sign_name, 0) + weight
-            
             western_results[p_id.lower()] = {"sign": sign_name, "element": elem, "deg": round(exact_degree % 30, 2)}
         except: continue
+    return {"planets": western_results, "elements": western_elements_count}
+
+
+def western_houses(year, month, day, hour, minute, lat, lon, tz_offset=8.0):
+    """上升星座與 12 宮（取決於出生時刻與地點；只查宮位，約 10 微秒，不值得快取）"""
+    date = _birth_datetime(year, month, day, hour, minute, tz_offset)
+    house_lons, angle_lons = swe.sweHousesLon(date.jd, lat, lon, const.HOUSES_PLACIDUS)
+    houses_data = [{"house": i, "sign": ZODIAC_NAMES[int(h_lon / 30) % 12]}
+                   for i, h_lon in enumerate(house_lons, start=1)]
+    return ZODIAC_NAMES[int(angle_lons[0] / 30) % 12], houses_data
+
+
+@cached_chart("western", defaults={"bazi_time_policy": lambda: bazi_engine.DEFAULT_TIME_POLICY})
+def calculate_positions(year, month, day, hour=12, minute=0, lat=22.3, lon=114.2, is_time_unknown=False, bazi_time_policy=None,
+                        tz_offset=8.0):
+    """
+    完整星盤 = 行星（western_planets）+ 上升與宮位（western_houses）+ 八字（bazi_engine.compute_bazi）
+    三部分各自只依賴部分輸入（見 chart_diff.DEPENDENCIES），行星與八字另有獨立快取，
+    例如補上出生時間或改城市時，只重算受影響的部分
+    出生時間為出生地的鐘錶時間，tz_offset 為當時的 UTC 偏移（小時，含夏令時間；由 places.utc_offset 換算）
+    """
+    check_birth_datetime(year, month, day, hour, minute, is_time_unknown)
+
+    # --- 1. 西方占星 (保留原樣) ---
+    western_start = time.perf_counter()
+    planets = western_planets(year, month, day, hour, minute, tz_offset)
+    western_results = planets["planets"]
+    western_elements_count = planets["elements"]
+    sign_scores = {}
+    for p_id in PLANETS_LIST:
+        info = western_results.get(p_id.lower())
+        if info is not None:
+            sign_scores[info["sign"]] = sign_scores.get(info["sign"], 0) + PLANET_WEIGHTS.get(p_id, 5)
 
     rising_sign = "未知"
     houses_data = []
     if not is_time_unknown:
         try:
-            asc = chart.get(const.ASC)
-            asc_idx = int(asc.lon / 30) % 12
-            rising_sign = ZODIAC_NAMES[asc_idx]
-            sign_scores[rising_sign] = sign_scores.get(rising_sign, 0) + 30
-            for i in range(1, 13):
-                h = chart.get(getattr(const, f'HOUSE{i}'))
-                h_idx = int(h.lon / 30) % 12
-                houses_data.append({"house": i, "sign": ZODIAC_NAMES[h_idx]})
+            rising_sign, houses_data = western_houses(year, month, day, hour, minute, lat, lon, tz_offset)
+            sign_scores[rising_sign] = sign_scores.get(rising_sign, 0) + RISING_WEIGHT
         except: pass
 
     total_score = sum(sign_scores.values())
@@ -70,63 +124,26 @@ def calculate_positions(year, month, day, hour=12, minute=0, lat=22.3, lon=114.2
             pct = (score / total_score) * 100
             distribution.append({"sign": s, "percent": round(pct, 1)})
         distribution.sort(key=lambda x: x['percent'], reverse=True)
+    logs.record("western", western_start)
 
-    # --- 3. 中式八字 (終極修復版) ---
-    # 初始化
+    # --- 3. 中式八字 (統一由 bazi_engine 計算，一次 EightChar) ---
     bazi_text = ["", "", "", ""]
     self_element = "未知"
-    wuxing_count = {"Metal": 0, "Wood": 0, "Water": 0, "Fire": 0, "Earth": 0}
-
+    day_master = ""
+    wuxing_percentages = {"金": 0, "木": 0, "水": 0, "火": 0, "土": 0}
+    policy = bazi_time_policy or bazi_engine.DEFAULT_TIME_POLICY
     try:
-        print(f"DEBUG: Calculating BaZi for {bazi_year}-{bazi_month}-{bazi_day} {bazi_hour}:{bazi_minute}")
-        
-        solar = Solar.fromYmdHms(bazi_year, bazi_month, bazi_day, bazi_hour, bazi_minute, 0)
-        lunar = solar.getLunar()
-        
-        bazi_text = [
-            lunar.getYearInGanZhi(), lunar.getMonthInGanZhi(),
-            lunar.getDayInGanZhi(), lunar.getTimeInGanZhi()
-        ]
-        
-        # 獲取五行列表
-        bazi_wuxing_list = lunar.getBaZiWuXing()
-        # print(f"DEBUG: Raw WuXing List: {bazi_wuxing_list}") # 解除註解可在 Render Log 看到原始數據
-        
-        limit = 6 if is_time_unknown else 8
-        
-        for i in range(limit):
-            if i < len(bazi_wuxing_list):
-                # 嘗試多種方法獲取文字
-                item = bazi_wuxing_list[i]
-                char = ""
-                
-                # 方法1: 如果是字串
-                if isinstance(item, str):
-                    char = item
-                # 方法2: 如果是物件，嘗試 .getName()
-                elif hasattr(item, 'getName'):
-                    char = item.getName()
-                # 方法3: 強制轉字串
-                else:
-                    char = str(item)
-                
-                # 判斷五行
-                if '金' in char: wuxing_count['Metal'] += 1
-                elif '木' in char: wuxing_count['Wood'] += 1
-                elif '水' in char: wuxing_count['Water'] += 1
-                elif '火' in char: wuxing_count['Fire'] += 1
-                elif '土' in char: wuxing_count['Earth'] += 1
-        
-        # 日主
-        day_master_gan = bazi_text[2][0] if len(bazi_text[2]) > 0 else "甲"
-        gan_wuxing = {"甲": "Wood", "乙": "Wood", "丙": "Fire", "丁": "Fire", "戊": "Earth", "己": "Earth", "庚": "Metal", "辛": "Metal", "壬": "Water", "癸": "Water"}
-        self_element = gan_wuxing.get(day_master_gan, "未知")
-        
-    except Exception as e:
-        # 這是關鍵：如果出錯，會在 Render Log 看到
-        print(f"CRITICAL BAZI ERROR: {e}")
-        import traceback
-        traceback.print_exc()
+        with logs.stage("bazi"):
+            bazi = bazi_engine.compute_bazi(year, month, day, hour, minute, lon, is_time_unknown, policy, tz_offset)
+        bazi_text = bazi["pillars"]
+        self_element = bazi["self_element"]
+        day_master = bazi["day_master"]
+        wuxing_percentages = bazi["percentages"]
+    except ValueError:
+        raise  # 輸入錯誤（日期時間、時間校正方式）交給呼叫端回報，不當成排盤失敗
+    except Exception:
+        # 這是關鍵：如果出錯，會在 Render Log 看到（含 traceback）
+        logger.exception("bazi computation failed")
 
     return {
         "western": {
@@ -139,6 +156,59 @@ def calculate_positions(year, month, day, hour=12, minute=0, lat=22.3, lon=114.2
         "chinese": {
             "bazi_text": bazi_text,
             "self_element": self_element,
-            "five_elements": wuxing_count
+            "day_master": day_master,
+            "five_elements": wuxing_percentages
         }
-    }
\ No newline at end of file
+    }
+
+
+# ==========================================
+# 批次計算（後台重算、配對等大量工作）
+# ==========================================
+BATCH_FIELDS = ("year", "month", "day", "hour", "minute", "lat", "lon", "is_time_unknown", "bazi_time_policy", "tz_offset")
+
+
+def _compute_record(record):
+    """單筆：星盤 + 八字（只做確定性的計算，不呼叫 AI）"""
+    result = {"id": record.get("id")}
+    try:
+        args = {k: record[k] for k in BATCH_FIELDS if record.get(k) is not None}
+        result["chart"] = calculate_positions(**args)
+    except Exception as e:
+        result["error"] = str(e)
+    return result
+
+
+def _compute_chunk(records):
+    return [_compute_record(r) for r in records]
+
+
+def calculate_positions_batch(records, max_workers=None, chunk_size=64, executor=None):
+    """
+    批次計算大量出生資料，依輸入順序逐筆 yield 結果
+    records 可以是任意可迭代物件（dict，欄位同 calculate_positions，可另帶 id 原樣返回）
+    同時在途的分塊數有上限，不論批次多大記憶體用量都維持平穩
+    """
+    own_executor = executor is None
+    if own_executor:
+        executor = ProcessPoolExecutor(max_workers=max_workers)
+    max_pending = (max_workers or executor._max_workers) * 2
+    pending = deque()
+    chunk = []
+    try:
+        for record in records:
+            chunk.append(record)
+            if len(chunk) >= chunk_size:
+                pending.append(executor.submit(_compute_chunk, chunk))
+                chunk = []
+                if len(pending) >= max_pending:
+                    yield from pending.popleft().result()
+        if chunk:
+            pending.append(executor.submit(_compute_chunk, chunk))
+        while pending:
+            yield from pending.popleft().result()
+    finally:
+        for future in pending:
+            future.cancel()
+        if own_executor:
+            executor.shutdown(wait=False, cancel_futures=True)
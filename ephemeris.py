@@ -0,0 +1,139 @@
+# 檔案名稱: ephemeris.py
+# 預先計算的行星黃經表：固定時間網格（預設每小時，1900–2100）存成 NumPy 陣列，
+# 以記憶體映射方式載入，查詢時線性插值，取代每次請求都建立完整的 flatlib Chart
+#
+# 建表：  python ephemeris.py build --out ephemeris.npy
+# 驗證：  python ephemeris.py verify --path ephemeris.npy --samples 20000
+import json
+import os
+
+import numpy as np
+import swisseph
+from flatlib import const
+from flatlib.datetime import Datetime
+from flatlib.ephem import swe
+
+# 表格欄位順序，與 engine.calculate_positions 的 planets_list 相同
+BODIES = [const.SUN, const.MOON, const.MERCURY, const.VENUS, const.MARS,
+          const.JUPITER, const.SATURN, const.URANUS, const.NEPTUNE, const.PLUTO]
+
+START_JD = Datetime('1900/01/01', '00:00', '+00:00').jd
+END_JD = Datetime('2101/01/01', '00:00', '+00:00').jd
+
+
+class EphemerisTable:
+    """黃經表：table[i, j] 為第 j 個天體在 start_jd + i * step 的黃經（度）"""
+
+    def __init__(self, table, start_jd, step):
+        self.table = table
+        self.start_jd = start_jd
+        self.step = step
+        self.end_jd = start_jd + (len(table) - 1) * step
+
+    @classmethod
+    def load(cls, path):
+        """以 mmap 載入表格，只有實際查詢到的頁面才會讀進記憶體"""
+        with open(_meta_path(path), encoding="utf-8") as f:
+            meta = json.load(f)
+        table = np.load(path, mmap_mode="r")
+        return cls(table, meta["start_jd"], meta["step"])
+
+    def covers(self, jd):
+        return self.start_jd <= jd < self.end_jd
+
+    def longitudes_batch(self, jds):
+        """向量化查詢：輸入 (N,) 儒略日，回傳 (N, 10) 黃經"""
+        jds = np.asarray(jds, dtype=np.float64)
+        pos = (jds - self.start_jd) / self.step
+        idx = np.clip(np.floor(pos).astype(np.int64), 0, len(self.table) - 2)
+        frac = (pos - idx)[:, None]
+        a = self.table[idx].astype(np.float64)
+        b = self.table[idx + 1].astype(np.float64)
+        # 跨越 360° 時取最短方向插值（逆行亦適用）
+        delta = (b - a + 180.0) % 360.0 - 180.0
+        return (a + frac * delta) % 360.0
+
+    def longitudes(self, jd):
+        """單一時間點：回傳 {天體 ID: 黃經}"""
+        row = self.longitudes_batch([jd])[0]
+        return dict(zip(BODIES, row.tolist()))
+
+
+def sign_indices(lons):
+    """黃經 → 星座序號（0 = 白羊座），支援任意形狀的陣列"""
+    return (np.floor_divide(np.asarray(lons, dtype=np.float64), 30.0).astype(np.int64)) % 12
+
+
+def _meta_path(path):
+    return path + ".json"
+
+
+def build(path, step_hours=1.0, start_jd=START_JD, end_jd=END_JD, progress=True):
+    """以 Swiss Ephemeris 逐點計算並寫出表格（一次性的離線工作）"""
+    step = step_hours / 24.0
+    count = int(np.ceil((end_jd - start_jd) / step)) + 1
+    table = np.lib.format.open_memmap(path, mode="w+", dtype=np.float32, shape=(count, len(BODIES)))
+    swe_ids = [swe.SWE_OBJECTS[b] for b in BODIES]
+    for i in range(count):
+        jd = start_jd + i * step
+        for j, swe_id in enumerate(swe_ids):
+            table[i, j] = swisseph.calc_ut(jd, swe_id)[0][0]
+        if progress and i % 100000 == 0:
+            print(f"{i}/{count}")
+    table.flush()
+    with open(_meta_path(path), "w", encoding="utf-8") as f:
+        json.dump({"start_jd": start_jd, "step": step, "bodies": BODIES}, f)
+    return EphemerisTable.load(path)
+
+
+def verify(table, samples=20000, seed=0):
+    """與 flatlib（Swiss Ephemeris 即時計算）比對隨機時間點的誤差與星座判定"""
+    rng = np.random.default_rng(seed)
+    jds = rng.uniform(table.start_jd, table.end_jd, samples)
+    fast = table.longitudes_batch(jds)
+    exact = np.array([[swe.sweObjectLon(b, jd) for b in BODIES] for jd in jds])
+    err = np.abs((fast - exact + 180.0) % 360.0 - 180.0)
+    sign_mismatch = int(np.count_nonzero(sign_indices(fast) != sign_indices(exact)))
+    # engine 回傳的 deg 取到小數點後 2 位，誤差須遠小於 0.005°
+    return {
+        "samples": samples,
+        "max_error_deg": float(err.max()),
+        "max_error_by_body": dict(zip(BODIES, err.max(axis=0).round(6).tolist())),
+        "sign_mismatches": sign_mismatch,
+    }
+
+
+_loaded = None
+
+
+def get_table():
+    """依環境變數 EPHEMERIS_PATH 載入表格；未設定或檔案不存在時回傳 None（沿用 flatlib）"""
+    global _loaded
+    if _loaded is None:
+        path = os.getenv("EPHEMERIS_PATH")
+        if not path or not os.path.exists(path):
+            return None
+        _loaded = EphemerisTable.load(path)
+    return _loaded
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="行星黃經表工具")
+    sub = parser.add_subparsers(dest="cmd", required=True)
+    p_build = sub.add_parser("build")
+    p_build.add_argument("--out", default="ephemeris.npy")
+    p_build.add_argument("--step-hours", type=float, default=1.0)
+    p_verify = sub.add_parser("verify")
+    p_verify.add_argument("--path", default="ephemeris.npy")
+    p_verify.add_argument("--samples", type=int, default=20000)
+    args = parser.parse_args()
+
+    if args.cmd == "build":
+        build(args.out, args.step_hours)
+    else:
+        report = verify(EphemerisTable.load(args.path), args.samples)
+        print(json.dumps(report, indent=2))
+        if report["max_error_deg"] > 0.005:
+            raise SystemExit("誤差超過 0.005°")
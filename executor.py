@@ -0,0 +1,121 @@
+# 檔案名稱: executor.py
+# 星盤 / 八字計算的執行層：CPU 密集的 flatlib、lunar_python 運算放到子行程，
+# 不和 event loop 上的 AI I/O 搶同一個 GIL
+import asyncio
+import importlib
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+from starlette.concurrency import run_in_threadpool
+
+import chart_cache
+import logs
+
+
+def _warm_worker():
+    """子行程初始化：先跑一次計算，載入星曆檔與 lunar_python 的表格"""
+    import engine
+    engine.calculate_positions.uncached(2000, 1, 1, 12, 0)
+
+
+def _noop():
+    return os.getpid()
+
+
+class ChartExecutor:
+    """
+    CHART_WORKERS: 子行程數量（預設 2；0 表示不開子行程，改用 threadpool）
+    """
+
+    def __init__(self, workers):
+        self.workers = workers
+        self.pool = None
+        self.in_flight = 0
+        self.completed = 0
+
+    @classmethod
+    def from_env(cls):
+        return cls(int(os.getenv("CHART_WORKERS", "2")))
+
+    async def start(self):
+        """啟動並預熱所有子行程，第一個請求不必負擔載入成本"""
+        if self.workers <= 0 or self.pool is not None:
+            return
+        # forkserver：子行程由乾淨的伺服器行程分出，不繼承這裡已開啟的 SQLite 連線（chart_cache）
+        # 與 event loop、執行緒的狀態；子行程自行 import 時各自開新的連線
+        self.pool = ProcessPoolExecutor(max_workers=self.workers, initializer=_warm_worker,
+                                        mp_context=multiprocessing.get_context("forkserver"))
+        loop = asyncio.get_running_loop()
+        await asyncio.gather(*[loop.run_in_executor(self.pool, _noop) for _ in range(self.workers)])
+
+    def shutdown(self):
+        if self.pool is not None:
+            self.pool.shutdown(wait=False, cancel_futures=True)
+            self.pool = None
+
+    async def run(self, func, *args, **kwargs):
+        """在子行程（或 threadpool）執行 func"""
+        self.in_flight += 1
+        try:
+            if self.pool is None:
+                return await run_in_threadpool(func, *args, **kwargs)
+            loop = asyncio.get_running_loop()
+            if kwargs:
+                return await loop.run_in_executor(self.pool, _call, func, args, kwargs)
+            return await loop.run_in_executor(self.pool, func, *args)
+        finally:
+            self.in_flight -= 1
+            self.completed += 1
+
+    async def run_cached(self, func, *args, **kwargs):
+        """
+        執行以 @cached_chart 包裝的函式：先在主行程查快取，
+        命中時直接返回，未命中才把未快取版本送到子行程，結果寫回快取
+        子行程內各階段的耗時會一併帶回，併入目前請求的計時
+        快取讀寫可能碰到 SQLite 磁碟層，放到 threadpool，不阻塞 event loop
+        """
+        key, params = func.cache_key(*args, **kwargs)
+        if chart_cache.cache.enabled:
+            result = await run_in_threadpool(chart_cache.cache.get, key)
+            if result is not None:
+                return result
+        result, stages = await self.run(_call_uncached, func.__module__, func.__name__, params)
+        logs.merge(stages)
+        if chart_cache.cache.enabled:
+            await run_in_threadpool(chart_cache.cache.set, key, result)
+        return result
+
+    @property
+    def queue_depth(self):
+        """等待中的任務數（超過子行程數量的部分）"""
+        if self.pool is None:
+            return 0
+        return max(0, self.in_flight - self.workers)
+
+    def stats(self):
+        return {
+            "mode": "process" if self.pool is not None else "thread",
+            "workers": self.workers,
+            "in_flight": self.in_flight,
+            "queue_depth": self.queue_depth,
+            "completed": self.completed,
+        }
+
+
+def _call(func, args, kwargs):
+    return func(*args, **kwargs)
+
+
+def _call_uncached(module_name, func_name, params):
+    """
+    子行程端：以模組與函式名稱找回 @cached_chart 包裝前的函式（包裝後的函式無法直接 pickle 原函式）
+    回傳 (結果, 各階段耗時)
+    """
+    func = getattr(importlib.import_module(module_name), func_name)
+    with logs.collect() as stages:
+        result = func.uncached(**params)
+    return result, stages
+
+
+chart_executor = ChartExecutor.from_env()
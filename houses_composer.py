@@ -0,0 +1,234 @@
+# 檔案名稱: houses_composer.py
+# 宮位分析的組裝模式：12 宮 × 12 星座只有 144 種組合，
+# 每種組合預先生成數個版本存在本機 SQLite，請求時直接組出 houses_analysis，不必呼叫 LLM
+#
+#   HOUSES_MODE          llm（預設，每次請求都生成）| composed（用預先生成的片段組裝，缺片段時退回 LLM）
+#   HOUSES_STORE_PATH    片段資料庫路徑（預設 houses_fragments.sqlite3）
+#   HOUSES_VARIANTS      每種組合的版本數（預設 3）
+#
+# 片段以「提示詞版本」分組：HOUSES_ANALYSIS_PROMPT 或生成參數一改，版本就不同，
+# 背景工作會為新版本補齊片段，補齊前仍走 LLM
+#
+# 手動補齊：  python houses_composer.py refresh --concurrency 8
+# 查看狀態：  python houses_composer.py status
+import asyncio
+import hashlib
+import json
+import os
+import random
+import re
+import sqlite3
+import threading
+import time
+
+import llm_gateway
+import logs
+import prompts
+
+logger = logs.get_logger("houses")
+
+# 片段的生成參數（temperature 同整段宮位分析）
+FRAGMENT_TEMPERATURE = 1.2
+FRAGMENT_MAX_TOKENS = 300
+
+_HEADING = re.compile(r"^\s*【[^】]*】\s*")
+
+
+def prompt_version(model):
+    """提示詞與生成參數的雜湊，作為片段的版本"""
+    payload = json.dumps([prompts.HOUSES_ANALYSIS_PROMPT, prompts.HOUSE_FRAGMENT_PROMPT, model,
+                          FRAGMENT_TEMPERATURE, FRAGMENT_MAX_TOKENS], ensure_ascii=False)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()[:16]
+
+
+def _clean(text):
+    """去掉模型自行加上的【第X宮】標題，只保留內容"""
+    return _HEADING.sub("", text.strip(), count=1).strip()
+
+
+class FragmentStore:
+    def __init__(self, path, variants):
+        self.variants = variants
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS house_fragments ("
+            "version TEXT NOT NULL, house INTEGER NOT NULL, sign TEXT NOT NULL, variant INTEGER NOT NULL, "
+            "text TEXT NOT NULL, created REAL NOT NULL, PRIMARY KEY (version, house, sign, variant))"
+        )
+        self._db.commit()
+        self._loaded = {}  # version -> {(house, sign): [text, ...]}，組裝時只讀記憶體
+
+    def _fragments(self, version):
+        fragments = self._loaded.get(version)
+        if fragments is None:
+            fragments = {}
+            with self._lock:
+                rows = self._db.execute(
+                    "SELECT house, sign, text FROM house_fragments WHERE version = ? ORDER BY variant", (version,)
+                ).fetchall()
+            for house, sign, text in rows:
+                fragments.setdefault((house, sign), []).append(text)
+            self._loaded[version] = fragments
+        return fragments
+
+    def put(self, version, house, sign, variant, text):
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO house_fragments (version, house, sign, variant, text, created) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (version, house, sign, variant, text, time.time()),
+            )
+            self._db.commit()
+        self._loaded.pop(version, None)
+
+    def missing(self, version, signs):
+        """回傳尚未補齊的 (宮位, 星座, 版本序號)"""
+        with self._lock:
+            have = set(self._db.execute(
+                "SELECT house, sign, variant FROM house_fragments WHERE version = ?", (version,)
+            ).fetchall())
+        return [(house, sign, variant)
+                for house in range(1, 13) for sign in signs for variant in range(self.variants)
+                if (house, sign, variant) not in have]
+
+    def prune(self, version):
+        """刪除其他（舊）版本的片段"""
+        with self._lock:
+            deleted = self._db.execute("DELETE FROM house_fragments WHERE version != ?", (version,)).rowcount
+            self._db.commit()
+        self._loaded = {k: v for k, v in self._loaded.items() if k == version}
+        return deleted
+
+    def compose(self, version, houses, seed=None):
+        """
+        houses: calculate_positions 的 houses_data（[{"house": 1, "sign": "白羊座"}, ...]）
+        任何一宮缺片段時回傳 None（由呼叫端退回 LLM）
+        seed 相同時選到相同的版本（同一張盤每次得到同樣的文字）
+        """
+        fragments = self._fragments(version)
+        rng = random.Random(seed)
+        parts = []
+        for h in houses:
+            choices = fragments.get((h["house"], h["sign"]))
+            if not choices:
+                return None
+            parts.append(f"【第{h['house']}宮】\n\n{rng.choice(choices)}")
+        return "\n\n".join(parts)
+
+    def stats(self, version):
+        with self._lock:
+            count = self._db.execute(
+                "SELECT COUNT(*) FROM house_fragments WHERE version = ?", (version,)
+            ).fetchone()[0]
+        return {"version": version, "fragments": count, "expected": 144 * self.variants}
+
+
+class HousesComposer:
+    def __init__(self, mode, store):
+        self.mode = mode
+        self.store = store
+        self.composed = 0
+        self.fallbacks = 0
+        self._task = None
+
+    @classmethod
+    def from_env(cls):
+        mode = os.getenv("HOUSES_MODE", "llm").lower()
+        if mode != "composed":
+            return cls(mode, None)
+        store = FragmentStore(os.getenv("HOUSES_STORE_PATH", "houses_fragments.sqlite3"),
+                              int(os.getenv("HOUSES_VARIANTS", "3")))
+        return cls(mode, store)
+
+    @property
+    def enabled(self):
+        return self.store is not None
+
+    def compose(self, model, houses, seed=None):
+        """組裝宮位分析；未啟用或片段不齊時回傳 None"""
+        if self.store is None or not houses:
+            return None
+        text = self.store.compose(prompt_version(model), houses, seed)
+        if text is None:
+            self.fallbacks += 1
+        else:
+            self.composed += 1
+        return text
+
+    async def refresh(self, client, model, concurrency=4):
+        """補齊目前提示詞版本缺少的片段，完成後清掉舊版本；回傳本次生成的數量"""
+        import engine
+        version = prompt_version(model)
+        todo = self.store.missing(version, engine.ZODIAC_NAMES)
+        if not todo:
+            return 0
+        logger.info("refreshing house fragments", extra={"fields": {"version": version, "missing": len(todo)}})
+        semaphore = asyncio.Semaphore(concurrency)
+        done = 0
+
+        async def generate(house, sign, variant):
+            nonlocal done
+            async with semaphore:
+                try:
+                    # 經過 llm_gateway，與線上請求共用並發上限與斷路器
+                    res = await llm_gateway.gateway.complete("houses_fragment", lambda: client.chat.completions.create(
+                        model=model,
+                        messages=[
+                            {"role": "system", "content": prompts.HOUSES_ANALYSIS_PROMPT},
+                            {"role": "user", "content": prompts.HOUSE_FRAGMENT_PROMPT.format(house=house, sign=sign)},
+                        ],
+                        temperature=FRAGMENT_TEMPERATURE,
+                        max_tokens=FRAGMENT_MAX_TOKENS,
+                    ))
+                except Exception as e:
+                    logger.warning("fragment %s/%s/%s failed: %s", house, sign, variant, e)
+                    return
+                text = _clean(res.choices[0].message.content or "")
+                if text:
+                    self.store.put(version, house, sign, variant, text)
+                    done += 1
+
+        await asyncio.gather(*[generate(*item) for item in todo])
+        if not self.store.missing(version, engine.ZODIAC_NAMES):
+            self.store.prune(version)
+        logger.info("house fragments refreshed", extra={"fields": {"version": version, "generated": done}})
+        return done
+
+    def start_refresh(self, client, model, concurrency=4):
+        """在背景補齊片段（不阻塞啟動）"""
+        if self.store is not None and self._task is None:
+            self._task = asyncio.create_task(self.refresh(client, model, concurrency))
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    def stats(self, model):
+        if self.store is None:
+            return {"mode": self.mode}
+        return {"mode": self.mode, **self.store.stats(prompt_version(model)),
+                "composed": self.composed, "fallbacks": self.fallbacks}
+
+
+composer = HousesComposer.from_env()
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="宮位片段工具")
+    sub = parser.add_subparsers(dest="cmd", required=True)
+    p_refresh = sub.add_parser("refresh")
+    p_refresh.add_argument("--concurrency", type=int, default=8)
+    sub.add_parser("status")
+    args = parser.parse_args()
+
+    os.environ["HOUSES_MODE"] = "composed"
+    import main
+    composer = HousesComposer.from_env()
+    if args.cmd == "refresh":
+        print(asyncio.run(composer.refresh(main.get_client(), main.LLM_MODEL, args.concurrency)))
+    print(json.dumps(composer.stats(main.LLM_MODEL), ensure_ascii=False, indent=2))
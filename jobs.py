@@ -0,0 +1,171 @@
+# 檔案名稱: jobs.py
+# 非同步分析工作：POST /analyze/jobs 立即回傳工作編號與星盤，AI 段落交給背景 worker 生成，
+# 客戶端以 GET /analyze/jobs/{id} 輪詢；斷線重送時以 Idempotency-Key 接回同一個工作，不重複付費
+#
+#   JOBS_WORKERS     同時生成的工作數（預設 8）
+#   JOBS_QUEUE_SIZE  排隊上限，超過時拒絕新工作（預設 1000）
+#   JOBS_RETENTION   完成後保留結果的秒數（預設 3600）
+import asyncio
+import contextvars
+import hashlib
+import json
+import os
+import time
+import uuid
+from collections import OrderedDict
+
+import logs
+
+logger = logs.get_logger("jobs")
+
+
+class JobQueueFull(Exception):
+    pass
+
+
+class IdempotencyConflict(Exception):
+    """同一個 Idempotency-Key 搭配了不同的請求內容"""
+
+
+class Job:
+    def __init__(self, job_id, fingerprint, chart, section_names):
+        self.id = job_id
+        self.fingerprint = fingerprint
+        self.status = "queued"  # queued → running → done
+        self.created = time.time()
+        self.finished = None
+        self.chart = chart
+        # 各段落：{"status": "pending" | "done" | "error", "content": ..., "error": ...}
+        self.sections = {name: {"status": "pending", "content": None, "error": None} for name in section_names}
+
+    def set_section(self, name, content, error=None):
+        if error is None:
+            self.sections[name] = {"status": "done", "content": content, "error": None}
+        else:
+            self.sections[name] = {"status": "error", "content": None, "error": str(error)}
+
+    def to_dict(self):
+        return {
+            "job_id": self.id,
+            "status": self.status,
+            "created": self.created,
+            "finished": self.finished,
+            "chart": self.chart,
+            "sections": self.sections,
+        }
+
+
+def fingerprint(payload):
+    """請求內容的雜湊（用來偵測同一個 Idempotency-Key 被拿去送不同的內容）"""
+    raw = json.dumps(payload, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+class JobManager:
+    def __init__(self, workers, queue_size, retention):
+        self.workers = workers
+        self.queue_size = queue_size
+        self.retention = retention
+        self._jobs = OrderedDict()   # job_id -> Job（依建立時間排序，方便清理）
+        self._by_key = {}            # Idempotency-Key -> job_id
+        self._queue = None
+        self._workers = []
+        self.submitted = 0
+        self.deduplicated = 0
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            workers=int(os.getenv("JOBS_WORKERS", "8")),
+            queue_size=int(os.getenv("JOBS_QUEUE_SIZE", "1000")),
+            retention=float(os.getenv("JOBS_RETENTION", "3600")),
+        )
+
+    def _ensure_workers(self):
+        if self._queue is None:
+            self._queue = asyncio.Queue(maxsize=self.queue_size)
+            # 以空白的 context 建立 worker，不繼承觸發建立的那個請求的計時範圍與請求編號
+            self._workers = [asyncio.create_task(self._worker(), context=contextvars.Context())
+                             for _ in range(self.workers)]
+
+    async def _worker(self):
+        while True:
+            job, work = await self._queue.get()
+            job.status = "running"
+            try:
+                await work(job)
+            except Exception:
+                logger.exception("job %s failed", job.id)
+                for name, section in job.sections.items():
+                    if section["status"] == "pending":
+                        job.set_section(name, None, "job failed")
+            finally:
+                job.status = "done"
+                job.finished = time.time()
+                self._queue.task_done()
+
+    def stop(self):
+        for task in self._workers:
+            task.cancel()
+        self._workers = []
+        self._queue = None
+
+    def _purge(self):
+        """清掉超過保留時間的已完成工作"""
+        cutoff = time.time() - self.retention
+        for job_id in list(self._jobs):
+            job = self._jobs[job_id]
+            if job.created > cutoff:
+                break  # 之後的工作更新，不必再看
+            if job.status == "done" and job.finished < cutoff:
+                del self._jobs[job_id]
+        live = set(self._jobs)
+        self._by_key = {k: v for k, v in self._by_key.items() if v in live}
+
+    def find(self, idempotency_key, payload_fingerprint):
+        """以 Idempotency-Key 找回既有工作；內容不同時拋出 IdempotencyConflict"""
+        if not idempotency_key:
+            return None
+        self._purge()
+        job_id = self._by_key.get(idempotency_key)
+        job = self._jobs.get(job_id) if job_id else None
+        if job is not None:
+            if job.fingerprint != payload_fingerprint:
+                raise IdempotencyConflict(idempotency_key)
+            self.deduplicated += 1
+        return job
+
+    def submit(self, idempotency_key, payload_fingerprint, chart, section_names, work):
+        """
+        建立工作並排入佇列；work(job) 是生成 AI 段落的 coroutine 函式
+        佇列已滿時拋出 JobQueueFull
+        """
+        self._ensure_workers()
+        self._purge()
+        job = Job(uuid.uuid4().hex, payload_fingerprint, chart, section_names)
+        try:
+            self._queue.put_nowait((job, work))
+        except asyncio.QueueFull:
+            raise JobQueueFull() from None
+        self._jobs[job.id] = job
+        if idempotency_key:
+            self._by_key[idempotency_key] = job.id
+        self.submitted += 1
+        return job
+
+    def get(self, job_id):
+        self._purge()
+        return self._jobs.get(job_id)
+
+    def stats(self):
+        return {
+            "workers": self.workers,
+            "queued": self._queue.qsize() if self._queue is not None else 0,
+            "jobs": len(self._jobs),
+            "running": sum(1 for j in self._jobs.values() if j.status == "running"),
+            "submitted": self.submitted,
+            "deduplicated": self.deduplicated,
+        }
+
+
+manager = JobManager.from_env()
@@ -0,0 +1,171 @@
+# 檔案名稱: llm_cache.py
+# AI 回覆快取：以 (提示詞, 星盤摘要, 模型, 取樣參數) 的雜湊為鍵，重複的星盤不必再付費生成
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+
+def make_key(system_prompt, summary, model, temperature, max_tokens):
+    """提示詞全文也納入雜湊，修改提示詞等同換了版本，舊快取自然失效"""
+    payload = json.dumps(
+        [system_prompt, summary, model, temperature, max_tokens], ensure_ascii=False
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class MemoryBackend:
+    """行程內 LRU，以 UTF-8 位元組數計算容量"""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self._data = OrderedDict()  # key -> 文字
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            value = self._data.get(key)
+            if value is not None:
+                self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        size = len(value.encode("utf-8"))
+        with self._lock:
+            old = self._data.pop(key, None)
+            if old is not None:
+                self._bytes -= len(old.encode("utf-8"))
+            self._data[key] = value
+            self._bytes += size
+            while self._bytes > self.max_bytes and self._data:
+                _, evicted = self._data.popitem(last=False)
+                self._bytes -= len(evicted.encode("utf-8"))
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._bytes = 0
+
+    def stats(self):
+        return {"backend": "memory", "entries": len(self._data), "bytes": self._bytes, "max_bytes": self.max_bytes}
+
+
+class SQLiteBackend:
+    """本機 SQLite 檔案，超過容量時淘汰最久未讀取的回覆"""
+
+    def __init__(self, path, max_bytes):
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS llm_responses ("
+            "key TEXT PRIMARY KEY, value TEXT NOT NULL, size INTEGER NOT NULL, accessed REAL NOT NULL)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS idx_llm_responses_accessed ON llm_responses (accessed)")
+        self._db.commit()
+
+    def get(self, key):
+        with self._lock:
+            row = self._db.execute("SELECT value FROM llm_responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            self._db.execute("UPDATE llm_responses SET accessed = ? WHERE key = ?", (time.time(), key))
+            self._db.commit()
+            return row[0]
+
+    def set(self, key, value):
+        size = len(value.encode("utf-8"))
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO llm_responses (key, value, size, accessed) VALUES (?, ?, ?, ?)",
+                (key, value, size, time.time()),
+            )
+            total = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM llm_responses").fetchone()[0]
+            if total > self.max_bytes:
+                # 由最舊的開始累加，刪到總量回到上限以內
+                excess = total - self.max_bytes
+                doomed = []
+                for old_key, old_size in self._db.execute(
+                    "SELECT key, size FROM llm_responses ORDER BY accessed ASC"
+                ):
+                    if excess <= 0:
+                        break
+                    doomed.append((old_key,))
+                    excess -= old_size
+                self._db.executemany("DELETE FROM llm_responses WHERE key = ?", doomed)
+            self._db.commit()
+
+    def clear(self):
+        with self._lock:
+            self._db.execute("DELETE FROM llm_responses")
+            self._db.commit()
+
+    def stats(self):
+        with self._lock:
+            entries, total = self._db.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM llm_responses"
+            ).fetchone()
+        return {"backend": "sqlite", "entries": entries, "bytes": total, "max_bytes": self.max_bytes}
+
+
+class LLMCache:
+    def __init__(self, backend):
+        self.backend = backend
+        self.hits = 0
+        self.misses = 0
+
+    @classmethod
+    def from_env(cls):
+        """
+        LLM_CACHE_BACKEND: memory（預設）/ sqlite / off
+        LLM_CACHE_PATH: SQLite 檔案路徑
+        LLM_CACHE_MAX_BYTES: 容量上限（位元組）
+        """
+        kind = os.getenv("LLM_CACHE_BACKEND", "memory").lower()
+        max_bytes = int(os.getenv("LLM_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+        if kind == "off":
+            return cls(None)
+        if kind == "sqlite":
+            return cls(SQLiteBackend(os.getenv("LLM_CACHE_PATH", "llm_cache.sqlite3"), max_bytes))
+        return cls(MemoryBackend(max_bytes))
+
+    @property
+    def enabled(self):
+        return self.backend is not None
+
+    def get(self, key):
+        if self.backend is None:
+            return None
+        value = self.backend.get(key)
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    def set(self, key, value):
+        if self.backend is not None and value:
+            self.backend.set(key, value)
+
+    def clear(self):
+        if self.backend is not None:
+            self.backend.clear()
+
+    def stats(self):
+        if self.backend is None:
+            return {"backend": "off"}
+        lookups = self.hits + self.misses
+        return {
+            **self.backend.stats(),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+        }
+
+
+cache = LLMCache.from_env()
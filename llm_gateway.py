@@ -0,0 +1,350 @@
+# 檔案名稱: llm_gateway.py
+# DeepSeek 呼叫的保護層：所有段落生成都經過這裡
+#   - AIMD 自適應並發上限：成功且延遲正常時緩慢加一，遇到 429 或延遲過高時減半
+#   - 每次呼叫的總期限（含重試），逾時即放棄該段落
+#   - 指數退避 + 全抖動重試（429 時優先採用 Retry-After）
+#   - 斷路器：連續失敗達門檻即暫停呼叫，冷卻後放一個探測請求
+#   - 選用的對沖請求：非串流呼叫超過該段落歷史延遲的某個分位數時，再送一個，取先完成者
+#
+#   LLM_CONCURRENCY_INITIAL / LLM_CONCURRENCY_MIN / LLM_CONCURRENCY_MAX   並發上限（預設 8 / 2 / 32）
+#   LLM_LATENCY_TARGET     延遲超過此秒數視為過載訊號（預設 60；串流以建立連線的時間計）
+#   LLM_DEADLINE           每個段落的總期限秒數（預設 120）
+#   LLM_MAX_ATTEMPTS       最多嘗試次數（預設 3）
+#   LLM_BREAKER_FAILURES   連續失敗幾次開啟斷路器（預設 5）
+#   LLM_BREAKER_RESET      斷路器冷卻秒數（預設 30）
+#   LLM_HEDGE_PERCENTILE   對沖門檻分位數，例如 0.95（預設不對沖）
+import asyncio
+import os
+import random
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+
+import logs
+import metrics
+
+logger = logs.get_logger("llm")
+
+
+class CircuitOpenError(Exception):
+    """斷路器開啟中，暫不呼叫 LLM"""
+
+
+def _classify(exc):
+    """回傳 "rate_limited"、"retryable" 或 "fatal"（參數錯誤、驗證失敗等重試也不會成功）"""
+    if isinstance(exc, (asyncio.TimeoutError, TimeoutError)):
+        return "retryable"
+    import openai
+    if isinstance(exc, openai.RateLimitError):
+        return "rate_limited"
+    if isinstance(exc, (openai.APIConnectionError, openai.InternalServerError)):
+        return "retryable"  # APITimeoutError 為 APIConnectionError 的子類別
+    status = getattr(exc, "status_code", None)
+    if status is not None and (status == 429 or status >= 500):
+        return "rate_limited" if status == 429 else "retryable"
+    return "fatal"
+
+
+def _retry_after(exc):
+    """429 回應的 Retry-After 秒數（沒有時回傳 None）"""
+    response = getattr(exc, "response", None)
+    try:
+        return float(response.headers.get("retry-after"))
+    except (AttributeError, TypeError, ValueError):
+        return None
+
+
+class AIMDLimiter:
+    """加性增、乘性減的並發上限；acquire 在額滿時排隊等待"""
+
+    def __init__(self, initial, minimum, maximum, latency_target, decrease_factor=0.5, cooldown=1.0):
+        self.limit = float(initial)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.latency_target = latency_target
+        self.decrease_factor = decrease_factor
+        self.cooldown = cooldown  # 同一波 429 只減半一次
+        self.in_flight = 0
+        self._waiters = deque()
+        self._last_decrease = 0.0
+
+    @property
+    def has_capacity(self):
+        return self.in_flight < int(self.limit)
+
+    async def acquire(self):
+        while not self.has_capacity:
+            waiter = asyncio.get_running_loop().create_future()
+            self._waiters.append(waiter)
+            try:
+                await waiter
+            except asyncio.CancelledError:
+                if waiter in self._waiters:
+                    self._waiters.remove(waiter)
+                elif waiter.done() and not waiter.cancelled():
+                    self._wake()  # 已被喚醒卻取消了，把名額讓給下一位
+                raise
+        self.in_flight += 1
+
+    def release(self):
+        self.in_flight -= 1
+        self._wake()
+
+    def _wake(self):
+        free = int(self.limit) - self.in_flight
+        while free > 0 and self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                free -= 1
+
+    def on_success(self, latency):
+        if latency > self.latency_target:
+            self.on_overload()
+            return
+        self.limit = min(self.maximum, self.limit + 1.0 / self.limit)
+        self._wake()
+
+    def on_overload(self):
+        now = time.monotonic()
+        if now - self._last_decrease >= self.cooldown:
+            self._last_decrease = now
+            self.limit = max(self.minimum, self.limit * self.decrease_factor)
+
+
+class CircuitBreaker:
+    """closed → （連續失敗達門檻）open → （冷卻後）half_open，探測成功回到 closed、失敗再 open"""
+
+    def __init__(self, failure_threshold, reset_timeout):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = "closed"
+        self.failures = 0
+        self._opened_at = 0.0
+        self._probing = False
+
+    def allow(self):
+        if self.state == "open":
+            if time.monotonic() - self._opened_at < self.reset_timeout:
+                return False
+            self.state = "half_open"
+            self._probing = False
+        if self.state == "half_open":
+            if self._probing:
+                return False
+            self._probing = True
+        return True
+
+    def release_probe(self):
+        self._probing = False
+
+    def record_success(self):
+        self.state = "closed"
+        self.failures = 0
+        self._probing = False
+
+    def record_failure(self):
+        self.failures += 1
+        if self.state == "half_open" or self.failures >= self.failure_threshold:
+            if self.state != "open":
+                logger.warning("circuit opened after %d consecutive failures", self.failures)
+            self.state = "open"
+            self._opened_at = time.monotonic()
+            self._probing = False
+
+
+class LLMGateway:
+    def __init__(self, limiter, breaker, deadline, max_attempts, backoff_base=0.5, backoff_cap=8.0,
+                 hedge_percentile=None, hedge_min_samples=20):
+        self.limiter = limiter
+        self.breaker = breaker
+        self.deadline = deadline
+        self.max_attempts = max_attempts
+        self.backoff_base = backoff_base
+        self.backoff_cap = backoff_cap
+        self.hedge_percentile = hedge_percentile
+        self.hedge_min_samples = hedge_min_samples
+        self._latencies = {}  # 段落 -> 最近的成功延遲（對沖門檻用）
+
+    @classmethod
+    def from_env(cls):
+        hedge = os.getenv("LLM_HEDGE_PERCENTILE")
+        return cls(
+            limiter=AIMDLimiter(
+                initial=int(os.getenv("LLM_CONCURRENCY_INITIAL", "8")),
+                minimum=int(os.getenv("LLM_CONCURRENCY_MIN", "2")),
+                maximum=int(os.getenv("LLM_CONCURRENCY_MAX", "32")),
+                latency_target=float(os.getenv("LLM_LATENCY_TARGET", "60")),
+            ),
+            breaker=CircuitBreaker(
+                failure_threshold=int(os.getenv("LLM_BREAKER_FAILURES", "5")),
+                reset_timeout=float(os.getenv("LLM_BREAKER_RESET", "30")),
+            ),
+            deadline=float(os.getenv("LLM_DEADLINE", "120")),
+            max_attempts=int(os.getenv("LLM_MAX_ATTEMPTS", "3")),
+            hedge_percentile=float(hedge) if hedge else None,
+        )
+
+    # --- 內部 ---
+    def _record_latency(self, section, latency):
+        self._latencies.setdefault(section, deque(maxlen=200)).append(latency)
+
+    def _hedge_delay(self, section):
+        samples = self._latencies.get(section)
+        if self.hedge_percentile is None or not samples or len(samples) < self.hedge_min_samples:
+            return None
+        ordered = sorted(samples)
+        return ordered[min(len(ordered) - 1, int(self.hedge_percentile * len(ordered)))]
+
+    async def _with_retries(self, section, attempt):
+        """attempt() 失敗時依錯誤種類退避重試；超過次數、期限或遇到不可重試的錯誤時拋出"""
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.deadline
+        for number in range(1, self.max_attempts + 1):
+            if not self.breaker.allow():
+                metrics.llm_requests.inc(section, "circuit_open")
+                raise CircuitOpenError("LLM circuit breaker is open")
+            try:
+                async with asyncio.timeout_at(deadline):
+                    result = await attempt()
+            except asyncio.CancelledError:
+                self.breaker.release_probe()  # 呼叫端取消（例如客戶端斷線），探測名額還回去
+                raise
+            except Exception as e:
+                kind = _classify(e)
+                if kind == "rate_limited":
+                    self.limiter.on_overload()
+                if kind != "fatal":
+                    self.breaker.record_failure()
+                else:
+                    self.breaker.record_success()  # 服務本身有回應，不算故障
+                delay = _retry_after(e) if kind == "rate_limited" else None
+                if delay is None:
+                    delay = random.uniform(0, min(self.backoff_cap, self.backoff_base * 2 ** (number - 1)))
+                if kind == "fatal" or number == self.max_attempts or loop.time() + delay >= deadline:
+                    raise
+                logger.info("retrying %s after %s (attempt %d, sleep %.2fs)", section, type(e).__name__, number, delay)
+                metrics_retries.inc(section, kind)
+                await asyncio.sleep(delay)
+            else:
+                self.breaker.record_success()
+                return result
+
+    async def _attempt(self, section, create):
+        """取得並發名額後呼叫一次 create()"""
+        await self.limiter.acquire()
+        start = time.perf_counter()
+        try:
+            result = await create()
+        finally:
+            self.limiter.release()
+        latency = time.perf_counter() - start
+        self.limiter.on_success(latency)
+        self._record_latency(section, latency)
+        return result
+
+    async def _hedged_attempt(self, section, create):
+        """超過對沖門檻且還有並發名額時再送一個相同的請求，取先成功者"""
+        delay = self._hedge_delay(section)
+        primary = asyncio.create_task(self._attempt(section, create))
+        if delay is None:
+            return await primary
+        try:
+            done, _ = await asyncio.wait({primary}, timeout=delay)
+        except BaseException:
+            primary.cancel()  # asyncio.wait 被取消時不會連帶取消等待中的 task
+            raise
+        if done or not self.limiter.has_capacity:
+            return await primary
+        metrics_hedges.inc(section)
+        backup = asyncio.create_task(self._attempt(section, create))
+        pending = {primary, backup}
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        return task.result()
+            return primary.result()  # 兩個都失敗：拋出主請求的錯誤
+        finally:
+            for task in (primary, backup):
+                task.cancel()
+
+    # --- 對外介面 ---
+    async def complete(self, section, create):
+        """
+        非串流呼叫：create 為每次呼叫都會產生新請求的函式
+        （例如 lambda: client.chat.completions.create(...)）
+        """
+        return await self._with_retries(section, lambda: self._hedged_attempt(section, create))
+
+    @asynccontextmanager
+    async def stream(self, section, create):
+        """
+        串流呼叫：建立串流的階段可重試；開始讀取之後並發名額保留到串流結束，
+        期限涵蓋整段串流（中途失敗不重試，避免重複送出已推給前端的文字）
+        create 須回傳可 await close() 的串流（openai 的 AsyncStream），離開時一律關閉
+        """
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.deadline
+
+        async def open_stream():
+            await self.limiter.acquire()
+            start = time.perf_counter()
+            try:
+                stream = await create()
+            except BaseException:
+                self.limiter.release()
+                raise
+            latency = time.perf_counter() - start
+            self.limiter.on_success(latency)
+            self._record_latency(section, latency)
+            return stream
+
+        stream = await self._with_retries(section, open_stream)
+        try:
+            async with asyncio.timeout_at(deadline):
+                yield stream
+        except Exception as e:
+            if _classify(e) != "fatal":
+                self.breaker.record_failure()
+            raise
+        finally:
+            # 讀完、中途失敗或被取消都關閉上游回應：連線還回連線池，伺服器端也隨之停止生成
+            try:
+                await stream.close()
+            finally:
+                self.limiter.release()
+
+    def stats(self):
+        return {
+            "concurrency_limit": round(self.limiter.limit, 2),
+            "in_flight": self.limiter.in_flight,
+            "waiting": len(self.limiter._waiters),
+            "circuit": self.breaker.state,
+            "consecutive_failures": self.breaker.failures,
+            "hedge_percentile": self.hedge_percentile,
+        }
+
+
+gateway = LLMGateway.from_env()
+
+metrics_retries = metrics.registry.register(metrics.Counter(
+    "star_llm_retries_total", "LLM call retries by section and error kind", ("section", "kind")))
+metrics_hedges = metrics.registry.register(metrics.Counter(
+    "star_llm_hedges_total", "Hedged LLM requests by section", ("section",)))
+_limit_gauge = metrics.registry.register(metrics.Gauge(
+    "star_llm_concurrency_limit", "Current adaptive LLM concurrency limit"))
+_in_flight_gauge = metrics.registry.register(metrics.Gauge(
+    "star_llm_in_flight", "LLM calls currently holding a concurrency slot"))
+_circuit_gauge = metrics.registry.register(metrics.Gauge(
+    "star_llm_circuit_open", "1 when the LLM circuit breaker is open or half-open"))
+
+
+def _collect():
+    _limit_gauge.set(value=gateway.limiter.limit)
+    _in_flight_gauge.set(value=gateway.limiter.in_flight)
+    _circuit_gauge.set(value=0 if gateway.breaker.state == "closed" else 1)
+
+
+metrics.registry.collectors.append(_collect)
@@ -0,0 +1,147 @@
+# 檔案名稱: logs.py
+# 結構化日誌：每行一筆 JSON，等級由 LOG_LEVEL 控制（預設 INFO）
+# 訊息一律用 logger.debug("... %s", obj) 的延遲格式化，關閉的等級不會產生 repr 成本
+#
+# 每個 HTTP 請求會收集各階段耗時（western、bazi、llm.<段落>、serialize…），
+# 請求結束時輸出一行 "request" 日誌
+import contextvars
+import json
+import logging
+import os
+import sys
+import time
+import uuid
+from contextlib import contextmanager
+
+# 目前請求的階段耗時（毫秒）與請求編號；不在請求中時為 None，stage() 直接略過
+_stages = contextvars.ContextVar("stages", default=None)
+_request_id = contextvars.ContextVar("request_id", default=None)
+
+
+class JsonFormatter(logging.Formatter):
+    """輸出 {"ts", "level", "logger", "msg", ...}；extra={"fields": {...}} 的欄位併入同一層"""
+
+    def format(self, record):
+        entry = {
+            "ts": round(record.created, 3),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        request_id = _request_id.get()
+        if request_id:
+            entry["request_id"] = request_id
+        fields = getattr(record, "fields", None)
+        if fields:
+            entry.update(fields)
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+def setup(level=None):
+    """設定 "star" 日誌根節點（只設定一次；子行程 import 時同樣生效）"""
+    root = logging.getLogger("star")
+    if not root.handlers:
+        handler = logging.StreamHandler(sys.stdout)
+        handler.setFormatter(JsonFormatter())
+        root.addHandler(handler)
+        root.propagate = False
+    root.setLevel((level or os.getenv("LOG_LEVEL", "INFO")).upper())
+    return root
+
+
+def get_logger(name):
+    return logging.getLogger(f"star.{name}")
+
+
+setup()
+logger = get_logger("http")
+
+
+# ==========================================
+# 階段計時
+# ==========================================
+@contextmanager
+def stage(name):
+    """累計一個階段的耗時；不在請求中（批次、CLI）時不計時"""
+    stages = _stages.get()
+    if stages is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        stages[name] = stages.get(name, 0.0) + (time.perf_counter() - start) * 1000
+
+
+@contextmanager
+def collect():
+    """開啟一個新的計時範圍，回傳收集用的 dict（子行程端用來把耗時帶回主行程）"""
+    stages = {}
+    token = _stages.set(stages)
+    try:
+        yield stages
+    finally:
+        _stages.reset(token)
+
+
+def record(name, start):
+    """累計自 start（time.perf_counter()）至今的耗時；用於不方便包成 with 區塊的長段程式"""
+    stages = _stages.get()
+    if stages is not None:
+        stages[name] = stages.get(name, 0.0) + (time.perf_counter() - start) * 1000
+
+
+def merge(stages):
+    """把另一個範圍（例如子行程）回傳的耗時併入目前的請求"""
+    current = _stages.get()
+    if current is None or not stages:
+        return
+    for name, ms in stages.items():
+        current[name] = current.get(name, 0.0) + ms
+
+
+def current_stages():
+    return _stages.get()
+
+
+class RequestLogMiddleware:
+    """
+    ASGI middleware：為每個請求建立計時範圍與請求編號，
+    回應（含串流回應）完整送出後輸出一行 request 日誌
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        stages = {}
+        stages_token = _stages.set(stages)
+        id_token = _request_id.set(uuid.uuid4().hex[:16])
+        start = time.perf_counter()
+        status = 500
+
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            if logger.isEnabledFor(logging.INFO):
+                logger.info("request", extra={"fields": {
+                    "method": scope["method"],
+                    "path": scope["path"],
+                    "status": status,
+                    "duration_ms": round((time.perf_counter() - start) * 1000, 2),
+                    "stages_ms": {k: round(v, 2) for k, v in stages.items()},
+                }})
+            _request_id.reset(id_token)
+            _stages.reset(stages_token)
@@ -1,7 +1,4 @@
 # Star Mirror Backend - v2.0 (Fixed Order & New AI Persona)
-from fastapi import FastAPI
-from pydantic import BaseModel
-import os
 import sys
 from pathlib import Path
 
@@ -10,17 +7,111 @@ current_dir = Path(__file__).parent
 if str(current_dir) not in sys.path:
     sys.path.insert(0, str(current_dir))
 
-import engine
-import bazi_engine
-from openai import OpenAI
+import startup  # 最先載入：import 耗時從這裡開始量測
+
+from fastapi import FastAPI, Header
+from fastapi.responses import PlainTextResponse, StreamingResponse
+from starlette.background import BackgroundTask
+from pydantic import BaseModel, model_validator
+from contextlib import asynccontextmanager
+from typing import Literal
+import asyncio
+import datetime
+import functools
+import json
+import os
+import traceback
+import zoneinfo
+
+# 重型模組（flatlib、lunar_python、numpy）延遲載入，由 lifespan 的預熱步驟觸發
+engine = startup.lazy_import("engine")
+bazi_engine = startup.lazy_import("bazi_engine")
+analytics = startup.lazy_import("analytics")
+transits = startup.lazy_import("transits")
+compatibility = startup.lazy_import("compatibility")
+import admission
+import chart_cache
+import chart_diff
+import combined
+import compact
+import compression
+import houses_composer
+import jobs
+import llm_cache
+import llm_gateway
+import logs
+import metrics
+import places
+import prompts
+import singleflight
+from executor import chart_executor
+
+def _load_lookup_tables():
+    import bazi_fast
+    import ephemeris
+    ephemeris.get_table()
+    bazi_fast.get_table()  # 只載入已建好的檔案；沒有檔案時不在啟動時建表（約數秒，每個 worker 都要付）
+
+def _warmup_chart():
+    """在主行程先算一張盤：載入 Swiss Ephemeris 星曆檔與 lunar_python 的表格（不寫入快取）"""
+    d = startup.state.warmup_date
+    engine.calculate_positions.uncached(d.year, d.month, d.day, d.hour, d.minute)
+
+@asynccontextmanager
+async def lifespan(app):
+    # 啟動時載入重型模組、預熱星盤計算子行程並先算一張盤，關閉時回收
+    await startup.state.start([
+        ("import_engines", lambda: (engine.calculate_positions, bazi_engine.compute_bazi, analytics.element_stats)),
+        ("lookup_tables", _load_lookup_tables),
+        ("places_index", places.get_index),
+        ("executor", chart_executor.start),
+        ("warmup_chart", _warmup_chart),
+        ("llm_client", get_client),
+        ("transit_table", lambda: transits.table.start()),  # 建立共用行運表並啟動每個時段的重建排程
+    ])
+    # HOUSES_MODE=composed：背景補齊目前提示詞版本的宮位片段
+    houses_composer.composer.start_refresh(get_client(), LLM_MODEL)
+    yield
+    jobs.manager.stop()
+    houses_composer.composer.stop()
+    transits.table.stop()
+    startup.state.stop()
+    chart_executor.shutdown()
 
 # ==========================================
 # 1. 初始化 App (必須放在最前面！)
 # ==========================================
-app = FastAPI()
+app = FastAPI(lifespan=lifespan, default_response_class=compact.FastJSONResponse)
+app.add_middleware(compression.CompressionMiddleware)  # 最內層：依 Accept-Encoding 壓縮（brotli / gzip）
+app.add_middleware(metrics.MetricsMiddleware)  # 內層：讀取階段計時寫入 /metrics 直方圖
+app.add_middleware(logs.RequestLogMiddleware)  # 外層：每個請求一行 JSON 日誌（含各階段耗時）
+
+logger = logs.get_logger("analyze")
+
+# 2. 初始化 OpenAI Client (非同步版本，內建 httpx 連線池，整個 worker 共用一個)
+# openai 套件載入較慢，第一次使用（或預熱）時才建立
+# DEEPSEEK_BASE_URL 可指向本機假伺服器（benchmarks/fake_llm.py）做負載測試
+client = None
+
+def get_client():
+    global client
+    if client is None:
+        from openai import AsyncOpenAI
+        client = AsyncOpenAI(
+            api_key=os.getenv("DEEPSEEK_API_KEY"),
+            base_url=os.getenv("DEEPSEEK_BASE_URL", "https://api.deepseek.com"),
+            max_retries=0  # 重試、期限與並發上限統一由 llm_gateway 處理
+        )
+    return client
 
-# 2. 初始化 OpenAI Client
-client = OpenAI(api_key=os.getenv("DEEPSEEK_API_KEY"), base_url="https://api.deepseek.com")
+LLM_MODEL = "deepseek-chat"
+
+# AI 分析段落：(回傳欄位名稱, 系統提示詞, temperature, max_tokens)
+AI_SECTIONS = [
+    ("attachment_analysis", prompts.ATTACHMENT_PROMPT, 1.0, 500),     # 依戀模式分析（300字）
+    ("deep_analysis", prompts.DEEP_ANALYSIS_PROMPT, 1.3, 2000),       # 星盤深度探索（1000字）
+    ("houses_analysis", prompts.HOUSES_ANALYSIS_PROMPT, 1.2, 2000),   # 宮位分析（每宮約100字；HOUSES_MODE=composed 時改用預先生成的片段）
+]
 
 # 3. 定義資料模型
 class ChartRequest(BaseModel):
@@ -32,6 +123,88 @@ class ChartRequest(BaseModel):
     lat: float = 22.3
     lon: float = 114.2
     is_time_unknown: bool = False
+    regenerate: bool = False  # True 時略過 AI 回覆快取，重新生成
+    bazi_time_policy: Literal["solar", "clock"] | None = None  # 八字時間校正，預設依 BAZI_TIME_POLICY
+    place_id: str | None = None  # /places/search 回傳的地點 id；提供時經緯度與時區以該地為準
+    tz: str | None = None  # IANA 時區（例如 "America/New_York"），省略時依 place_id
+    tz_offset: float | None = None  # 出生當時的 UTC 偏移（小時）；省略時由時區換算，沒有時區則為 +8
+
+    @model_validator(mode="after")
+    def _check_datetime(self):
+        """不存在的日期時間回 422（時間未知時只檢查日期）"""
+        hour, minute = (12, 0) if self.is_time_unknown else (self.hour, self.minute)
+        try:
+            datetime.datetime(self.year, self.month, self.day, hour, minute)
+        except ValueError as e:
+            raise ValueError(f"無效的出生日期或時間: {e}") from None
+        return self
+
+    @model_validator(mode="after")
+    def _resolve_place(self):
+        """地點 → 經緯度與時區；時區 → 出生當時的 UTC 偏移（含夏令時間與歷史時區變更）"""
+        if self.place_id is not None:
+            place = places.get(self.place_id)
+            if place is None:
+                raise ValueError(f"未知的地點: {self.place_id}")
+            self.lat, self.lon = place["lat"], place["lon"]
+            self.tz = self.tz or place["tz"]
+        if self.tz_offset is None:
+            if self.tz is None:
+                self.tz_offset = places.DEFAULT_TZ_OFFSET
+            else:
+                hour, minute = (12, 0) if self.is_time_unknown else (self.hour, self.minute)
+                self.tz_offset = places.utc_offset(self.tz, self.year, self.month, self.day, hour, minute)
+        return self
+
+class BatchRecord(ChartRequest):
+    id: str | None = None  # 呼叫端自訂識別碼，原樣返回
+
+class BatchRequest(BaseModel):
+    records: list[BatchRecord]
+
+class ChartDiffRequest(BaseModel):
+    before: ChartRequest
+    after: ChartRequest
+
+class TransitRequest(ChartRequest):
+    date: datetime.date | None = None  # 起始日期（出生地時區的當地日期，見 tz / tz_offset），預設今天
+    days: int = 1  # 天數（最多 31 天；超出共用表格範圍的時段會當場計算）
+
+class CompatibilityRankRequest(ChartRequest):
+    top_k: int = 10
+    exclude_id: str | None = None  # 查詢者本人也在候選名單時，排除自己
+
+class CompatibilityRemoveRequest(BaseModel):
+    ids: list[str]
+
+class CohortStatsRequest(BaseModel):
+    timestamps: list[datetime.datetime]  # 出生時間（當地鐘錶時間，ISO 格式，例如 "1990-05-17T08:30"，不帶時區）
+    lat: list[float] | None = None
+    lon: list[float] | None = None
+    time_unknown: list[bool] | None = None
+    cohorts: list[str] | None = None  # 分組標籤，例如註冊月份 "2025-01"
+    tz_offset: list[float] | None = None  # 出生當時的 UTC 偏移（小時），省略時為 +8
+
+    @model_validator(mode="after")
+    def _check_lengths(self):
+        """逐筆欄位須與 timestamps 等長，否則 NumPy 會默默廣播或錯位"""
+        n = len(self.timestamps)
+        for name in ("lat", "lon", "time_unknown", "cohorts", "tz_offset"):
+            values = getattr(self, name)
+            if values is not None and len(values) != n:
+                raise ValueError(f"{name} 的長度（{len(values)}）須與 timestamps（{n}）相同")
+        return self
+
+    @model_validator(mode="after")
+    def _check_timestamps(self):
+        """當地鐘錶時間不可帶時區（偏移請放 tz_offset）；年份須在節氣表範圍內，否則查表會取錯年、月柱"""
+        first, last = analytics.YEAR_RANGE
+        for i, stamp in enumerate(self.timestamps):
+            if stamp.tzinfo is not None:
+                raise ValueError(f"timestamps[{i}] 須為不帶時區的當地時間，UTC 偏移請放在 tz_offset")
+            if not first <= stamp.year <= last:
+                raise ValueError(f"timestamps[{i}] 的年份須在 {first}–{last} 之間")
+        return self
 
 # ==========================================
 # 4. 定義 API 路由
@@ -40,398 +213,752 @@ class ChartRequest(BaseModel):
 def test_bazi(year: int = 2000, month: int = 1, day: int = 1, hour: int = 12, minute: int = 0):
     """測試端點：直接返回八字計算結果"""
     try:
-        bazi_data = bazi_engine.get_bazi_analysis(year, month, day, hour, minute)
+        with logs.stage("bazi"):
+            bazi_data = bazi_engine.get_bazi_analysis(year, month, day, hour, minute)
         return {
             "success": True,
             "bazi_data": bazi_data,
             "five_elements": bazi_data.get('percentages', {})
         }
     except Exception as e:
-        import traceback
         return {
             "success": False,
             "error": str(e),
             "traceback": traceback.format_exc()
         }
 
-@app.post("/analyze")
-def analyze_chart(req: ChartRequest):
-    # --- A. 計算西方星盤 ---
-    chart = engine.calculate_positions(req.year, req.month, req.day, req.hour, req.minute, req.lat, req.lon, req.is_time_unknown)
-    
-    print(f"[DEBUG] engine 返回的 chart['chinese']: {chart.get('chinese')}")  # 調試日誌
-    
-    # --- B. 計算東方八字 (使用 bazi_engine 的準確計算) ---
-    # 確保 chinese 結構存在
-    if 'chinese' not in chart:
-        chart['chinese'] = {}
-    
-    # 立即清理 engine 返回的英文格式數據，改用中文格式
-    # engine 返回的是 {"Metal": 0, "Wood": 0, ...}，我們需要 {"金": 0, "木": 0, ...}
-    default_five_elements = {"金": 0, "木": 0, "水": 0, "火": 0, "土": 0}
-    
-    # 強制檢查並清理英文格式
-    if 'five_elements' in chart.get('chinese', {}):
-        fe = chart['chinese']['five_elements']
-        # 檢查是否是英文格式
-        if isinstance(fe, dict) and any(k in fe for k in ['Metal', 'Wood', 'Water', 'Fire', 'Earth']):
-            print(f"[DEBUG] 檢測到 engine 返回的英文格式，強制清理: {fe}")
-            chart['chinese']['five_elements'] = default_five_elements.copy()
-        else:
-            # 即使不是英文格式，也強制設置為中文格式（確保格式一致）
-            chart['chinese']['five_elements'] = default_five_elements.copy()
-    else:
-        # 不存在，直接設置
-        chart['chinese']['five_elements'] = default_five_elements.copy()
-    
-    bazi_text = "八字計算失敗"
-    
-    print(f"[DEBUG] 設置默認值後的 chart['chinese']['five_elements']: {chart['chinese']['five_elements']}")  # 調試日誌
-    
-    try:
-        bazi_data = bazi_engine.get_bazi_analysis(req.year, req.month, req.day, req.hour, req.minute)
-        print(f"[DEBUG] bazi_data: {bazi_data}")  # 調試日誌
-        
-        # 注入數據供前端使用 - 使用 bazi_engine 的準確計算結果
-        if bazi_data and 'percentages' in bazi_data:
-            chart['chinese']['five_elements'] = bazi_data['percentages']
-            print(f"[DEBUG] 設置 five_elements: {chart['chinese']['five_elements']}")  # 調試日誌
-        
-        # 獲取文字供 AI 使用
-        if bazi_data and 'bazi_text' in bazi_data:
-            bazi_text = bazi_data['bazi_text']
-    except Exception as e:
-        import traceback
-        error_msg = f"八字計算錯誤: {str(e)}\n{traceback.format_exc()}"
-        print(error_msg)
-        # 保持默認值，確保前端能收到數據結構
-    
-    # 確保 five_elements 存在且格式正確
-    if 'five_elements' not in chart['chinese']:
-        chart['chinese']['five_elements'] = default_five_elements
-    print(f"[DEBUG] 最終 chart['chinese']['five_elements']: {chart['chinese'].get('five_elements')}")  # 調試日誌
-
-    # --- C. 準備 AI 閱讀的資料 ---
+@app.get("/ready")
+def readiness():
+    """就緒檢查：預熱完成前回 503（給負載平衡器 / 自動擴展判斷）"""
+    status = startup.state.status()
+    return compact.FastJSONResponse(status, status_code=200 if status["ready"] else 503)
+
+@app.get("/schema/compact")
+def compact_schema():
+    """精簡版星盤（compat=false）的序號對照表"""
+    return compact.schema()
+
+@app.get("/cache/stats")
+def cache_stats():
+    """快取命中統計"""
+    return {
+        "chart": chart_cache.cache.stats(),
+        "llm": llm_cache.cache.stats(),
+        "houses": houses_composer.composer.stats(LLM_MODEL),
+    }
+
+@app.get("/metrics")
+def prometheus_metrics():
+    """Prometheus 文字格式的指標（階段耗時、快取命中、LLM token 與錯誤計數）"""
+    return PlainTextResponse(metrics.registry.render(), media_type="text/plain; version=0.0.4")
+
+@app.get("/llm/stats")
+def llm_stats():
+    """LLM 保護層狀態（並發上限、排隊數、斷路器）"""
+    return llm_gateway.gateway.stats()
+
+@app.get("/admission/stats")
+def admission_stats():
+    """准入控制狀態（處理中、排隊中、LLM 積壓與是否降級）"""
+    return admission.controller.stats()
+
+@app.get("/singleflight/stats")
+def singleflight_stats():
+    """相同請求合併：進行中的計算數、等待者數，以及累計的 leader / coalesced / abandoned 次數"""
+    return singleflight.stats()
+
+@app.get("/executor/stats")
+def executor_stats():
+    """星盤計算執行層狀態（含排隊深度）"""
+    return chart_executor.stats()
+
+@app.post("/charts/batch")
+def charts_batch(req: BatchRequest):
+    """
+    批次計算星盤與八字（不呼叫 AI），以 NDJSON 串流逐筆返回
+    每行：{"id": ..., "chart": {...}, "bazi": {...}}，失敗時該行帶 "error"
+    """
+    records = (r.model_dump(exclude={"regenerate"}) for r in req.records)
+
+    def lines():
+        for result in engine.calculate_positions_batch(records, executor=chart_executor.pool):
+            yield json.dumps(result, ensure_ascii=False) + "\n"
+
+    return StreamingResponse(lines(), media_type="application/x-ndjson")
+
+@app.post("/analytics/elements")
+def cohort_element_stats(req: CohortStatsRequest):
+    """族群元素統計：整批向量化計算，回傳各分組的星座 / 四元素 / 五行直方圖"""
+    return analytics.element_stats(req.timestamps, req.lat, req.lon, req.time_unknown, req.cohorts, req.tz_offset)
+
+@app.post("/compatibility/candidates")
+def compatibility_add(req: BatchRequest):
+    """
+    新增或更新配對候選人（每筆需帶 id；id 已存在時覆寫）
+    整批向量化計算配對特徵後併入記憶體中的候選人矩陣
+    """
+    records = [r.model_dump() for r in req.records if r.id]
+    if not records:
+        return {"added": 0, "updated": 0, "skipped": len(req.records), **compatibility.store.stats()}
+    features = compatibility.chart_features(*compatibility.records_to_arrays(records))
+    added, updated = compatibility.store.add([r["id"] for r in records], features)
+    return {"added": added, "updated": updated, "skipped": len(req.records) - len(records),
+            **compatibility.store.stats()}
+
+@app.post("/compatibility/candidates/remove")
+def compatibility_remove(req: CompatibilityRemoveRequest):
+    """移除配對候選人"""
+    return {"removed": compatibility.store.remove(req.ids), **compatibility.store.stats()}
+
+@app.post("/compatibility/rank")
+def compatibility_rank(req: CompatibilityRankRequest):
+    """
+    以查詢者的出生資料對所有候選人一次向量化評分，返回前 top_k 名
+    score = aspects（跨盤相位）+ 2 × elements（四元素互補）+ 2 × wuxing（五行互補與日主生剋）
+    """
+    with logs.stage("compatibility"):
+        query = [f[0] for f in compatibility.chart_features(*compatibility.records_to_arrays([req.model_dump()]))]
+        results = compatibility.store.rank(query, max(1, min(req.top_k, 100)), req.exclude_id)
+    return {"candidates": compatibility.store.size, "results": results}
+
+@app.get("/compatibility/stats")
+def compatibility_stats():
+    """配對候選人矩陣的大小"""
+    return compatibility.store.stats()
+
+async def _prepare_chart(req: ChartRequest):
+    """計算星盤與八字（在執行層的子行程中進行），回傳 (chart, {段落: 摘要})"""
+    with logs.stage("chart"):
+        chart = await chart_executor.run_cached(
+            engine.calculate_positions,
+            req.year, req.month, req.day, req.hour, req.minute, req.lat, req.lon, req.is_time_unknown,
+            req.bazi_time_policy, req.tz_offset
+        )
+    logger.debug("chart computed: %s", chart)
+    return chart, _build_summaries(chart, req.is_time_unknown)
+
+def _build_summaries(chart, is_time_unknown):
+    """
+    組出各段落給 AI 閱讀的星盤摘要 {段落: 摘要}
+    每個段落只讀取需要的部分，補上出生時間或改城市後摘要沒變的段落會直接命中 llm_cache：
+      attachment_analysis  行星星座 + 年、月、日柱（不含上升與時柱）
+      deep_analysis        完整摘要
+      houses_analysis      上升 + 宮位配置
+    """
     w = chart['western']['planets']
-    
+    chinese = chart['chinese']
+
+    # 八字文字（計算失敗時四柱為空字串）
+    if all(chinese['bazi_text']):
+        bazi_text = bazi_engine.format_bazi_text(chinese['bazi_text'], is_time_unknown)
+    else:
+        bazi_text = "八字計算失敗"
+
     # 準備宮位數據（用於宮位分析）
     houses_info = ""
-    if chart.get('western', {}).get('houses'):
+    if chart['western'].get('houses'):
         houses_list = []
         for h in chart['western']['houses']:
             houses_list.append(f"第{h['house']}宮 {h['sign']}")
         houses_info = f"\n宮位配置：{', '.join(houses_list)}。"
-    
-    summary = (
-        f"用戶星盤資料：\n"
-        f"太陽{w['sun']['sign']}, 月亮{w['moon']['sign']}, 上升{chart['western']['rising']}。\n"
-        f"金星{w['venus']['sign']}, 火星{w['mars']['sign']}, 土星{w['saturn']['sign']}。\n"
-        f"八字：{bazi_text}。\n"
-        f"五行能量：{chart['chinese'].get('five_elements', 'N/A')}。"
-        f"{houses_info}"
-    )
 
-    # --- D. 定義 AI 提示詞 ---
-    # 1. 依戀模式分析提示詞（300字，心理學角度）
-    attachment_prompt = """
-    你是專業的心理學分析師，根據星盤數據分析用戶的依戀模式。
-
-    【任務】
-    根據用戶的星盤（特別是月亮、土星、金星的位置和相位），分析其依戀類型傾向。
-
-    【要求 - 嚴格執行】
-    1. 字數：約 300 字
-    2. 風格：語言淺白，一針見血，不要廢話，不要解釋
-    3. 禁止建議：絕對不要寫「建議你...」、「你可以試著...」、「你應該...」
-    4. 禁止解釋：不要解釋「什麼是依戀類型」、「什麼是安全型依戀」，直接分析
-    5. 必須判定：將用戶歸類為以下四者之一，並用粗體標示：
-       - **安全型依戀 (Secure)**
-       - **焦慮型依戀 (Anxious)**
-       - **逃避型依戀 (Avoidant)**
-       - **恐懼-逃避型依戀 (Fearful-Avoidant)**
-    
-    6. 分析角度：從心理學角度分析其在親密關係中的表現、情感模式、防禦機制
-    7. 語言風格：
-       - 淺白：用簡單直白的語言
-       - 一針見血：直接說重點
-       - 不要廢話：不要說「一般來說」、「通常」、「可能」
-       - 直接描述：用「你在關係中...」、「你會...」、「你總是...」
-
-    【輸出格式】
-    直接輸出分析內容，不要標題，不要 Markdown 格式，純文字即可。
+    if all(chinese['bazi_text'][:3]):
+        day_pillars = f"{chinese['bazi_text'][0]}年 {chinese['bazi_text'][1]}月 {chinese['bazi_text'][2]}日（日主{chinese['day_master']}）"
+    else:
+        day_pillars = "八字計算失敗"
+
+    return {
+        "attachment_analysis": (
+            f"用戶星盤資料：\n"
+            f"太陽{w['sun']['sign']}, 月亮{w['moon']['sign']}。\n"
+            f"金星{w['venus']['sign']}, 火星{w['mars']['sign']}, 土星{w['saturn']['sign']}。\n"
+            f"八字：{day_pillars}。"
+        ),
+        "deep_analysis": (
+            f"用戶星盤資料：\n"
+            f"太陽{w['sun']['sign']}, 月亮{w['moon']['sign']}, 上升{chart['western']['rising']}。\n"
+            f"金星{w['venus']['sign']}, 火星{w['mars']['sign']}, 土星{w['saturn']['sign']}。\n"
+            f"八字：{bazi_text}。\n"
+            f"五行能量：{chinese['five_elements']}。"
+            f"{houses_info}"
+        ),
+        "houses_analysis": f"用戶星盤資料：\n上升{chart['western']['rising']}。{houses_info}",
+    }
+
+
+async def _generate_section(name, system_prompt, summary, temperature, max_tokens, use_cache=True, degraded=False):
+    """
+    呼叫 DeepSeek 生成單一段落，回傳 (內容, 例外)；失敗只影響該段落
+    degraded=True（准入控制降級）時只使用快取，未命中回傳 (None, None)
+    """
+    cache_key = llm_cache.make_key(system_prompt, summary, LLM_MODEL, temperature, max_tokens)
+    if use_cache:
+        cached = llm_cache.cache.get(cache_key)
+        if cached is not None:
+            logger.debug("section %s served from cache", name)
+            metrics.record_llm(name, "cached")
+            return cached, None
+    if degraded:
+        metrics.record_llm(name, "shed")
+        return None, None
+    try:
+        with logs.stage(f"llm.{name}"):
+            res = await llm_gateway.gateway.complete(name, lambda: get_client().chat.completions.create(
+                model=LLM_MODEL,
+                messages=[
+                    {"role": "system", "content": system_prompt},
+                    {"role": "user", "content": summary}
+                ],
+                temperature=temperature,
+                max_tokens=max_tokens
+            ))
+        content = res.choices[0].message.content
+        metrics.record_llm(name, "ok", getattr(res, "usage", None))
+        llm_cache.cache.set(cache_key, content)
+        return content, None
+    except Exception as e:
+        logger.warning("section %s failed: %s", name, e)
+        metrics.record_llm(name, "error")
+        return None, e
+
+
+async def _generate_combined(sections, summaries, use_cache=True, degraded=False):
+    """
+    GENERATION_MODE=combined：一次呼叫生成多個段落，回傳 {段落: (內容, 例外)}
+    共用規則與完整摘要只送一次；缺少或格式不對的段落退回逐段生成
+    """
+    names = [name for name, *_ in sections]
+    system_prompt = combined.build_prompt(names)
+    summary = summaries["deep_analysis"]  # 完整摘要
+    max_tokens = sum(s[3] for s in sections)
+    cache_key = llm_cache.make_key(system_prompt, summary, LLM_MODEL, combined.TEMPERATURE, max_tokens)
+    text = llm_cache.cache.get(cache_key) if use_cache else None
+    if text is not None:
+        metrics.record_llm("combined", "cached")
+    elif not degraded:
+        try:
+            with logs.stage("llm.combined"):
+                res = await llm_gateway.gateway.complete("combined", lambda: get_client().chat.completions.create(
+                    model=LLM_MODEL,
+                    messages=[
+                        {"role": "system", "content": system_prompt},
+                        {"role": "user", "content": summary}
+                    ],
+                    temperature=combined.TEMPERATURE,
+                    max_tokens=max_tokens
+                ))
+            text = res.choices[0].message.content or ""
+            metrics.record_llm("combined", "ok", getattr(res, "usage", None))
+        except Exception as e:
+            logger.warning("combined generation failed: %s", e)
+            metrics.record_llm("combined", "error")
+
+    parts = combined.split(text or "", names)
+    if len(parts) == len(names):
+        llm_cache.cache.set(cache_key, text)
+    elif text:
+        logger.warning("combined output missing sections: %s", [n for n in names if n not in parts])
+        metrics.record_llm("combined", "malformed")
+    results = {name: (content, None) for name, content in parts.items()}
+    missing = [s for s in sections if s[0] not in parts]
+    fallback = await asyncio.gather(*[
+        _generate_section(name, prompt, summaries[name], temperature, max_tokens,
+                          use_cache=use_cache, degraded=degraded)
+        for name, prompt, temperature, max_tokens in missing
+    ])
+    results.update({name: res for (name, *_), res in zip(missing, fallback)})
+    return results
+
+
+async def _generate_sections(sections, summaries, use_cache=True, degraded=False):
+    """依 GENERATION_MODE 生成各段落，回傳 {段落: (內容, 例外)}"""
+    if combined.MODE == "combined" and len(sections) > 1:
+        return await _generate_combined(sections, summaries, use_cache, degraded)
+    results = await asyncio.gather(*[
+        _generate_section(name, prompt, summaries[name], temperature, max_tokens,
+                          use_cache=use_cache, degraded=degraded)
+        for name, prompt, temperature, max_tokens in sections
+    ])
+    return {name: res for (name, *_), res in zip(sections, results)}
+
+
+def _active_sections(chart):
+    """回傳本次需要生成的段落（沒有宮位資料時跳過宮位分析）"""
+    has_houses = bool(chart.get('western', {}).get('houses'))
+    return [s for s in AI_SECTIONS if s[0] != "houses_analysis" or has_houses]
+
+
+@app.post("/charts/diff")
+async def charts_diff(req: ChartDiffRequest):
     """
-    
-    # 2. 星盤深度探索提示詞（1000字，多角度分析）
-    deep_analysis_prompt = """
-    你是現代星盤解說師，風格：語言淺白，一針見血，不要廢話，不需要建議。
-
-    【任務】
-    根據用戶星盤，進行 1000 字左右的深度分析。
-
-    【格式要求】
-    1. 小標題格式：使用【標題】格式標記小標題（例如：【內在靈魂】），這樣前端可以識別並顯示為黃色
-    2. 每個小標題必須獨立一行
-    3. 小標題後空一行再寫內容
-    4. 不要使用其他 Markdown 符號（不要用 ##、**、* 等符號）
-
-    【內容要求 - 極重要，嚴格執行，違反將導致錯誤】
-    1. **禁止建議**：絕對不要寫「建議你...」、「你可以試著...」、「你應該...」
-    
-    2. **禁止名詞解釋（極重要，絕對禁止）**：
-       - 絕對不要說「第X宮代表...」、「XX宮是...」、「XX星座代表...」
-       - 絕對不要說「落入XX座的能量影響你如何...」、「XX座的能量影響你...」
-       - 絕對不要說「第X宮 天秤座」這種標題格式
-       - 絕對不要解釋「什麼是二宮」、「什麼是金星」、「什麼是上升星座」
-       - 絕對不要說「XX宮代表XX領域」、「XX宮是XX的領域」
-       - 直接說結論，直接描述用戶的實際表現
-       - 如果你看到「第12宮 天秤座」這種格式，絕對不要生成解釋性文字
-    
-    3. **宮位分析規則（極重要，嚴格執行）**：
-       - 絕對禁止：不要說「第二宮代表金錢和價值觀」、「第五宮代表創意和戀愛」、「第12宮代表隱藏的情感...」
-       - 絕對禁止：不要說「第12宮 天秤座。落入天秤座的能量影響你如何處理隱藏的情感...」
-       - 必須直接描述：直接說「你在金錢上...」、「你在戀愛中...」、「你在工作中...」、「你在隱藏的情感上...」
-       - 實際模樣：描述用戶在該宮位的實際表現、行為模式、真實狀態
-       - 範例：
-         (X) 錯誤：「第12宮 天秤座。落入天秤座的能量影響你如何處理隱藏的情感、面對過去業力...」
-         (X) 錯誤：「第12宮代表隱藏的情感、潛意識...」
-         (O) 正確：「你在隱藏的情感上：你習慣...，你會...，你總是...」
-         (O) 正確：「你對隱藏的情感處理方式是：你...，你總是...」
-    
-    4. **多角度分析**：
-       - 每個小標題從不同角度出發
-       - 可以是：內在靈魂、處事風格、愛情與慾望、人際博弈、金錢觀、工作模式、情感盲點、防禦機制、真實模樣等
-       - 每次分析的角度要不同，全面描繪這個人
-       - 不要用宮位名稱作為小標題（例如：不要用「第12宮」作為標題）
-    
-    5. **語言風格（極重要）**：
-       - 淺白：用簡單直白的語言，不要用複雜的詞彙
-       - 一針見血：直接說重點，不要繞彎子
-       - 不要廢話：不要說「一般來說」、「通常」、「可能」這種不確定的話
-       - 像在描述一個真實的人：用「你...」、「你會...」、「你總是...」這種直接描述
-       - 不要用「這代表...」、「這意味著...」、「這象徵...」這種解釋性語言
-       - 不要用「影響你如何...」、「影響你的...」這種解釋性語言
-
-    【範例格式】
-    【內在靈魂】
-
-    你外表看似...，其實內心...。你的月亮...，這讓你在...時會...。
-
-    【處事風格】
-
-    你在工作中...，你習慣...，你總是...。
-
-    【輸出】
-    直接輸出分析內容，開頭不要有標題，直接從第一個小標題開始。小標題使用【標題】格式。
+    比較兩次請求（例如補上出生時間、改城市的前後）：
+    inputs 變動的輸入、recompute 需要重算的星盤部分、chart 變動的星盤欄位、
+    sections 摘要有變動而需要重新生成的 AI 段落（其餘段落再次分析時會命中快取）
     """
-    
-    # 3. 宮位分析提示詞（每一宮約100字，直接描述用戶特質）
-    houses_analysis_prompt = """
-    你是現代星盤解說師，風格：語言淺白，一針見血，不要廢話，不需要建議。
-
-    【任務】
-    根據用戶的12個宮位配置，分析用戶在每個宮位的性格特質。每一宮約100字左右。
-
-    【極重要警告 - 違反將導致錯誤】
-    你必須直接描述用戶的實際特質，絕對不要解釋宮位或星座的含義。
-    絕對禁止使用以下任何格式：
-    - 「落入XX座的能量影響你...」
-    - 「落入XX座意味著你...」
-    - 「第X宮代表...」
-    - 「你的...是你...的領域」
-    
-    你只能直接說：「你在...上...」、「你總是...」、「你會...」、「你習慣...」
-
-    【格式要求】
-    1. 使用【標題】格式標記每個宮位（例如：【第1宮】），這樣前端可以識別並顯示為黃色
-    2. 每個小標題必須獨立一行
-    3. 小標題後空一行再寫內容
-    4. 不要使用其他 Markdown 符號
-
-    【內容要求 - 極重要，嚴格執行】
-    1. **禁止建議**：絕對不要寫「建議你...」、「你可以試著...」、「你應該...」
-    
-    2. **禁止解釋宮位含義（極重要，絕對禁止，違反將導致錯誤）**：
-       - 絕對不要說「第X宮代表...」、「XX宮是...」、「XX宮意味著...」
-       - 絕對不要說「落入XX座意味著...」、「XX座在XX宮代表...」
-       - 絕對不要說「落入XX座的能量影響你...」、「XX座的能量影響你如何...」
-       - 絕對不要說「落入XX座的能量影響你對...的定義、對...的追求,以及你如何...」
-       - 絕對不要解釋「什麼是第X宮」、「第X宮的意義是...」
-       - 絕對不要說「第X宮掌管...」、「第X宮主管...」
-       - 絕對不要說「你的...是你...的領域」、「你的...是你...的舞台」
-       - 直接說用戶在這個宮位的實際特質和表現，不要解釋宮位或星座的含義
-    
-    3. **必須直接描述用戶特質（極重要，嚴格執行）**：
-       - 開頭直接說「你在...上...」、「你在...方面...」、「你對...的態度是...」
-       - 用「你總是...」、「你會...」、「你習慣...」、「你傾向於...」這種直接描述
-       - 描述用戶的實際表現、行為模式、性格特質
-       - 每一宮約100字左右
-       - 範例：
-         (X) 錯誤：「第4宮 水瓶座。落入水瓶座的能量影響你對家的定義、對安全感的追求,以及你如何建立內在的情感支撐。你的家庭背景、童年經驗與內在情感基礎,是你回歸自我的避風港。」
-         (X) 錯誤：「第5宮 雙魚座。落入雙魚座意味著你傾向於以這種能量享受生活、表達創意與追求快樂。你在愛情、娛樂與創造活動中的表現方式,是你展現個人魅力與才華的舞台。」
-         (X) 錯誤：「第6宮 白羊座。落入白羊座的能量影響你如何處理日常事務、維護身體健康,以及你在職場中的表現。你的工作態度、健康習慣與服務他人的方式,是你實踐責任與服務的領域。」
-         (O) 正確：「【第4宮】\n\n你對家的定義是...，你對安全感的追求方式是...，你習慣...。你的家庭背景讓你...，你總是...。」
-         (O) 正確：「【第5宮】\n\n你在愛情中...，你在娛樂時...，你在創造活動中...。你總是...，你會...。」
-         (O) 正確：「【第6宮】\n\n你在日常事務上...，你在維護健康時...，你在職場中...。你習慣...，你總是...。」
-    
-    4. **語言風格（極重要）**：
-       - 淺白：用簡單直白的語言，講人話
-       - 一針見血：直接說重點，不要繞彎子
-       - 不要廢話：不要說「一般來說」、「通常」、「可能」
-       - 像在描述一個真實的人：用「你...」、「你會...」、「你總是...」這種直接描述
-       - 不要用「這代表...」、「這意味著...」、「這象徵...」這種解釋性語言
-       - 不要用「影響你如何...」、「影響你對...的定義」這種解釋性語言
-       - 不要用「是你...的領域」、「是你...的舞台」這種解釋性語言
-       - **關鍵**：直接說「你在...上...」，不要說「XX座的能量影響你...」
-
-    【輸出格式】
-    直接輸出分析內容，每個宮位一個【標題】，格式如下：
-
-    【第1宮】
-
-    你在自我形象上...，你總是...，你會...。
-
-    【第2宮】
-
-    你在金錢和價值觀上...，你習慣...，你總是...。
-
-    （依此類推，共12個宮位）
+    def params(r):
+        p = chart_cache.normalize(r.model_dump(exclude={"regenerate"}))
+        p["bazi_time_policy"] = p["bazi_time_policy"] or bazi_engine.DEFAULT_TIME_POLICY
+        return p
+
+    (before, before_summaries), (after, after_summaries) = await asyncio.gather(
+        _prepare_chart(req.before), _prepare_chart(req.after))
+    inputs = chart_diff.changed_inputs(params(req.before), params(req.after))
+    active = {name for name, *_ in _active_sections(after)}
+    return {
+        "inputs": inputs,
+        "recompute": chart_diff.affected_parts(inputs),
+        "chart": chart_diff.diff(before, after),
+        "sections": [name for name in chart_diff.changed_sections(before_summaries, after_summaries) if name in active],
+    }
+
+
+@app.post("/transits")
+async def transits_lookup(req: TransitRequest):
+    """
+    行運：本命行星與共用行運表（天空位置每個時段只算一次，所有使用者共用）之間的相位
+    每個時段回傳 sky（行運行星星座）與 aspects（依誤差排序，applying 表示相位正在形成）
+    時間未知時月亮位置誤差可達 ±7°，不列入本命行星
+    """
+    with logs.stage("chart"):
+        natal = await chart_executor.run_cached(
+            engine.western_planets, req.year, req.month, req.day, req.hour, req.minute, req.tz_offset)
+    planets = {name: p for name, p in natal["planets"].items() if not (req.is_time_unknown and name == "moon")}
+    start, offset = _transit_start(req)
+    with logs.stage("transits"):
+        rows = transits.table.rows(transits.table.day_slots(start, max(1, min(req.days, 31)), offset), offset)
+        slots = transits.transits_for(planets, rows, offset)
+    return {"natal": planets, "slots": slots}
+
+
+def _transit_start(req):
+    """
+    行運的起始日期與劃分日期用的 UTC 偏移：有時區（tz 或 place_id）時取起始日當天的偏移（含夏令時間），
+    否則沿用 tz_offset（省略時為 +8）；req.tz_offset 是出生當時的偏移，不一定等於現在
+    """
+    if req.tz is None:
+        return req.date or datetime.datetime.now(transits.zone(req.tz_offset)).date(), req.tz_offset
+    start = req.date or datetime.datetime.now(zoneinfo.ZoneInfo(req.tz)).date()
+    return start, places.utc_offset(req.tz, start.year, start.month, start.day, 0, 0)
+
+
+@app.get("/transits/stats")
+def transits_stats():
+    """共用行運表狀態"""
+    return transits.table.stats()
+
+
+@app.get("/places/search")
+def places_search(q: str, limit: int = 10):
+    """
+    出生地自動完成（內建離線城市表，中文、英文、簡體與別名皆可，前綴比對）
+    回傳的 id 可直接作為 /analyze 等端點的 place_id，伺服器會代入經緯度與出生當時的時區
+    """
+    with logs.stage("places"):
+        results = places.search(q, max(1, min(limit, 50)))
+    return {"query": q, "results": results}
+
+
+@app.get("/places/stats")
+def places_stats():
+    """地點索引大小"""
+    return places.get_index().stats()
+
+
+def _compose_sections(chart, sections, regenerate):
+    """
+    HOUSES_MODE=composed 時以預先生成的片段組出宮位分析
+    回傳 (已組好的段落 {名稱: 內容}, 仍需 LLM 生成的段落)；片段不齊時全部交給 LLM
+    """
+    houses = chart['western'].get('houses')
+    if not houses or not any(s[0] == "houses_analysis" for s in sections):
+        return {}, sections
+    # 同一組宮位固定選同一個版本；regenerate 時隨機換一個
+    seed = None if regenerate else json.dumps(houses, ensure_ascii=False)
+    text = houses_composer.composer.compose(LLM_MODEL, houses, seed)
+    if text is None:
+        return {}, sections
+    metrics.record_llm("houses_analysis", "composed")
+    return {"houses_analysis": text}, [s for s in sections if s[0] != "houses_analysis"]
+
+
+def _overloaded(e):
+    """准入控制拒絕：503 + Retry-After"""
+    return compact.FastJSONResponse({"error": "伺服器忙碌，請稍後再試"}, status_code=503,
+                                    headers={"Retry-After": str(e.retry_after)})
+
+
+@app.post("/analyze")
+async def analyze_chart(req: ChartRequest, compat: bool = True, fields: str | None = None):
+    """
+    compat=false：不返回重複的 ai_report，chart 改用精簡版（見 GET /schema/compact）
+    fields：只返回指定的頂層欄位，例如 fields=chart,deep_analysis
+    伺服器過載時回 503 + Retry-After；LLM 積壓時降級（degraded=true，只返回星盤與已快取的段落）
+    內容相同的請求同時送達時只計算一次，結果共用（singleflight）
     """
-    
-    # --- E. 呼叫 DeepSeek AI ---
-    # 最終檢查：確保 five_elements 存在且格式正確（中文）
-    if 'chinese' not in chart:
-        chart['chinese'] = {}
-    
-    # 強制確保 five_elements 是中文格式
-    if 'five_elements' not in chart['chinese']:
-        chart['chinese']['five_elements'] = {"金": 0, "木": 0, "水": 0, "火": 0, "土": 0}
-    else:
-        # 如果存在但格式不對（可能是英文格式），轉換或重新設置
-        fe = chart['chinese']['five_elements']
-        # 檢查是否是英文格式
-        if 'Metal' in fe or 'Wood' in fe or 'Water' in fe or 'Fire' in fe or 'Earth' in fe:
-            # 是英文格式，重新設置為中文格式
-            chart['chinese']['five_elements'] = {"金": 0, "木": 0, "水": 0, "火": 0, "土": 0}
-        # 確保所有中文鍵都存在
-        required_keys = ["金", "木", "水", "火", "土"]
-        for key in required_keys:
-            if key not in chart['chinese']['five_elements']:
-                chart['chinese']['five_elements'][key] = 0
-    
-    print(f"[DEBUG] 返回前的完整 chart 結構: {chart}")  # 調試日誌
-    print(f"[DEBUG] 返回前的 chart['chinese']: {chart.get('chinese')}")  # 調試日誌
-    print(f"[DEBUG] 返回前的 chart['chinese']['five_elements']: {chart['chinese'].get('five_elements')}")  # 調試日誌
-    
     try:
-        # 1. 生成依戀模式分析（300字，心理學角度）
-        attachment_res = client.chat.completions.create(
-            model="deepseek-chat",
-            messages=[
-                {"role": "system", "content": attachment_prompt}, 
-                {"role": "user", "content": summary}
-            ],
-            temperature=1.0,
-            max_tokens=500
-        )
-        attachment_analysis = attachment_res.choices[0].message.content
-        
-        # 2. 生成星盤深度探索（1000字，多角度分析）
-        deep_res = client.chat.completions.create(
-            model="deepseek-chat",
-            messages=[
-                {"role": "system", "content": deep_analysis_prompt}, 
-                {"role": "user", "content": summary}
-            ],
-            temperature=1.3,
-            max_tokens=2000
+        data = await singleflight.analyze.do(_flight_key(req), lambda flight: _analyze_admitted(req))
+    except admission.Overloaded as e:
+        return _overloaded(e)
+    with logs.stage("serialize"):
+        # 結果由合併的請求共用，先複製再依各自的查詢參數調整
+        return compact.FastJSONResponse(compact.shape_response(dict(data), compat, fields))
+
+
+def _flight_key(req):
+    """合併用的鍵：地點與時區已換算為 lat / lon / tz_offset，place_id 或 tz 的寫法不同也視為相同請求"""
+    return singleflight.make_key(chart_cache.normalize(req.model_dump(exclude={"place_id", "tz"})))
+
+
+async def _analyze_admitted(req):
+    ticket = await admission.controller.acquire()
+    try:
+        return await _analyze(req, ticket.degraded)
+    finally:
+        ticket.release()
+
+
+async def _analyze(req, degraded):
+    """完整分析（星盤 + AI 段落），回傳未調整欄位的回應內容"""
+    chart, summaries = await _prepare_chart(req)
+
+    # --- 呼叫 DeepSeek AI：三個段落同時生成，延遲約等於最慢的一個 ---
+    composed, sections = _compose_sections(chart, _active_sections(chart), req.regenerate)
+    generated = {name: (text, None) for name, text in composed.items()}
+    generated.update(await _generate_sections(sections, summaries, use_cache=not req.regenerate, degraded=degraded))
+
+    attachment_analysis, attachment_err = generated.get("attachment_analysis", (None, None))
+    deep_analysis, deep_err = generated.get("deep_analysis", (None, None))
+    houses_analysis, _ = generated.get("houses_analysis", (None, None))
+
+    # 為了向後兼容，同時返回 ai_report（使用 deep_analysis 的內容）
+    final_response = {
+        "chart": chart,
+        "attachment_analysis": attachment_analysis,  # 依戀模式分析（300字）
+        "deep_analysis": deep_analysis,  # 星盤深度探索（1000字）
+        "houses_analysis": houses_analysis,  # 宮位分析（每一宮約100字，共12宮）
+        "ai_report": deep_analysis  # 向後兼容：使用 deep_analysis 的內容
+    }
+    if degraded:
+        final_response["degraded"] = True  # 過載降級：AI 段落稍後重試即可取得
+
+    # 依戀或深度分析失敗時，仍返回 chart 及其他成功的段落，並附上錯誤資訊
+    err = attachment_err or deep_err
+    if err is not None:
+        final_response["error"] = str(err)
+        final_response["traceback"] = "".join(traceback.format_exception(type(err), err, err.__traceback__))
+    return final_response
+
+
+# ==========================================
+# 5. 非同步工作版本（適合行動網路：斷線重送不會重複生成）
+# ==========================================
+async def _run_job(sections, summaries, regenerate, job):
+    """背景 worker 執行：各段落同時生成，每完成一段就寫回工作，輪詢時可看到部分結果"""
+    if combined.MODE == "combined" and len(sections) > 1:
+        # 合併模式一次取得所有段落
+        for name, (content, err) in (await _generate_combined(sections, summaries, not regenerate)).items():
+            job.set_section(name, content, err)
+        return
+
+    async def run(name, prompt, temperature, max_tokens):
+        content, err = await _generate_section(name, prompt, summaries[name], temperature, max_tokens,
+                                               use_cache=not regenerate)
+        job.set_section(name, content, err)
+
+    await asyncio.gather(*[run(*section) for section in sections])
+
+
+def _job_response(job, status_code=200, compat=True, fields=None):
+    """工作狀態；段落內容另以 /analyze 相同的欄位名稱平鋪，方便沿用既有的前端解析"""
+    data = job.to_dict()
+    for name, section in job.sections.items():
+        data[name] = section["content"]
+    data["ai_report"] = data.get("deep_analysis")
+    if fields:
+        fields += ",job_id,status"
+    return compact.FastJSONResponse(compact.shape_response(data, compat, fields), status_code=status_code)
+
+
+@app.post("/analyze/jobs")
+async def create_analyze_job(req: ChartRequest, idempotency_key: str | None = Header(None),
+                             compat: bool = True, fields: str | None = None):
+    """
+    建立分析工作：立即回傳 job_id 與星盤（202），AI 段落在背景生成
+    帶相同 Idempotency-Key 重送時接回原本的工作（200），不重新計算
+    """
+    fingerprint = jobs.fingerprint(req.model_dump())
+    try:
+        job = jobs.manager.find(idempotency_key, fingerprint)
+        if job is not None:
+            return _job_response(job, compat=compat, fields=fields)
+        chart, summaries = await _prepare_chart(req)
+        # 計算星盤期間可能已有相同 Idempotency-Key 的重送建立了工作
+        job = jobs.manager.find(idempotency_key, fingerprint)
+        if job is not None:
+            return _job_response(job, compat=compat, fields=fields)
+        active = _active_sections(chart)
+        composed, sections = _compose_sections(chart, active, req.regenerate)
+        job = jobs.manager.submit(
+            idempotency_key, fingerprint, chart, [name for name, *_ in active],
+            functools.partial(_run_job, sections, summaries, req.regenerate)
         )
-        deep_analysis = deep_res.choices[0].message.content
-        
-        # 3. 生成宮位分析（每一宮約100字，共12宮）
-        houses_analysis = None
-        if chart.get('western', {}).get('houses') and len(chart['western']['houses']) > 0:
-            try:
-                houses_res = client.chat.completions.create(
-                    model="deepseek-chat",
+        for name, text in composed.items():
+            job.set_section(name, text)
+    except jobs.IdempotencyConflict:
+        return compact.FastJSONResponse({"error": "Idempotency-Key 已用於不同的請求內容"}, status_code=409)
+    except jobs.JobQueueFull:
+        return compact.FastJSONResponse({"error": "工作佇列已滿，請稍後再試"}, status_code=503, headers={"Retry-After": "10"})
+    return _job_response(job, status_code=202, compat=compat, fields=fields)
+
+
+@app.get("/analyze/jobs/{job_id}")
+def get_analyze_job(job_id: str, compat: bool = True, fields: str | None = None):
+    """查詢工作：status 為 queued / running / done，sections 內含各段落的狀態與內容"""
+    job = jobs.manager.get(job_id)
+    if job is None:
+        return compact.FastJSONResponse({"error": "找不到工作（可能已超過保留時間）"}, status_code=404)
+    return _job_response(job, compat=compat, fields=fields)
+
+
+@app.get("/analyze/jobs")
+def analyze_jobs_stats():
+    """背景工作統計"""
+    return jobs.manager.stats()
+
+
+# ==========================================
+# 6. 串流版本 (Server-Sent Events)
+# ==========================================
+def _sse(event, data):
+    """組成一筆 SSE 訊息"""
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+async def _stream_section(name, system_prompt, summary, temperature, max_tokens, queue, use_cache=True,
+                          degraded=False):
+    """以 stream=True 生成單一段落，逐個 token 推入 queue；失敗只影響該段落（degraded 時只使用快取）"""
+    cache_key = llm_cache.make_key(system_prompt, summary, LLM_MODEL, temperature, max_tokens)
+    if use_cache:
+        cached = llm_cache.cache.get(cache_key)
+        if cached is not None:
+            # 快取命中：整段一次送出
+            logger.debug("section %s served from cache", name)
+            metrics.record_llm(name, "cached")
+            await queue.put(("delta", {"section": name, "delta": cached}))
+            await queue.put(("section_done", {"section": name}))
+            return
+    if degraded:
+        metrics.record_llm(name, "shed")
+        await queue.put(("section_error", {"section": name, "error": "伺服器忙碌，暫不生成"}))
+        return
+    try:
+        with logs.stage(f"llm.{name}"):
+            async with llm_gateway.gateway.stream(name, lambda: get_client().chat.completions.create(
+                    model=LLM_MODEL,
                     messages=[
-                        {"role": "system", "content": houses_analysis_prompt}, 
+                        {"role": "system", "content": system_prompt},
                         {"role": "user", "content": summary}
                     ],
-                    temperature=1.2,
-                    max_tokens=2000
-                )
-                houses_analysis = houses_res.choices[0].message.content
-            except Exception as e:
-                print(f"[DEBUG] 宮位分析生成失敗: {e}")
-                houses_analysis = None
-        
-        # 返回前最後一次驗證數據結構 - 確保五行能量數據正確（強制中文格式）
-        if 'chinese' not in chart:
-            chart['chinese'] = {}
-        
-        # 強制檢查並轉換為中文格式
-        fe = chart['chinese'].get('five_elements', {})
-        
-        # 檢查是否是英文格式（Metal, Wood, Water, Fire, Earth）
-        is_english_format = False
-        if isinstance(fe, dict):
-            english_keys = ['Metal', 'Wood', 'Water', 'Fire', 'Earth']
-            if any(key in fe for key in english_keys):
-                is_english_format = True
-                print(f"[DEBUG] 檢測到英文格式的 five_elements: {fe}")
-        
-        # 如果是英文格式或不存在，重新設置為中文格式
-        if is_english_format or not isinstance(fe, dict) or 'five_elements' not in chart['chinese']:
-            # 如果 bazi_engine 已經計算過，應該已經設置了中文格式
-            # 但為了安全，我們再次確保是中文格式
-            if not is_english_format and isinstance(fe, dict) and any(k in fe for k in ["金", "木", "水", "火", "土"]):
-                # 已經是中文格式，只需要確保所有鍵都存在
-                required_keys = ["金", "木", "水", "火", "土"]
-                for key in required_keys:
-                    if key not in chart['chinese']['five_elements']:
-                        chart['chinese']['five_elements'][key] = 0
-                    # 確保值是數字
-                    if not isinstance(chart['chinese']['five_elements'][key], (int, float)):
-                        chart['chinese']['five_elements'][key] = 0
+                    temperature=temperature,
+                    max_tokens=max_tokens,
+                    stream=True,
+                    stream_options={"include_usage": True}  # 最後一個 chunk 附帶 token 用量
+            )) as stream:
+                parts = []
+                usage = None
+                async for chunk in stream:
+                    if getattr(chunk, "usage", None) is not None:
+                        usage = chunk.usage
+                    if not chunk.choices:
+                        continue
+                    delta = chunk.choices[0].delta.content
+                    if delta:
+                        parts.append(delta)
+                        await queue.put(("delta", {"section": name, "delta": delta}))
+        metrics.record_llm(name, "ok", usage)
+        llm_cache.cache.set(cache_key, "".join(parts))
+        await queue.put(("section_done", {"section": name}))
+    except Exception as e:
+        logger.warning("section %s stream failed: %s", name, e)
+        metrics.record_llm(name, "error")
+        await queue.put(("section_error", {"section": name, "error": str(e)}))
+
+
+async def _stream_combined(sections, summaries, queue, use_cache=True, degraded=False):
+    """
+    合併模式的串流：一次串流呼叫，依 <<<段落>>> 標記把 token 分送到各段落
+    每個段落只會收到一個結束事件；沒收到內容的段落在最後退回逐段串流，中途斷線的段落回報 section_error
+    """
+    names = [name for name, *_ in sections]
+    system_prompt = combined.build_prompt(names)
+    summary = summaries["deep_analysis"]
+    max_tokens = sum(s[3] for s in sections)
+    cache_key = llm_cache.make_key(system_prompt, summary, LLM_MODEL, combined.TEMPERATURE, max_tokens)
+    finished = set()
+
+    cached = llm_cache.cache.get(cache_key) if use_cache else None
+    if cached is not None:
+        metrics.record_llm("combined", "cached")
+        for name, content in combined.split(cached, names).items():
+            await queue.put(("delta", {"section": name, "delta": content}))
+            await queue.put(("section_done", {"section": name}))
+            finished.add(name)
+    elif not degraded:
+        splitter = combined.StreamSplitter(names)
+        received = {name: [] for name in names}
+        raw = []
+        current = None
+
+        async def close(name):
+            # 有內容的段落才算完成，空段落留給最後的退回機制
+            if name is not None and "".join(received[name]).strip():
+                await queue.put(("section_done", {"section": name}))
+                finished.add(name)
+
+        async def dispatch(events):
+            nonlocal current
+            for name, text in events:
+                if text is None:
+                    await close(current)
+                    current = name
+                else:
+                    received[name].append(text)
+                    await queue.put(("delta", {"section": name, "delta": text}))
+
+        try:
+            with logs.stage("llm.combined"):
+                async with llm_gateway.gateway.stream("combined", lambda: get_client().chat.completions.create(
+                        model=LLM_MODEL,
+                        messages=[
+                            {"role": "system", "content": system_prompt},
+                            {"role": "user", "content": summary}
+                        ],
+                        temperature=combined.TEMPERATURE,
+                        max_tokens=max_tokens,
+                        stream=True,
+                        stream_options={"include_usage": True}
+                )) as stream:
+                    usage = None
+                    async for chunk in stream:
+                        if getattr(chunk, "usage", None) is not None:
+                            usage = chunk.usage
+                        if not chunk.choices:
+                            continue
+                        delta = chunk.choices[0].delta.content
+                        if delta:
+                            raw.append(delta)
+                            await dispatch(splitter.feed(delta))
+            await dispatch(splitter.flush())
+            await close(current)
+            metrics.record_llm("combined", "ok", usage)
+            if len(finished) == len(names):
+                llm_cache.cache.set(cache_key, "".join(raw))
             else:
-                # 強制設置為中文格式默認值
-                chart['chinese']['five_elements'] = {"金": 0, "木": 0, "水": 0, "火": 0, "土": 0}
-                print(f"[DEBUG] 強制設置為中文格式默認值")
+                metrics.record_llm("combined", "malformed")
+        except Exception as e:
+            logger.warning("combined stream failed: %s", e)
+            metrics.record_llm("combined", "error")
+            # 已送出部分內容的段落無法收回，以錯誤結束
+            if current is not None and current not in finished and received[current]:
+                await queue.put(("section_error", {"section": current, "error": str(e)}))
+                finished.add(current)
+
+    missing = [s for s in sections if s[0] not in finished]
+    await asyncio.gather(*[
+        _stream_section(name, prompt, summaries[name], temperature, max_tokens, queue,
+                        use_cache=use_cache, degraded=degraded)
+        for name, prompt, temperature, max_tokens in missing
+    ])
+
+
+@app.post("/analyze/stream")
+async def analyze_chart_stream(req: ChartRequest, compat: bool = True):
+    """
+    串流版 /analyze：先送出 chart，再以 delta 事件推送各 AI 段落的 token
+    事件順序：chart → delta / section_done / section_error（多段交錯）→ done（生成中途失敗時改以 error 結束）
+    准入名額保留到串流結束；降級時 chart 事件帶 degraded=true，未快取的段落以 section_error 結束
+    內容相同的串流同時進行時共用同一份生成，後到的請求先重播已送出的事件
+    """
+    subscription = singleflight.analyze_stream.stream(_flight_key(req), lambda flight: _produce_stream(req, flight))
+    try:
+        await subscription.started()
+    except admission.Overloaded as e:
+        subscription.close()
+        return _overloaded(e)
+    except BaseException:
+        subscription.close()
+        raise
+
+    async def event_stream():
+        try:
+            async for event, data in subscription.events():
+                if event == "chart" and not compat:
+                    with logs.stage("serialize"):
+                        data = {**data, "chart": compact.compact_chart(data["chart"])}
+                yield _sse(event, data)
+        finally:
+            # 客戶端中途斷線：最後一個離開的請求會取消生成，避免白白消耗 token
+            subscription.close()
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+        background=BackgroundTask(subscription.close)  # 串流未開始就斷線時也離開（close 可重複呼叫）
+    )
+
+
+async def _produce_stream(req, flight):
+    """串流的實際生成：事件發布到 flight，由所有相同請求的串流共用；准入名額保留到生成結束"""
+    ticket = await admission.controller.acquire()
+    tasks = []
+    try:
+        chart, summaries = await _prepare_chart(req)
+        active = _active_sections(chart)
+        composed, sections = _compose_sections(chart, active, req.regenerate)
+
+        first = {"chart": chart, "sections": [name for name, *_ in active]}
+        if ticket.degraded:
+            first["degraded"] = True
+        flight.publish("chart", first)
+
+        # 已組好的段落整段一次送出
+        for name, text in composed.items():
+            flight.publish("delta", {"section": name, "delta": text})
+            flight.publish("section_done", {"section": name})
+
+        queue = asyncio.Queue()
+        if combined.MODE == "combined" and len(sections) > 1:
+            tasks = [asyncio.create_task(_stream_combined(
+                sections, summaries, queue, use_cache=not req.regenerate, degraded=ticket.degraded
+            ))]
         else:
-            # 確保所有中文鍵都存在且為數字
-            required_keys = ["金", "木", "水", "火", "土"]
-            for key in required_keys:
-                if key not in chart['chinese']['five_elements']:
-                    chart['chinese']['five_elements'][key] = 0
-                # 確保值是數字
-                if not isinstance(chart['chinese']['five_elements'][key], (int, float)):
-                    chart['chinese']['five_elements'][key] = 0
-        
-        print(f"[DEBUG] 最終驗證後的 five_elements: {chart['chinese'].get('five_elements')}")
-        print(f"[DEBUG] five_elements 類型: {type(chart['chinese'].get('five_elements'))}")
-        print(f"[DEBUG] five_elements 鍵: {list(chart['chinese'].get('five_elements', {}).keys())}")
-        
-        # 返回前最後一次驗證數據結構
-        # 為了向後兼容，同時返回 ai_report（使用 deep_analysis 的內容）
-        final_response = {
-            "chart": chart, 
-            "attachment_analysis": attachment_analysis,  # 依戀模式分析（300字）
-            "deep_analysis": deep_analysis,  # 星盤深度探索（1000字）
-            "houses_analysis": houses_analysis,  # 宮位分析（每一宮約100字，共12宮）
-            "ai_report": deep_analysis  # 向後兼容：使用 deep_analysis 的內容
-        }
-        print(f"[DEBUG] 最終返回的 chart.chinese.five_elements: {final_response['chart'].get('chinese', {}).get('five_elements', 'NOT FOUND')}")
-        print(f"[DEBUG] 最終返回的完整 chart.chinese: {final_response['chart'].get('chinese', {})}")
-        return final_response
+            tasks = [
+                asyncio.create_task(_stream_section(
+                    name, prompt, summaries[name], temperature, max_tokens, queue,
+                    use_cache=not req.regenerate, degraded=ticket.degraded
+                ))
+                for name, prompt, temperature, max_tokens in sections
+            ]
+        remaining = len(sections)  # 每個段落各有一個 section_done 或 section_error
+        while remaining:
+            event, data = await queue.get()
+            if event in ("section_done", "section_error"):
+                remaining -= 1
+            flight.publish(event, data)
+        flight.publish("done", {})
     except Exception as e:
-        # 即使 AI 調用失敗，也要確保返回正確的 chart 數據
-        print(f"[DEBUG] AI 調用失敗，但返回 chart: {chart.get('chinese', {}).get('five_elements', 'NOT FOUND')}")
-        import traceback
-        return {
-            "chart": chart, 
-            "attachment_analysis": None, 
-            "deep_analysis": None,
-            "houses_analysis": None,
-            "error": str(e),
-            "traceback": traceback.format_exc()
-        }
\ No newline at end of file
+        if not flight.events:
+            raise  # 還沒送出任何事件（例如准入被拒）：由 Subscription.started() 轉成一般的錯誤回應
+        # 串流已開始：所有訂閱者都以 error 事件收尾，不留下沒有結束事件的串流
+        logger.exception("stream generation failed")
+        flight.publish("error", {"error": str(e)})
+    finally:
+        # 等取消真正完成（各段落的上游串流關閉）後才還准入名額
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        ticket.release()
+
+
+startup.state.imports_done()
@@ -0,0 +1,209 @@
+# 檔案名稱: metrics.py
+# Prometheus 文字格式的指標（不依賴外部套件或服務），由 /metrics 輸出
+#   - 各階段耗時直方圖（western、bazi、chart、llm.<段落>、serialize）
+#   - HTTP 請求數 / 耗時、進行中請求數
+#   - 快取命中、執行層排隊、LLM token 與錯誤計數
+# 注意：每個 uvicorn worker 各自計數，多 worker 部署時由 Prometheus 端加總
+import threading
+import time
+
+import logs
+
+# 預設 bucket（秒）：涵蓋查表級的毫秒到 LLM 的數十秒
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 20.0, 40.0, 80.0)
+
+
+def _format_labels(names, values, extra=""):
+    parts = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name, help_text, labels=()):
+        self.name = name
+        self.help = help_text
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def header(self):
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, *label_values, amount=1):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def render(self):
+        lines = self.header()
+        for key, value in sorted(self._values.items()):
+            lines.append(f"{self.name}{_format_labels(self.labels, key)} {_format_value(value)}")
+        return lines
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def set(self, *label_values, value):
+        with self._lock:
+            self._values[label_values] = value
+
+    def dec(self, *label_values, amount=1):
+        self.inc(*label_values, amount=-amount)
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help_text, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help_text, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, *label_values, value):
+        with self._lock:
+            entry = self._values.get(label_values)
+            if entry is None:
+                entry = self._values[label_values] = [[0] * len(self.buckets), 0.0, 0]
+            counts = entry[0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            entry[1] += value
+            entry[2] += 1
+
+    def render(self):
+        lines = self.header()
+        for key, (counts, total, count) in sorted(self._values.items()):
+            cumulative = 0
+            for bound, c in zip(self.buckets, counts):
+                cumulative += c
+                labels = _format_labels(self.labels, key, f'le="{_format_value(float(bound))}"')
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            inf_labels = _format_labels(self.labels, key, 'le="+Inf"')
+            lines.append(f"{self.name}_bucket{inf_labels} {count}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labels, key)} {_format_value(total)}")
+            lines.append(f"{self.name}_count{_format_labels(self.labels, key)} {count}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+        self.collectors = []  # 輸出前呼叫，用來同步外部模組的狀態（快取、執行層）
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        for collect in self.collectors:
+            collect()
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+http_requests = registry.register(Counter(
+    "star_http_requests_total", "HTTP requests by route and status", ("route", "status")))
+http_duration = registry.register(Histogram(
+    "star_http_request_duration_seconds", "HTTP request duration including streamed body", ("route",)))
+http_in_flight = registry.register(Gauge(
+    "star_http_requests_in_flight", "HTTP requests currently being served"))
+stage_duration = registry.register(Histogram(
+    "star_stage_duration_seconds", "Per-request stage duration (western, bazi, chart, llm.<section>, serialize)", ("stage",)))
+llm_requests = registry.register(Counter(
+    "star_llm_requests_total", "LLM section generations by outcome (ok, error, cached, composed, shed)", ("section", "outcome")))
+llm_tokens = registry.register(Counter(
+    "star_llm_tokens_total", "LLM tokens reported in completion usage", ("section", "kind")))
+cache_lookups = registry.register(Gauge(
+    "star_cache_lookups", "Cache lookups by cache and result since process start", ("cache", "result")))
+cache_hit_ratio = registry.register(Gauge(
+    "star_cache_hit_ratio", "Cache hit ratio since process start", ("cache",)))
+executor_in_flight = registry.register(Gauge(
+    "star_executor_in_flight", "Chart computations submitted to the executor and not yet finished"))
+executor_queue_depth = registry.register(Gauge(
+    "star_executor_queue_depth", "Chart computations waiting for a free worker process"))
+
+
+def record_llm(section, outcome, usage=None):
+    """記錄一次段落生成的結果與 token 用量（usage 為 OpenAI 回應的 usage 欄位）"""
+    llm_requests.inc(section, outcome)
+    if usage is not None:
+        llm_tokens.inc(section, "prompt", amount=usage.prompt_tokens or 0)
+        llm_tokens.inc(section, "completion", amount=usage.completion_tokens or 0)
+
+
+def _collect_caches():
+    import chart_cache
+    import llm_cache
+    for name, cache in (("chart", chart_cache.cache), ("llm", llm_cache.cache)):
+        hits = cache.hits + getattr(cache, "disk_hits", 0)
+        cache_lookups.set(name, "hit", value=hits)
+        cache_lookups.set(name, "miss", value=cache.misses)
+        lookups = hits + cache.misses
+        cache_hit_ratio.set(name, value=hits / lookups if lookups else 0.0)
+
+
+def _collect_executor():
+    from executor import chart_executor
+    executor_in_flight.set(value=chart_executor.in_flight)
+    executor_queue_depth.set(value=chart_executor.queue_depth)
+
+
+registry.collectors.extend([_collect_caches, _collect_executor])
+
+
+class MetricsMiddleware:
+    """
+    ASGI middleware：記錄請求數、耗時與進行中數量，並把該請求的各階段耗時寫入直方圖
+    須放在 logs.RequestLogMiddleware 內層（先 add_middleware），才讀得到階段計時
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        start = time.perf_counter()
+        status = 500
+
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        http_in_flight.inc()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            http_in_flight.dec()
+            # 以路由樣板作標籤（/analyze/jobs/{job_id}），避免標籤數量無限增長
+            route = getattr(scope.get("route"), "path", None) or "unmatched"
+            http_requests.inc(route, str(status))
+            http_duration.observe(route, value=time.perf_counter() - start)
+            for name, ms in (logs.current_stages() or {}).items():
+                stage_duration.observe(name, value=ms / 1000.0)
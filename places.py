@@ -0,0 +1,270 @@
+# 檔案名稱: places.py
+# 離線出生地資料庫：內建城市表（places.tsv）+ 以 mmap 載入的前綴索引（places.idx）
+#   - /places/search 自動完成：二分搜尋前綴，不必呼叫外部地理編碼服務
+#   - 出生當時的 UTC 偏移：由 zoneinfo 依 IANA 時區換算，含夏令時間與歷史時區變更
+#     （例如台灣 1974–1975、1979 年的日光節約時間，中國 1986–1991 年的夏令時）
+#
+#   PLACES_PATH        城市表（預設與本檔同目錄的 places.tsv）
+#   PLACES_INDEX_PATH  前綴索引檔（預設與城市表同目錄的 places.idx；不存在或與城市表不符時自動重建）
+#
+# 索引格式（小端序）：
+#   標頭 b"PLX1" + uint32 城市表 CRC32 + uint32 鍵數 N
+#   uint32 鍵偏移[N + 1]、uint32 鍵對應的城市序號[N]、鍵內容（正規化後的 UTF-8，依位元組排序）
+# 以 UTF-8 位元組排序時，同一前綴的鍵必定相鄰，找到第一個鍵後往後掃到前綴不符為止
+#
+# 建表：  python places.py build
+# 基準：  python places.py bench --queries 100000
+import bisect
+import csv
+import datetime
+import mmap
+import os
+import struct
+import unicodedata
+import zlib
+import zoneinfo
+
+import logs
+import metrics
+
+logger = logs.get_logger("places")
+
+_HERE = os.path.dirname(os.path.abspath(__file__))
+PLACES_PATH = os.getenv("PLACES_PATH", os.path.join(_HERE, "places.tsv"))
+INDEX_PATH = os.getenv("PLACES_INDEX_PATH", os.path.join(os.path.dirname(PLACES_PATH), "places.idx"))
+
+# 沒有提供時區時沿用原本的 +08:00（東經 120° 標準時）
+DEFAULT_TZ_OFFSET = 8.0
+
+_MAGIC = b"PLX1"
+_HEADER = struct.Struct("<4sII")
+# 單次查詢最多掃描的鍵數（單一字元的前綴可能對應上百個鍵）
+_MAX_SCAN = 2000
+
+_IGNORED = str.maketrans("", "", " -'.,·・()（）")
+_VARIANTS = str.maketrans({"臺": "台"})
+
+
+def normalize(text):
+    """查詢與索引共用的正規化：全形轉半形、去掉重音符號與空白標點、不分大小寫、臺 → 台"""
+    text = unicodedata.normalize("NFKD", text)
+    text = "".join(c for c in text if not unicodedata.combining(c))
+    return unicodedata.normalize("NFKC", text).casefold().translate(_IGNORED).translate(_VARIANTS)
+
+
+def utc_offset(tz, year, month, day, hour=12, minute=0):
+    """
+    IANA 時區在該當地時間的 UTC 偏移（小時）
+    含夏令時間；早於時區制度的日期為地方平時（例如上海 1901 年前為 +08:05:43）
+    夏令時間切換時重複的一小時取較早的一次（fold=0）
+    """
+    try:
+        zone = zoneinfo.ZoneInfo(tz)
+    except (zoneinfo.ZoneInfoNotFoundError, ValueError):
+        raise ValueError(f"未知的時區: {tz}") from None
+    local = datetime.datetime(year, month, day, hour, minute, tzinfo=zone)
+    return local.utcoffset().total_seconds() / 3600.0
+
+
+def load_places(path=PLACES_PATH):
+    """讀取城市表，回傳 (城市列表, 城市表 CRC32)"""
+    with open(path, "rb") as f:
+        raw = f.read()
+    places = []
+    for row in csv.DictReader(raw.decode("utf-8").splitlines(), delimiter="\t"):
+        places.append({
+            "id": row["id"],
+            "name": row["name"],
+            "name_en": row["name_en"],
+            "country": row["country"],
+            "country_name": row["country_name"],
+            "lat": float(row["lat"]),
+            "lon": float(row["lon"]),
+            "tz": row["tz"],
+            "population": int(row["population"]),  # 千人，只用於排序
+            "aliases": [a for a in row["aliases"].split("|") if a],
+        })
+    return places, zlib.crc32(raw)
+
+
+def build_index(places, checksum):
+    """城市列表 → 索引檔內容（bytes）；每個城市以中文名、英文名與別名各建一個鍵"""
+    entries = set()
+    for i, place in enumerate(places):
+        for text in (place["name"], place["name_en"], *place["aliases"]):
+            key = normalize(text).encode("utf-8")
+            if key:
+                entries.add((key, i))
+    entries = sorted(entries)
+    offsets = [0]
+    for key, _ in entries:
+        offsets.append(offsets[-1] + len(key))
+    return b"".join([
+        _HEADER.pack(_MAGIC, checksum, len(entries)),
+        struct.pack(f"<{len(offsets)}I", *offsets),
+        struct.pack(f"<{len(entries)}I", *(i for _, i in entries)),
+        *(key for key, _ in entries),
+    ])
+
+
+class _Keys:
+    """讓 bisect 直接在 mmap 上二分搜尋：第 i 個鍵只在比較時才切出來"""
+
+    def __init__(self, index):
+        self.index = index
+
+    def __len__(self):
+        return self.index.size
+
+    def __getitem__(self, i):
+        return self.index.key(i)
+
+
+class PlaceIndex:
+    def __init__(self, places, buffer):
+        self.places = places
+        self.by_id = {p["id"]: p for p in places}
+        self._names = [(normalize(p["name"]).encode("utf-8"), normalize(p["name_en"]).encode("utf-8"))
+                       for p in places]
+        self._buffer = buffer
+        magic, self.checksum, self.size = _HEADER.unpack_from(buffer, 0)
+        if magic != _MAGIC:
+            raise ValueError("不是地點索引檔")
+        start = _HEADER.size
+        view = memoryview(buffer)
+        self._offsets = view[start:start + 4 * (self.size + 1)].cast("I")
+        start += 4 * (self.size + 1)
+        self._place_ids = view[start:start + 4 * self.size].cast("I")
+        self._blob = start + 4 * self.size
+        self._keys = _Keys(self)
+
+    @classmethod
+    def load(cls, path=PLACES_PATH, index_path=INDEX_PATH):
+        """
+        載入城市表與索引；索引不存在或 CRC32 與城市表不符時重建並寫回
+        （寫入失敗時只保留在記憶體中，例如唯讀的部署目錄）
+        """
+        places, checksum = load_places(path)
+        if os.path.exists(index_path):
+            try:
+                with open(index_path, "rb") as f:
+                    buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:  # 空檔案
+                buffer = None
+            if buffer is not None:
+                if buffer.size() >= _HEADER.size and _HEADER.unpack_from(buffer, 0)[:2] == (_MAGIC, checksum):
+                    return cls(places, buffer)
+                buffer.close()
+        data = build_index(places, checksum)
+        try:
+            tmp = f"{index_path}.{os.getpid()}.tmp"
+            with open(tmp, "wb") as f:
+                f.write(data)
+            os.replace(tmp, index_path)
+            logger.info("places index rebuilt", extra={"fields": {"places": len(places), "bytes": len(data)}})
+        except OSError as e:
+            logger.warning("places index not written (%s), keeping it in memory", e)
+            return cls(places, data)
+        with open(index_path, "rb") as f:
+            return cls(places, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+
+    def key(self, i):
+        return self._buffer[self._blob + self._offsets[i]:self._blob + self._offsets[i + 1]]
+
+    def search(self, query, limit=10):
+        """
+        前綴搜尋：回傳最多 limit 個城市
+        排序：完全符合 → 名稱（中文或英文）符合 → 只有別名符合，同一級依人口由多到少
+        """
+        prefix = normalize(query).encode("utf-8")
+        if not prefix:
+            return []
+        first = bisect.bisect_left(self._keys, prefix)
+        ranks = {}
+        for i in range(first, min(first + _MAX_SCAN, self.size)):
+            key = self.key(i)
+            if not key.startswith(prefix):
+                break
+            place_id = self._place_ids[i]
+            if key == prefix:
+                rank = 0
+            elif any(name.startswith(prefix) for name in self._names[place_id]):
+                rank = 1
+            else:
+                rank = 2
+            ranks[place_id] = min(rank, ranks.get(place_id, rank))
+        ranked = sorted(ranks, key=lambda i: (ranks[i], -self.places[i]["population"]))
+        return [self.places[i] for i in ranked[:limit]]
+
+    def stats(self):
+        return {"places": len(self.places), "keys": self.size, "index_bytes": len(self._buffer)}
+
+
+_index = None
+
+
+def get_index():
+    """第一次使用時載入（lifespan 預熱步驟中呼叫）"""
+    global _index
+    if _index is None:
+        _index = PlaceIndex.load()
+    return _index
+
+
+def get(place_id):
+    """以 id 取得城市，不存在時回傳 None"""
+    return get_index().by_id.get(place_id)
+
+
+def search(query, limit=10):
+    results = get_index().search(query, limit)
+    _searches.inc("hit" if results else "empty")
+    return [public(p) for p in results]
+
+
+def public(place):
+    """回應用的欄位（不含排序用的人口與內部別名）"""
+    return {k: place[k] for k in ("id", "name", "name_en", "country", "country_name", "lat", "lon", "tz")}
+
+
+def bench(queries=100000, seed=0):
+    """以城市名稱的隨機前綴量測單次查詢耗時"""
+    import random
+    import time
+
+    index = get_index()
+    rng = random.Random(seed)
+    names = [p[field] for p in index.places for field in ("name", "name_en")]
+    samples = []
+    for _ in range(queries):
+        name = rng.choice(names)
+        samples.append(name[:rng.randint(1, len(name))])
+    start = time.perf_counter()
+    for q in samples:
+        index.search(q)
+    elapsed = time.perf_counter() - start
+    return {"queries": queries, "places": len(index.places), "keys": index.size,
+            "mean_us": round(elapsed / queries * 1e6, 2)}
+
+
+_searches = metrics.registry.register(metrics.Counter(
+    "star_place_searches_total", "Place autocomplete searches by whether anything matched", ("result",)))
+
+
+if __name__ == "__main__":
+    import argparse
+    import json
+
+    parser = argparse.ArgumentParser(description="離線地點索引工具")
+    sub = parser.add_subparsers(dest="cmd", required=True)
+    sub.add_parser("build")
+    p_bench = sub.add_parser("bench")
+    p_bench.add_argument("--queries", type=int, default=100000)
+    args = parser.parse_args()
+
+    if args.cmd == "build":
+        if os.path.exists(INDEX_PATH):
+            os.remove(INDEX_PATH)
+        print(json.dumps(get_index().stats(), indent=2))
+    else:
+        print(json.dumps(bench(args.queries), indent=2))
@@ -0,0 +1,162 @@
+# 檔案名稱: singleflight.py
+# 相同請求合併（single-flight）：分享到群組、或使用者連點送出時，短時間內會湧入內容完全相同的請求，
+# 每一個都各自排盤並付費呼叫三次 LLM。同一個鍵（正規化後的請求內容）正在計算時，
+# 後到的請求直接等待同一份計算的結果，串流則從頭重播已送出的事件後接著收後續事件
+#
+#   SINGLEFLIGHT_ENABLED  1（預設）| 0（停用，每個請求各自計算）
+#
+# 計算以獨立的 task 執行，第一個請求斷線不影響其他等待者；所有等待者都離開時才取消計算
+# 計算結束（成功或失敗）後立即移除，之後的相同請求照常走快取（chart_cache / llm_cache）
+import asyncio
+import json
+import os
+
+import metrics
+
+ENABLED = os.getenv("SINGLEFLIGHT_ENABLED", "1") not in ("0", "false", "no")
+
+
+def make_key(params):
+    """請求參數（dict）→ 合併用的鍵；呼叫端應先去掉不影響結果的欄位並正規化"""
+    return json.dumps(params, sort_keys=True, ensure_ascii=False)
+
+
+class Flight:
+    """一份進行中的計算；串流時已發布的事件保留在 events，後加入的請求從頭重播"""
+
+    def __init__(self, key):
+        self.key = key
+        self.task = None
+        self.waiters = 0
+        self.events = []
+        self.finished = False
+        self._changed = asyncio.Event()
+
+    def publish(self, event, data):
+        self.events.append((event, data))
+        self._notify()
+
+    def _notify(self):
+        changed, self._changed = self._changed, asyncio.Event()
+        changed.set()
+
+
+class Subscription:
+    """一個串流請求對 Flight 的訂閱；close() 可重複呼叫"""
+
+    def __init__(self, group, flight):
+        self.group = group
+        self.flight = flight
+        self._closed = False
+
+    async def started(self):
+        """
+        等到第一個事件發布；計算在發布任何事件前就失敗時（例如准入被拒）拋出同一個例外，
+        讓呼叫端仍可回一般的錯誤回應而不是空的串流
+        """
+        flight = self.flight
+        while not flight.events and not flight.finished:
+            await flight._changed.wait()
+        if not flight.events:
+            if flight.task.cancelled():
+                raise asyncio.CancelledError()
+            exc = flight.task.exception()
+            if exc is not None:
+                raise exc
+
+    async def events(self):
+        i = 0
+        flight = self.flight
+        while True:
+            while i < len(flight.events):
+                yield flight.events[i]
+                i += 1
+            if flight.finished:
+                return
+            await flight._changed.wait()
+
+    def close(self):
+        if not self._closed:
+            self._closed = True
+            self.group._leave(self.flight)
+
+
+class Group:
+    """同一類請求（例如 /analyze）的合併群組"""
+
+    def __init__(self, name, enabled=ENABLED):
+        self.name = name
+        self.enabled = enabled
+        self._flights = {}
+
+    def _join(self, key, func):
+        flight = self._flights.get(key) if self.enabled else None
+        if flight is None:
+            flight = Flight(key)
+            flight.task = asyncio.ensure_future(func(flight))
+            flight.task.add_done_callback(lambda _: self._finish(flight))
+            if self.enabled:
+                self._flights[key] = flight
+            _requests.inc(self.name, "leader")
+        else:
+            _requests.inc(self.name, "coalesced")
+        flight.waiters += 1
+        return flight
+
+    def _finish(self, flight):
+        flight.finished = True
+        flight._notify()
+        if self._flights.get(flight.key) is flight:
+            del self._flights[flight.key]
+
+    def _leave(self, flight):
+        flight.waiters -= 1
+        if flight.waiters == 0 and not flight.task.done():
+            # 沒有人在等了：取消計算，並立即移除，之後的相同請求重新開始
+            if self._flights.get(flight.key) is flight:
+                del self._flights[flight.key]
+            flight.task.cancel()
+            _requests.inc(self.name, "abandoned")
+
+    async def do(self, key, func):
+        """
+        func(flight) 為 coroutine function；相同 key 的計算進行中時等待同一個結果
+        結果物件由所有等待者共用，呼叫端不可修改（需要時先複製）；例外也一併共用
+        """
+        flight = self._join(key, func)
+        try:
+            return await asyncio.shield(flight.task)
+        finally:
+            self._leave(flight)
+
+    def stream(self, key, produce):
+        """
+        串流版：produce(flight) 以 flight.publish(event, data) 發布事件
+        回傳 Subscription，呼叫端以 events() 逐一取得事件，結束或斷線時務必 close()
+        """
+        return Subscription(self, self._join(key, produce))
+
+    def stats(self):
+        return {
+            "enabled": self.enabled,
+            "in_flight": len(self._flights),
+            "waiters": sum(f.waiters for f in self._flights.values()),
+        }
+
+
+analyze = Group("analyze")
+analyze_stream = Group("analyze_stream")
+
+
+def stats():
+    totals = {}
+    for (group, role), value in _requests._values.items():
+        totals.setdefault(group, {})[role] = value
+    return {group.name: {**group.stats(), **totals.get(group.name, {})} for group in (analyze, analyze_stream)}
+
+
+_requests = metrics.registry.register(metrics.Counter(
+    "star_singleflight_requests_total",
+    "Requests that started a computation (leader), joined an identical in-progress one (coalesced), "
+    "or computations cancelled after every waiter left (abandoned)",
+    ("group", "role")))
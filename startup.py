@@ -0,0 +1,167 @@
+# 檔案名稱: startup.py
+# 冷啟動：重型模組（flatlib、lunar_python、numpy、openai）延遲載入，
+# 改在 lifespan 的預熱步驟中載入並先算一張盤，預熱完成後 /ready 才回報就緒
+#
+#   STARTUP_WARMUP           blocking（預設，預熱完才開始接請求）| background（先接請求，/ready 未就緒前回 503）| off
+#   STARTUP_WARMUP_DATE      預熱用的出生時間（預設 2000-01-01T12:00）
+#   STARTUP_IMPORT_BUDGET_MS import main 的時間預算（預設 600 毫秒，超過時記錄警告）
+#
+# 量測 import 時間（可放進 CI）：
+#   python startup.py check-imports --budget-ms 600
+import asyncio
+import datetime
+import importlib.util
+import os
+import sys
+import time
+
+import logs
+
+IMPORT_STARTED = time.perf_counter()
+
+logger = logs.get_logger("startup")
+
+
+def lazy_import(name):
+    """回傳延遲載入的模組：第一次存取屬性時才真正執行模組內容"""
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.find_spec(name)
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    return module
+
+
+class Startup:
+    """記錄 import 與各預熱步驟的耗時，提供 /ready 的就緒狀態"""
+
+    def __init__(self, mode, warmup_date, import_budget_ms):
+        self.mode = mode
+        self.warmup_date = warmup_date
+        self.import_budget_ms = import_budget_ms
+        self.import_ms = None
+        self.steps = {}
+        self.ready = False
+        self.error = None
+        self._task = None
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            mode=os.getenv("STARTUP_WARMUP", "blocking"),
+            warmup_date=datetime.datetime.fromisoformat(os.getenv("STARTUP_WARMUP_DATE", "2000-01-01T12:00")),
+            import_budget_ms=float(os.getenv("STARTUP_IMPORT_BUDGET_MS", "600")),
+        )
+
+    def imports_done(self):
+        """在 main.py 結尾呼叫：記錄 import 耗時並與預算比較"""
+        self.import_ms = round((time.perf_counter() - IMPORT_STARTED) * 1000, 1)
+        if self.import_ms > self.import_budget_ms:
+            logger.warning("import took %.1f ms (budget %.0f ms)", self.import_ms, self.import_budget_ms)
+
+    async def _step(self, name, func, *args):
+        start = time.perf_counter()
+        result = func(*args)
+        if asyncio.iscoroutine(result):
+            result = await result
+        self.steps[name] = round((time.perf_counter() - start) * 1000, 1)
+        return result
+
+    async def warm_up(self, steps):
+        """依序執行 (名稱, 函式) 預熱步驟；函式可以是一般函式或 coroutine 函式"""
+        start = time.perf_counter()
+        try:
+            for name, func in steps:
+                await self._step(name, func)
+            self.ready = True
+            logger.info("warm-up finished", extra={"fields": {
+                "total_ms": round((time.perf_counter() - start) * 1000, 1),
+                "import_ms": self.import_ms,
+                "steps_ms": self.steps,
+            }})
+        except Exception as e:
+            self.error = str(e)
+            logger.exception("warm-up failed")
+
+    async def start(self, steps):
+        """lifespan 啟動時呼叫；background 模式下不等待預熱完成"""
+        if self.mode == "off":
+            self.ready = True
+        elif self.mode == "background":
+            self._task = asyncio.create_task(self.warm_up(steps))
+        else:
+            await self.warm_up(steps)
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+
+    def status(self):
+        return {
+            "ready": self.ready,
+            "mode": self.mode,
+            "import_ms": self.import_ms,
+            "import_budget_ms": self.import_budget_ms,
+            "warmup_ms": self.steps,
+            "error": self.error,
+        }
+
+
+state = Startup.from_env()
+
+
+def check_imports(module="main", budget_ms=600.0):
+    """在乾淨的子行程中以 -X importtime 量測 import 時間，回傳總耗時與最慢的頂層套件"""
+    import subprocess
+    env = {**os.environ, "DEEPSEEK_API_KEY": os.getenv("DEEPSEEK_API_KEY", "x")}
+    proc = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"],
+                          capture_output=True, text=True, env=env, cwd=os.path.dirname(os.path.abspath(__file__)))
+    if proc.returncode != 0:
+        raise SystemExit(proc.stderr)
+    # -X importtime 先列子模組再列父模組：緊接在目標模組之前的第一層項目就是它直接載入的套件
+    top_level = {}
+    children = {}
+    total_us = 0
+    for line in proc.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, name = line.split("|")
+        if not cumulative.strip().isdigit():
+            continue
+        depth = (len(name) - len(name.lstrip())) // 2
+        if depth == 0:
+            if name.strip() == module:
+                total_us = int(cumulative)
+                top_level = children
+            children = {}
+        elif depth == 1:
+            children[name.strip()] = int(cumulative) / 1000
+    slowest = sorted(top_level.items(), key=lambda kv: kv[1], reverse=True)[:10]
+    total_ms = total_us / 1000
+    return {
+        "module": module,
+        "total_ms": round(total_ms, 1),
+        "budget_ms": budget_ms,
+        "within_budget": total_ms <= budget_ms,
+        "slowest": {name: round(ms, 1) for name, ms in slowest},
+    }
+
+
+if __name__ == "__main__":
+    import argparse
+    import json
+
+    parser = argparse.ArgumentParser(description="冷啟動工具")
+    sub = parser.add_subparsers(dest="cmd", required=True)
+    p_check = sub.add_parser("check-imports")
+    p_check.add_argument("--module", default="main")
+    p_check.add_argument("--budget-ms", type=float, default=float(os.getenv("STARTUP_IMPORT_BUDGET_MS", "600")))
+    args = parser.parse_args()
+
+    report = check_imports(args.module, args.budget_ms)
+    print(json.dumps(report, indent=2))
+    if not report["within_budget"]:
+        raise SystemExit("import 時間超過預算")
@@ -0,0 +1,242 @@
+# 檔案名稱: transits.py
+# 行運：同一時刻天空中的行星位置對所有人都一樣，每個時段只計算一次，存進共用的記憶體表格；
+# 每位使用者的行運只是拿本命行星黃經和表格中的一列做陣列運算，不必為每個請求建立「現在」的星盤
+#
+#   TRANSIT_DAYS        表格涵蓋今天起的天數（預設 8；另保留前一天，方便跨時區的「昨天」）
+#   TRANSIT_SLOT_HOURS  時段長度（預設 24，每天一個時段；6 表示每天 4 個時段），須能整除 24，行星位置取時段中點
+#
+# 排程：背景工作在每個時段交界時重建表格（表格很小：9 天 × 10 顆行星），
+# 查詢時若表格已過期（例如排程尚未啟動）也會當場重建
+#
+# 共用表格以 +08:00 劃分時段；其他時區的查詢以該時區的當地日期劃分，時段起點與表格對齊時
+# （時差為時段長度的整數倍，例如 6 小時時段的 +02:00）直接查表，否則當場計算
+import asyncio
+import datetime
+import os
+import time
+
+import numpy as np
+
+import engine
+import ephemeris
+import logs
+import metrics
+
+logger = logs.get_logger("transits")
+
+# 行運行星：含天王、海王、冥王（外行星的行運最慢、影響期最長）
+BODIES = ephemeris.BODIES
+BODY_NAMES = [b.lower() for b in BODIES]
+
+# 相位：(名稱, 角度, 容許度)
+ASPECTS = [
+    ("conjunction", 0.0, 8.0),
+    ("sextile", 60.0, 4.0),
+    ("square", 90.0, 6.0),
+    ("trine", 120.0, 6.0),
+    ("opposition", 180.0, 8.0),
+]
+ASPECT_ANGLES = np.array([a[1] for a in ASPECTS])
+ASPECT_ORBS = np.array([a[2] for a in ASPECTS])
+
+# 共用表格的時區：與 engine 的預設相同，以 +08:00 劃分日期
+TZ_OFFSET = 8.0
+TZ = datetime.timezone(datetime.timedelta(hours=TZ_OFFSET))
+_UNIX_EPOCH_JD = 2440587.5
+
+
+def zone(tz_offset):
+    """UTC 偏移（小時）→ 固定偏移的 tzinfo"""
+    return TZ if tz_offset == TZ_OFFSET else datetime.timezone(datetime.timedelta(hours=tz_offset))
+
+
+def sky_longitudes(jds):
+    """(N,) 儒略日 → (N, 10) 黃經；有黃經表時插值，否則逐筆由 Swiss Ephemeris 計算"""
+    jds = np.asarray(jds, dtype=np.float64)
+    table = ephemeris.get_table()
+    if table is not None and np.all((jds >= table.start_jd) & (jds < table.end_jd)):
+        return table.longitudes_batch(jds)
+    from flatlib.ephem import swe
+    return np.array([[swe.sweObjectLon(b, jd) for b in BODIES] for jd in jds.tolist()])
+
+
+def natal_longitudes(planets):
+    """engine 回傳的 planets（{"sun": {"sign": ..., "deg": ...}}）→ (名稱列表, 黃經陣列)"""
+    names = [name for name in BODY_NAMES if name in planets]
+    lons = np.array([engine.ZODIAC_NAMES.index(planets[n]["sign"]) * 30.0 + planets[n]["deg"] for n in names])
+    return names, lons
+
+
+def find_aspects(transit_lons, natal_lons, next_lons=None):
+    """
+    一次算出所有 (行運行星, 本命行星, 相位) 組合：
+    回傳 [(行運序號, 本命序號, 相位序號, 誤差度數, 是否入相位)]，依誤差由小到大排序
+    next_lons 為下一個時段的行運黃經，用來判斷相位正在形成（入相位）還是分離
+    """
+    def deviation(t):
+        sep = np.abs((t[:, None] - natal_lons[None, :] + 180.0) % 360.0 - 180.0)  # (行運, 本命)
+        return np.abs(sep[:, :, None] - ASPECT_ANGLES)                            # (行運, 本命, 相位)
+
+    dev = deviation(transit_lons)
+    t_idx, n_idx, a_idx = np.nonzero(dev <= ASPECT_ORBS)
+    orbs = dev[t_idx, n_idx, a_idx]
+    if next_lons is not None:
+        applying = deviation(next_lons)[t_idx, n_idx, a_idx] < orbs
+    else:
+        applying = np.zeros(len(orbs), dtype=bool)
+    order = np.argsort(orbs, kind="stable")
+    return list(zip(t_idx[order].tolist(), n_idx[order].tolist(), a_idx[order].tolist(),
+                    orbs[order].tolist(), applying[order].tolist()))
+
+
+class TransitTable:
+    def __init__(self, days, slot_hours):
+        if slot_hours <= 0 or not (24 / slot_hours).is_integer():
+            # 時段跨過午夜時每天的時段數不是整數，日期範圍會錯位、表格也永遠不會是最新的
+            raise ValueError(f"TRANSIT_SLOT_HOURS 須能整除 24（例如 1、2、3、4、6、8、12、24），收到: {slot_hours}")
+        self.days = days
+        self.slot_hours = slot_hours
+        self.first_slot = None  # 第一列的時段編號（自 1970-01-01 +08:00 當地時間起算）
+        self.lons = None        # (時段數, 10) 黃經
+        self.sky = []           # 每個時段的行星星座（直接放進回應，不必每次轉換）
+        self.built_at = None
+        self.rebuilds = 0
+        self._task = None
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            days=int(os.getenv("TRANSIT_DAYS", "8")),
+            slot_hours=float(os.getenv("TRANSIT_SLOT_HOURS", "24")),
+        )
+
+    @property
+    def slot_seconds(self):
+        return self.slot_hours * 3600.0
+
+    @property
+    def slots_per_day(self):
+        return int(24 / self.slot_hours)
+
+    def day_slots(self, date, days=1, tz_offset=TZ_OFFSET):
+        """當地日期（UTC 偏移 tz_offset 小時）起 days 天內的所有時段編號"""
+        first = self.slot_of(datetime.datetime(date.year, date.month, date.day, tzinfo=zone(tz_offset)), tz_offset)
+        return list(range(first, first + self.slots_per_day * days))
+
+    def slot_of(self, when, tz_offset=TZ_OFFSET):
+        """aware datetime → 時段編號（以 UTC 偏移 tz_offset 的當地時間劃分）"""
+        return int((when.timestamp() + tz_offset * 3600.0) // self.slot_seconds)
+
+    def slot_start(self, slot, tz_offset=TZ_OFFSET):
+        """時段編號 → 該時段開始的當地時間"""
+        return datetime.datetime.fromtimestamp(slot * self.slot_seconds - tz_offset * 3600.0, zone(tz_offset))
+
+    def _table_slot(self, slot, tz_offset):
+        """其他時區的時段編號 → 起點相同的表格時段編號；起點沒有對齊時回傳 None"""
+        shift = (TZ_OFFSET - tz_offset) * 3600.0 / self.slot_seconds
+        return slot + int(shift) if shift == int(shift) else None
+
+    def _slot_jds(self, slots, tz_offset=TZ_OFFSET):
+        mid = (np.asarray(slots, dtype=np.float64) + 0.5) * self.slot_seconds - tz_offset * 3600.0
+        return _UNIX_EPOCH_JD + mid / 86400.0
+
+    def _compute(self, slots, tz_offset=TZ_OFFSET):
+        lons = sky_longitudes(self._slot_jds(slots, tz_offset))
+        signs = ephemeris.sign_indices(lons)
+        sky = [{name: {"sign": engine.ZODIAC_NAMES[s], "deg": round(lon % 30, 2)}
+                for name, s, lon in zip(BODY_NAMES, row_signs.tolist(), row.tolist())}
+               for row, row_signs in zip(lons, signs)]
+        return lons, sky
+
+    def rebuild(self, now=None):
+        """重建表格：前一天 + 今天起 days 天"""
+        start = time.perf_counter()
+        per_day = self.slots_per_day
+        first = self.slot_of(now or datetime.datetime.now(TZ)) - per_day
+        slots = list(range(first, first + per_day * (self.days + 1)))
+        lons, sky = self._compute(slots)
+        # 一次替換三個欄位，查詢端不會讀到新舊混雜的表格
+        self.first_slot, self.lons, self.sky = first, lons, sky
+        self.built_at = time.time()
+        self.rebuilds += 1
+        logger.info("transit table rebuilt", extra={"fields": {
+            "slots": len(slots), "ms": round((time.perf_counter() - start) * 1000, 2)}})
+
+    def _fresh(self, now):
+        if self.lons is None:
+            return False
+        return self.slot_of(now) - self.first_slot == self.slots_per_day
+
+    def rows(self, slots, tz_offset=TZ_OFFSET):
+        """
+        回傳 [(時段編號, 黃經, 行星星座, 下一時段黃經)]；slots 以 UTC 偏移 tz_offset 的當地時間劃分
+        表格外、或起點沒有和表格對齊的時段當場計算（不寫回表格）
+        """
+        now = datetime.datetime.now(TZ)
+        if not self._fresh(now):
+            self.rebuild(now)
+        first, lons, sky = self.first_slot, self.lons, self.sky
+        result = []
+        for slot in slots:
+            table_slot = self._table_slot(slot, tz_offset)
+            i = -1 if table_slot is None else table_slot - first
+            if 0 <= i < len(lons) - 1:
+                _lookups.inc("hit")
+                result.append((slot, lons[i], sky[i], lons[i + 1]))
+            else:
+                _lookups.inc("miss")
+                extra_lons, extra_sky = self._compute([slot, slot + 1], tz_offset)
+                result.append((slot, extra_lons[0], extra_sky[0], extra_lons[1]))
+        return result
+
+    async def _run(self):
+        while True:
+            now = datetime.datetime.now(TZ)
+            next_start = self.slot_start(self.slot_of(now) + 1)
+            await asyncio.sleep(max(1.0, (next_start - now).total_seconds() + 1.0))
+            try:
+                self.rebuild()
+            except Exception:
+                logger.exception("transit table rebuild failed")
+
+    def start(self):
+        """建立表格並啟動排程（lifespan 預熱步驟中呼叫）"""
+        self.rebuild()
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    def stats(self):
+        return {
+            "days": self.days,
+            "slot_hours": self.slot_hours,
+            "slots": 0 if self.lons is None else len(self.lons),
+            "first_slot_start": None if self.first_slot is None else self.slot_start(self.first_slot).isoformat(),
+            "built_at": self.built_at,
+            "rebuilds": self.rebuilds,
+        }
+
+
+def transits_for(natal_planets, rows, tz_offset=TZ_OFFSET):
+    """本命行星 × 共用表格的列 → 每個時段的行運相位（start 以 UTC 偏移 tz_offset 的當地時間表示）"""
+    names, natal = natal_longitudes(natal_planets)
+    result = []
+    for slot, lons, sky, next_lons in rows:
+        aspects = [
+            {"transit": BODY_NAMES[t], "natal": names[n], "aspect": ASPECTS[a][0],
+             "orb": round(orb, 2), "applying": applying}
+            for t, n, a, orb, applying in find_aspects(lons, natal, next_lons)
+        ]
+        result.append({"start": table.slot_start(slot, tz_offset).isoformat(), "sky": sky, "aspects": aspects})
+    return result
+
+
+table = TransitTable.from_env()
+
+_lookups = metrics.registry.register(metrics.Counter(
+    "star_transit_lookups_total", "Transit slot lookups served from the shared table (hit) or computed on demand (miss)",
+    ("result",)))